@@ -0,0 +1,407 @@
+'''
+## BENCHBOX 1.0
+## Measures LocalBox on this machine. Every workload runs on fresh loopback nodes (see loopbox): the files it
+## needs beforehand are put in the first node's folder and synced at start up, then the change is made there
+## and timed until every other node has an exact copy
+##   huge     one big file
+##   tiny     many tiny files in subfolders
+##   edits    a few bytes changed in a big file, one edit after the other
+##   renames  a burst of renames and deletes among many small files
+## New files are written outside the folder first and moved in all at once, so the time to generate them isn't counted
+## For every workload it reports throughput, change-to-replica latency and the CPU time and peak RSS of every
+## node, and saves it all as JSON. Given the JSON of an earlier run it compares the two and fails on a regression
+## Usage: python benchbox.py [--nodes N] [--port PORT] [--output FILE] [--compare FILE] [workload ...]
+'''
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from loopbox import LoopbackNodes, CONNECT_TIMEOUT, SYNC_TIMEOUT, PROGRAM_DIR, write_file, file_digest
+
+MB = 1024*1024
+
+DEFAULT_NODES = 2
+DEFAULT_PORT = 22000
+
+DEFAULT_HUGE_SIZE = 1024
+DEFAULT_TINY_FILES = 100000
+DEFAULT_EDIT_SIZE = 256
+DEFAULT_RENAME_FILES = 10000
+
+#Tiny files are 1 to TINY_SIZE bytes, FILES_PER_FOLDER to a folder
+TINY_SIZE = 512
+FILES_PER_FOLDER = 1000
+
+#The edits workload changes EDIT_BYTES bytes at a random offset EDIT_COUNT times
+EDIT_COUNT = 5
+EDIT_BYTES = 100
+
+#Of the files in the renames workload, this share is renamed and this share deleted
+RENAMED_SHARE = 0.2
+DELETED_SHARE = 0.1
+
+#A metric this much worse than in the compared run is a regression
+DEFAULT_TOLERANCE = 0.2
+
+
+class BenchmarkFailed(Exception):
+    pass
+
+
+def process_usage(pid):
+    #(CPU seconds, peak RSS in bytes) of a running process, from /proc. None where there is no /proc
+
+    try:
+        with open("/proc/%s/stat"%pid,"rb") as f:
+            #The fields after the command name, which can have spaces in it
+            fields = f.read().rsplit(")",1)[1].split()
+        with open("/proc/%s/status"%pid,"rb") as f:
+            status = f.read()
+    except (IOError,OSError):
+        return None
+
+    cpu = (int(fields[11]) + int(fields[12]))/float(os.sysconf("SC_CLK_TCK"))
+    peak = 0
+    for line in status.splitlines():
+        if line.startswith("VmHWM:"):
+            peak = int(line.split()[1])*1024
+    return cpu,peak
+
+
+class Benchmark(object):
+    #One workload on its own fresh nodes
+
+    def __init__(self,name,count,first_port,multicast=None):
+
+        self.name = name
+        self.nodes = LoopbackNodes(count,first_port,multicast)
+        self.folder = self.nodes.folders[0]
+        self.staging = os.path.join(self.nodes.root,"staging")
+
+        #{name: (size,md5)} of what every node should end up with
+        self.expected = {}
+
+        self.latencies = []
+        self._bytes = 0
+        self._files = 0
+        self._began = None
+        self._changed = None
+        self._synced = None
+        self._usage = None
+
+    def _path(self,folder,name):
+
+        path = os.path.join(folder,*name.split("/"))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return path
+
+    def put(self,name,data):
+        #A file that is there before the nodes start
+
+        with open(self._path(self.folder,name),"wb") as f:
+            f.write(data)
+        self.expected[name] = (len(data),hashlib.md5(data).hexdigest())
+
+    def put_random(self,name,size):
+
+        path = self._path(self.folder,name)
+        write_file(path,size)
+        self.expected[name] = (size,file_digest(path))
+
+    def stage(self,name,data):
+        #A new file, moved into the folder with the others by move_in
+
+        with open(self._path(self.staging,name),"wb") as f:
+            f.write(data)
+        self.expected[name] = (len(data),hashlib.md5(data).hexdigest())
+        self._count(len(data))
+
+    def stage_random(self,name,size):
+
+        path = self._path(self.staging,name)
+        write_file(path,size)
+        self.expected[name] = (size,file_digest(path))
+        self._count(size)
+
+    def move_in(self):
+
+        for name in os.listdir(self.staging):
+            os.rename(os.path.join(self.staging,name),os.path.join(self.folder,name))
+        self._changed = time.time()
+
+    def edit(self,name,offset,data):
+
+        path = os.path.join(self.folder,*name.split("/"))
+        with open(path,"r+b") as f:
+            f.seek(offset)
+            f.write(data)
+        self._changed = time.time()
+
+        self.expected[name] = (os.path.getsize(path),file_digest(path))
+        self._count(len(data))
+
+    def rename(self,old,new):
+
+        os.rename(os.path.join(self.folder,*old.split("/")),self._path(self.folder,new))
+        self._changed = time.time()
+
+        self.expected[new] = self.expected.pop(old)
+        self._count(0)
+
+    def delete(self,name):
+
+        os.remove(os.path.join(self.folder,*name.split("/")))
+        self._changed = time.time()
+
+        del self.expected[name]
+        self._count(0)
+
+    def _count(self,size):
+        self._bytes = self._bytes + size
+        self._files = self._files + 1
+
+    def start(self):
+        #Starts the nodes and waits until the files put there beforehand are everywhere
+
+        self.nodes.start()
+        if not self.nodes.wait_connected(CONNECT_TIMEOUT):
+            raise BenchmarkFailed("the nodes didn't connect to each other")
+        self.wait()
+
+    def wait(self):
+
+        synced = self.nodes.wait_synced(self.expected,SYNC_TIMEOUT,interval=0.1)
+        if synced is None:
+            raise BenchmarkFailed("not every node had the files after %s seconds"%SYNC_TIMEOUT)
+        return synced
+
+    def begin(self):
+        #Everything from here on is measured, along with the files staged for it
+
+        self._usage = self.usage()
+        self._began = time.time()
+
+    def synced(self):
+        #Waits for the last change to reach every node
+
+        self._synced = self.wait()
+        self.latencies.append(max(0.0,self._synced-self._changed))
+
+    def usage(self):
+        return [process_usage(process.pid) for process in self.nodes.processes]
+
+    def result(self):
+
+        seconds = self._synced - self._began
+        latencies = sorted(self.latencies)
+
+        cpu = []
+        peak_rss = []
+        for before,after in zip(self._usage,self.usage()):
+            if before is None or after is None:
+                cpu.append(None)
+                peak_rss.append(None)
+            else:
+                cpu.append(round(after[0]-before[0],3))
+                peak_rss.append(after[1])
+
+        return {"passed": True,
+                "nodes": len(self.nodes.folders),
+                "bytes": self._bytes,
+                "files": self._files,
+                "seconds": round(seconds,3),
+                "mb_per_second": round(self._bytes/float(MB)/seconds,3) if seconds > 0 else None,
+                "files_per_second": round(self._files/seconds,3) if seconds > 0 else None,
+                "latency": {"min": round(latencies[0],3),
+                            "median": round(latencies[len(latencies)//2],3),
+                            "max": round(latencies[-1],3)},
+                "cpu_seconds": cpu,
+                "peak_rss_bytes": peak_rss}
+
+    def close(self,keep=False):
+
+        self.nodes.stop()
+        if not keep:
+            self.nodes.remove()
+
+
+def huge_workload(bench,options):
+
+    bench.start()
+    bench.stage_random("huge.bin",options.huge_size*MB)
+
+    bench.begin()
+    bench.move_in()
+    bench.synced()
+
+def tiny_workload(bench,options):
+
+    bench.start()
+    for i in range(options.tiny_files):
+        bench.stage("tiny/%03d/%06d.txt"%(i//FILES_PER_FOLDER,i),os.urandom(random.randint(1,TINY_SIZE)))
+
+    bench.begin()
+    bench.move_in()
+    bench.synced()
+
+def edits_workload(bench,options):
+
+    size = options.edit_size*MB
+    bench.put_random("edited.bin",size)
+    bench.start()
+
+    bench.begin()
+    for i in range(EDIT_COUNT):
+        bench.edit("edited.bin",random.randint(0,size-EDIT_BYTES),os.urandom(EDIT_BYTES))
+        bench.synced()
+
+def renames_workload(bench,options):
+
+    for i in range(options.rename_files):
+        bench.put("many/%03d/%06d.txt"%(i//FILES_PER_FOLDER,i),os.urandom(4096))
+    bench.start()
+
+    names = sorted(bench.expected)
+    random.shuffle(names)
+    renamed = int(len(names)*RENAMED_SHARE)
+    deleted = int(len(names)*DELETED_SHARE)
+
+    bench.begin()
+    for name in names[:renamed]:
+        bench.rename(name,name.replace(".txt",".renamed.txt"))
+    for name in names[renamed:renamed+deleted]:
+        bench.delete(name)
+    bench.synced()
+
+WORKLOADS = [("huge",huge_workload),("tiny",tiny_workload),("edits",edits_workload),("renames",renames_workload)]
+
+
+def run(name,workload,options):
+
+    bench = Benchmark(name,options.nodes,options.port,options.multicast)
+    print "\n%s: running %s nodes in %s"%(name,options.nodes,bench.nodes.root)
+
+    try:
+        workload(bench,options)
+        result = bench.result()
+    except BenchmarkFailed as e:
+        print "%s FAILED: %s, logs are in %s"%(name,e,bench.nodes.root)
+        bench.close(keep=True)
+        return {"passed": False, "error": str(e)}
+
+    bench.close()
+    print "%s: %s files, %.1f MB in %.2f seconds, latency %.2f seconds (median), CPU %s seconds, peak RSS %s MB"%(
+        name,result["files"],result["bytes"]/float(MB),result["seconds"],result["latency"]["median"],
+        result["cpu_seconds"],[rss//MB if rss else None for rss in result["peak_rss_bytes"]])
+    return result
+
+
+def git_commit():
+
+    try:
+        return subprocess.check_output(["git","rev-parse","HEAD"],cwd=PROGRAM_DIR,stderr=subprocess.STDOUT).strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+
+def compare(old,new,tolerance):
+    #Prints how every workload did against an earlier run, returns the regressions
+
+    #(metric, True if higher is better)
+    metrics = [("mb_per_second",True),("files_per_second",True),("median latency",False),("total CPU seconds",False),("max peak RSS",False)]
+
+    def value(result,metric):
+        if metric == "median latency":
+            return result["latency"]["median"]
+        if metric == "total CPU seconds":
+            values = [cpu for cpu in result["cpu_seconds"] if cpu is not None]
+            return sum(values) if values else None
+        if metric == "max peak RSS":
+            values = [rss for rss in result["peak_rss_bytes"] if rss is not None]
+            return max(values) if values else None
+        return result[metric]
+
+    regressions = []
+    print "\nCompared to %s (commit %s):"%(old.get("time"),old.get("commit"))
+
+    for name,result in sorted(new["workloads"].items()):
+        before = old["workloads"].get(name)
+        if not before or not before.get("passed") or not result.get("passed"):
+            continue
+
+        for metric,higher_is_better in metrics:
+            a = value(before,metric)
+            b = value(result,metric)
+            if not a or b is None:
+                continue
+
+            change = (b-a)/float(a)
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > tolerance:
+                flag = "  REGRESSION"
+                regressions.append("%s %s"%(name,metric))
+            print "  %-8s %-18s %12.3f -> %12.3f (%+.0f%%)%s"%(name,metric,a,b,change*100,flag)
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Runs LocalBox workloads on loopback nodes and saves the results as JSON")
+    parser.add_argument("workloads",nargs="*",metavar="workload",help="any of %s, all of them by default"%", ".join(name for name,w in WORKLOADS))
+    parser.add_argument("--nodes",type=int,default=DEFAULT_NODES,help="nodes per workload (default %(default)s)")
+    parser.add_argument("--port",type=int,default=DEFAULT_PORT,help="port of the first node, the others take the next ones (default %(default)s)")
+    parser.add_argument("--huge-size",type=int,default=DEFAULT_HUGE_SIZE,help="MB of the huge file (default %(default)s)")
+    parser.add_argument("--tiny-files",type=int,default=DEFAULT_TINY_FILES,help="number of tiny files (default %(default)s)")
+    parser.add_argument("--edit-size",type=int,default=DEFAULT_EDIT_SIZE,help="MB of the edited file (default %(default)s)")
+    parser.add_argument("--rename-files",type=int,default=DEFAULT_RENAME_FILES,help="files among which some are renamed and deleted (default %(default)s)")
+    parser.add_argument("--multicast",metavar="GROUP:PORT",help="have the nodes multicast big files to this group")
+    parser.add_argument("--output",help="JSON file for the results (default benchmark-<date>.json)")
+    parser.add_argument("--compare",help="JSON of an earlier run, a metric more than --tolerance worse fails the run")
+    parser.add_argument("--tolerance",type=float,default=DEFAULT_TOLERANCE,help="(default %(default)s)")
+    options = parser.parse_args()
+
+    names = [name for name,workload in WORKLOADS]
+    for name in options.workloads:
+        if name not in names:
+            parser.error("unknown workload %s"%name)
+
+    results = {"time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+               "commit": git_commit(),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "options": vars(options),
+               "workloads": {}}
+
+    for name,workload in WORKLOADS:
+        if not options.workloads or name in options.workloads:
+            results["workloads"][name] = run(name,workload,options)
+
+    output = options.output or "benchmark-%s.json"%datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    with open(output,"wb") as f:
+        json.dump(results,f,indent=2,sort_keys=True)
+    print "\nResults saved in %s"%output
+
+    failed = [name for name,result in results["workloads"].items() if not result["passed"]]
+
+    if options.compare:
+        with open(options.compare,"rb") as f:
+            regressions = compare(json.load(f),results,options.tolerance)
+        if regressions:
+            print "\nREGRESSED: %s"%", ".join(regressions)
+            return 1
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
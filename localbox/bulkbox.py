@@ -0,0 +1,157 @@
+'''
+## BULKBOX 1.0
+## Many small files in one transfer. A folder seeded with thousands of files, or a drop of them, would
+## otherwise cost a stream, a FILE_BEGIN and an acknowledgement per file, and the window fills up with
+## files of a few bytes. In bulk they go as one stream of records, like a tar file: a header (name length,
+## size, mtime in ns), the name, then the data. The records are cut into FILE_DATA frames without regard
+## for where a file starts or ends, so the frames are full and compress well, and the peer puts every
+## file in place as soon as its last byte is in
+'''
+
+import io
+import struct
+
+from framebox import ProtocolError
+
+#name length, size, mtime in nanoseconds
+RECORD_HEADER = struct.Struct(">IQq")
+MAX_NAME_SIZE = 64*1024
+
+#The queue is sent in bulk once it has at least BULK_MIN_FILES files smaller than BULK_FILE_SIZE,
+#in streams of at most BULK_STREAM_FILES files and BULK_STREAM_SIZE bytes
+BULK_MIN_FILES = 32
+BULK_FILE_SIZE = 256*1024
+BULK_STREAM_FILES = 1000
+BULK_STREAM_SIZE = 16*1024*1024
+
+
+def bulk_batches(files):
+    #files: [(filename,size)] in the order to send them, split into lists of filenames for one stream each
+
+    batches = []
+    batch = []
+    batch_size = 0
+
+    for filename,size in files:
+        if batch and (len(batch) >= BULK_STREAM_FILES or batch_size + size > BULK_STREAM_SIZE):
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+        batch.append(filename)
+        batch_size = batch_size + size
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+def pack_record(name,size,mtime_ns):
+    return RECORD_HEADER.pack(len(name),size,mtime_ns) + name
+
+def record_stream(entries,frame_size):
+    #The records of entries, (filename,name,size,mtime_ns) each, in pieces of exactly frame_size bytes
+    #(the last one shorter). Files that can't be read anymore are left out, a file that shrank since
+    #its size was taken is padded with zeros like a whole transfer would be
+
+    pending = []
+    pending_size = 0
+
+    for filename,name,size,mtime_ns in entries:
+        try:
+            f = io.open(filename,"rb")
+        except IOError:
+            continue
+
+        with f:
+            data = f.read(size)
+        data = data + b"\0"*(size-len(data))
+
+        for part in (pack_record(name,size,mtime_ns),data):
+            pending.append(part)
+            pending_size = pending_size + len(part)
+
+            if pending_size < frame_size:
+                continue
+
+            joined = b"".join(pending)
+            start = 0
+            while pending_size - start >= frame_size:
+                yield joined[start:start+frame_size]
+                start = start + frame_size
+            pending = [joined[start:]]
+            pending_size = pending_size - start
+
+    if pending_size:
+        yield b"".join(pending)
+
+
+class RecordReader(object):
+    #Takes a record stream in pieces of any size and calls begin(name,size,mtime_ns), then data(offset,data)
+    #for every piece of the file's data and end() once the last one is in
+
+    def __init__(self,begin,data,end):
+
+        self._begin = begin
+        self._data = data
+        self._end = end
+
+        #The header (and name) collected so far, None while in the data of a file
+        self._header = b""
+        self._name_size = None
+        self._size = 0
+        self._mtime_ns = 0
+        self._offset = 0
+
+    def in_record(self):
+        #True if the stream stopped in the middle of a record
+        return self._header != b""
+
+    def feed(self,data):
+
+        position = 0
+        while position < len(data):
+
+            if self._header is not None:
+                position = self._read_header(data,position)
+                continue
+
+            n = min(self._size-self._offset,len(data)-position)
+            self._data(self._offset,data[position:position+n])
+            self._offset = self._offset + n
+            position = position + n
+
+            if self._offset == self._size:
+                self._finish_record()
+
+    def _read_header(self,data,position):
+        #Collects the fixed header, then the name, then starts the file
+
+        if self._name_size is None:
+            need = RECORD_HEADER.size
+        else:
+            need = RECORD_HEADER.size + self._name_size
+
+        taken = data[position:position+need-len(self._header)]
+        self._header = self._header + taken
+        position = position + len(taken)
+        if len(self._header) < need:
+            return position
+
+        if self._name_size is None:
+            self._name_size,self._size,self._mtime_ns = RECORD_HEADER.unpack(self._header)
+            if self._name_size > MAX_NAME_SIZE:
+                raise ProtocolError("Bulk record name of %s bytes is too long"%self._name_size)
+            if self._name_size > 0:
+                return position
+
+        self._begin(self._header[RECORD_HEADER.size:],self._size,self._mtime_ns)
+        self._header = None
+        self._offset = 0
+
+        if self._size == 0:
+            self._finish_record()
+        return position
+
+    def _finish_record(self):
+        self._end()
+        self._header = b""
+        self._name_size = None
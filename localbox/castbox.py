@@ -0,0 +1,252 @@
+'''
+## CASTBOX 1.0
+## Multicast for big files going to many peers. Sent over TCP, a file costs the sender's uplink once per
+## peer (or per relay group). Multicast puts it on the LAN once, as UDP datagrams to a group every peer
+## listening to it gets them from.
+## A peer is asked over its control connection first (FILE_BEGIN of MODE_MULTICAST, then CAST_JOIN with
+## the session id, group and port) and says CAST_READY once it has joined the group. The file then goes
+## out in blocks of CAST_BLOCK_SIZE bytes, paced to the multicast rate since UDP has no flow control,
+## with an XOR parity block after every FEC_GROUP of them: one block lost in a group is rebuilt from the
+## rest and the parity without asking. CAST_DONE then tells every peer the file is out, each one answers
+## with a CAST_NACK of the pieces it is still missing and those are sent over its TCP connection like any
+## FILE_DATA, then FILE_END.
+## A peer that can't join the group, or that gets none of the datagrams (multicast isn't routed there),
+## answers STATUS_SEND_WHOLE instead and gets its files the usual way from then on
+'''
+
+import binascii
+import errno
+import itertools
+import os
+import socket
+import struct
+import threading
+import time
+
+from shapebox import TokenBucket, RateLimit
+from indexbox import mtime_ns
+
+#session, block number (the group number for a parity block), kind
+DATAGRAM_HEADER = struct.Struct(">IIB")
+KIND_DATA = 0
+KIND_PARITY = 1
+
+#CAST_JOIN: session, port, then the group address
+JOIN_PAYLOAD = struct.Struct(">IH")
+
+#Data in one datagram, it fits an ethernet frame with the IP, UDP and datagram headers
+CAST_BLOCK_SIZE = 1400
+
+#Data blocks covered by one parity block
+FEC_GROUP = 16
+
+#Files at least this big are multicast, to at least MIN_CAST_PEERS peers, at most this many bytes a second
+DEFAULT_MULTICAST_THRESHOLD = 8*1024*1024
+DEFAULT_MULTICAST_RATE = 40*1024*1024
+MIN_CAST_PEERS = 2
+
+#What the pacing lets out at once, the receivers' socket buffers have to take it
+CAST_BURST = 256*1024
+RECEIVE_BUFFER_SIZE = 8*1024*1024
+
+#A receiver told the file is out waits until no datagram of it came for QUIET_TIME seconds, at most DRAIN_TIME
+QUIET_TIME = 0.1
+DRAIN_TIME = 2.0
+
+
+def parse_group(address):
+    #"group:port" to (group,port)
+    group,port = address.rsplit(":",1)
+    return group,int(port)
+
+def xor_blocks(blocks,size):
+    #The XOR of the blocks, shorter ones padded with zeros to size. Done on long integers, which
+    #python XORs in C, a loop over the bytes would be far too slow
+
+    value = 0
+    for block in blocks:
+        value = value ^ int(binascii.hexlify(bytes(block).ljust(size,b"\0")),16)
+    return binascii.unhexlify("%0*x"%(size*2,value))
+
+def block_count(size):
+    return (size+CAST_BLOCK_SIZE-1)//CAST_BLOCK_SIZE
+
+def missing_blocks(have,size):
+    #(offset,length) in bytes of the runs of blocks that aren't in, have is a bytearray with a 1 for every
+    #block that is, size the size of the file
+
+    missing = []
+    start = have.find(b"\0")
+    while start != -1:
+        end = have.find(b"\1",start)
+        if end == -1:
+            end = len(have)
+        missing.append((start*CAST_BLOCK_SIZE,min(end*CAST_BLOCK_SIZE,size)-start*CAST_BLOCK_SIZE))
+        start = have.find(b"\0",end)
+    return missing
+
+def pack_join(session,group,port):
+    return JOIN_PAYLOAD.pack(session,port) + group
+
+def unpack_join(payload):
+    #(session,group,port)
+    session,port = JOIN_PAYLOAD.unpack_from(payload)
+    return session,payload[JOIN_PAYLOAD.size:],port
+
+
+class Multicaster(object):
+    #The sending side, one for the node
+
+    def __init__(self,box,group,port,rate=DEFAULT_MULTICAST_RATE,interface=None):
+
+        self.box = box
+        self.group = group
+        self.port = port
+
+        self._socket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.IPPROTO_IP,socket.IP_MULTICAST_TTL,1)
+        #Peers on this machine listen too
+        self._socket.setsockopt(socket.IPPROTO_IP,socket.IP_MULTICAST_LOOP,1)
+        if interface:
+            self._socket.setsockopt(socket.IPPROTO_IP,socket.IP_MULTICAST_IF,socket.inet_aton(interface))
+
+        self._limit = RateLimit([box._rate_limit,TokenBucket(rate,CAST_BURST)],box._metrics)
+
+        #Sessions start at a random number so a restarted node doesn't reuse the ones peers may still know
+        self._sessions = itertools.count(struct.unpack(">I",os.urandom(4))[0] >> 1)
+
+    def send_file(self,filename,peers):
+        #Multicasts the file to peers and repairs what they missed. Returns the peers that didn't get it
+
+        box = self.box
+        st = os.stat(filename)
+        name = box._index.name(filename)
+        session = next(self._sessions) & 0xFFFFFFFF
+
+        streams = {}
+        missed = []
+        for peer in peers:
+            try:
+                stream = peer.cast_begin(session,self.group,self.port,name,st.st_size,mtime_ns(st))
+            except (IOError,socket.error) as e:
+                print "\nCouldn't start a multicast to %s: %s"%(peer.address,e)
+                stream = None
+            if stream is None:
+                missed.append(peer)
+            else:
+                streams[peer] = stream
+
+        if not streams:
+            return missed
+
+        print "\nMulticasting %s (%s bytes) to %s peers"%(name,st.st_size,len(streams))
+        started = time.time()
+        self._cast(session,filename,st.st_size)
+        box._metrics.count("localbox_multicast_bytes_total",st.st_size)
+        box._metrics.observe("localbox_send_seconds",time.time()-started)
+
+        #Every peer's repairs go over its own connection, at the same time
+        results = {}
+        def finish(peer):
+            try:
+                results[peer] = peer.cast_finish(streams[peer],filename)
+            except (IOError,socket.error) as e:
+                print "\nMulticast to %s failed: %s"%(peer.address,e)
+
+        threads = [threading.Thread(target = finish,args = (peer,)) for peer in streams]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+        missed.extend(peer for peer in streams if not results.get(peer))
+        return missed
+
+    def _cast(self,session,filename,size):
+
+        destination = (self.group,self.port)
+        group_bytes = CAST_BLOCK_SIZE*FEC_GROUP
+
+        with open(filename,"rb") as f:
+            for group_offset in range(0,size,group_bytes):
+                data = f.read(min(group_bytes,size-group_offset))
+                blocks = [data[i:i+CAST_BLOCK_SIZE] for i in range(0,len(data),CAST_BLOCK_SIZE)]
+                first = group_offset//CAST_BLOCK_SIZE
+
+                self._limit.take(len(data)+(len(blocks)+1)*DATAGRAM_HEADER.size+CAST_BLOCK_SIZE)
+
+                for i,block in enumerate(blocks):
+                    self._send(DATAGRAM_HEADER.pack(session,first+i,KIND_DATA)+block,destination)
+                parity = xor_blocks(blocks,CAST_BLOCK_SIZE)
+                self._send(DATAGRAM_HEADER.pack(session,first//FEC_GROUP,KIND_PARITY)+parity,destination)
+
+    def _send(self,datagram,destination):
+
+        while True:
+            try:
+                self._socket.sendto(datagram,destination)
+                return
+            except socket.error as e:
+                #The socket's buffer is full, the pacing is ahead of the interface
+                if e.errno not in (errno.ENOBUFS,errno.EAGAIN):
+                    raise
+                time.sleep(0.001)
+
+    def close(self):
+        self._socket.close()
+
+
+class CastListener(object):
+    #The receiving side of one group and port, hands the datagrams of every session to the transfer
+    #that joined it
+
+    def __init__(self,group,port,interface=None):
+
+        self.group = group
+        self.port = port
+
+        self._socket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        #Every node on this machine listens on the same port
+        self._socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        if hasattr(socket,"SO_REUSEPORT"):
+            try:
+                self._socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEPORT,1)
+            except socket.error:
+                pass
+        self._socket.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,RECEIVE_BUFFER_SIZE)
+        self._socket.bind(("",port))
+        self._socket.setsockopt(socket.IPPROTO_IP,socket.IP_ADD_MEMBERSHIP,socket.inet_aton(group)+socket.inet_aton(interface or "0.0.0.0"))
+
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+        t = threading.Thread(target = self._run)
+        t.daemon = True
+        t.start()
+
+    def add(self,session,transfer):
+        with self._lock:
+            self._sessions[session] = transfer
+
+    def remove(self,session):
+        with self._lock:
+            self._sessions.pop(session,None)
+
+    def _run(self):
+
+        buffer = bytearray(DATAGRAM_HEADER.size+CAST_BLOCK_SIZE)
+        view = memoryview(buffer)
+
+        while True:
+            try:
+                n = self._socket.recv_into(buffer)
+            except socket.error:
+                continue
+            if n < DATAGRAM_HEADER.size:
+                continue
+
+            session,index,kind = DATAGRAM_HEADER.unpack_from(buffer)
+            transfer = self._sessions.get(session)
+            if transfer is not None:
+                transfer.on_datagram(index,kind,view[DATAGRAM_HEADER.size:n])
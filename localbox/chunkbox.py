@@ -0,0 +1,332 @@
+'''
+## CHUNKBOX 1.0
+## Content defined chunking and a local chunk index, so data the peer already has somewhere
+## in its folder (an older build, the same archive under another name) is never sent again
+##
+## Chunk boundaries follow FastCDC's normalized chunking: nothing is cut before MIN_CHUNK_SIZE,
+## a strict cut condition is used up to AVG_CHUNK_SIZE and a loose one up to MAX_CHUNK_SIZE.
+## A per byte gear hash loop is far too slow in python, so each byte is mapped to one gear bit with
+## str.translate and cut points are where a fixed bit pattern appears, found with str.find.
+## Both run in C and the cut points still only depend on the bytes around them
+## The index follows the folder on a thread of its own as syncs find files changed and files come in,
+## a peer's chunk list is only looked up in it, chunk by chunk
+'''
+
+import hashlib
+import itertools
+import os
+import pickle
+import Queue
+import struct
+import threading
+import time
+
+MIN_CHUNK_SIZE = 16*1024
+AVG_CHUNK_SIZE = 64*1024
+MAX_CHUNK_SIZE = 256*1024
+
+DEFAULT_DEDUP_THRESHOLD = 1024*1024
+
+_READ_SIZE = 8*1024*1024
+
+#Chunks offered first for a file the peer has no version of, only those at the start are chunked
+#before the peer says whether it has any of them
+PROBE_CHUNKS = 64
+
+#Files to chunk again are collected until none came for this many seconds, then chunked once no files are
+#being sent or received. Chunking in python holds the GIL, it would slow the transfers down
+UPDATE_DELAY = 1.0
+
+CHUNK = struct.Struct(">32sI")
+COUNT = struct.Struct(">I")
+INDEX = struct.Struct(">I")
+
+
+def _gear_bits(seed,count):
+    #Fixed pseudo random bits, every peer has to cut at the same places for chunks to match
+    bits = []
+    i = 0
+    while len(bits) < count:
+        for byte in bytearray(hashlib.md5(b"%s:%d"%(seed,i)).digest()):
+            bits.append(b"1" if byte & 1 else b"0")
+        i = i + 1
+    return bits[:count]
+
+_GEAR = b"".join(_gear_bits(b"gear",256))
+
+#AVG_CHUNK_SIZE is 2**16, a pattern of n bits turns up about every 2**n bytes
+_PATTERN = b"".join(_gear_bits(b"pattern",18))
+_STRICT_PATTERN = _PATTERN
+_LOOSE_PATTERN = _PATTERN[:14]
+
+
+def _cut_points(data,start,end,final):
+    #Yields chunk ends in data[start:end], if final is False the last unfinished chunk is left over
+
+    bits = data.translate(_GEAR)
+    strict = len(_STRICT_PATTERN)
+    loose = len(_LOOSE_PATTERN)
+
+    while start < end:
+
+        if end - start <= MIN_CHUNK_SIZE:
+            if final:
+                yield end
+            return
+
+        if not final and end - start < MAX_CHUNK_SIZE:
+            #Not enough data yet to be sure where this chunk ends
+            return
+
+        cut = bits.find(_STRICT_PATTERN,start+MIN_CHUNK_SIZE-strict,min(start+AVG_CHUNK_SIZE,end))
+        if cut != -1:
+            cut = cut + strict
+        else:
+            cut = bits.find(_LOOSE_PATTERN,start+AVG_CHUNK_SIZE-loose+1,min(start+MAX_CHUNK_SIZE,end))
+            if cut != -1:
+                cut = cut + loose
+            else:
+                cut = min(start+MAX_CHUNK_SIZE,end)
+
+        yield cut
+        start = cut
+
+
+def chunk_hash(data):
+    return hashlib.sha256(data).digest()
+
+def chunks(f):
+    #Yields (offset,length,sha256) for every chunk of the file
+
+    offset = 0
+    leftover = b""
+
+    while True:
+        data = f.read(_READ_SIZE)
+        final = not data
+        data = leftover + data
+
+        start = 0
+        for cut in _cut_points(data,0,len(data),final):
+            yield offset+start,cut-start,chunk_hash(data[start:cut])
+            start = cut
+
+        offset = offset + start
+        leftover = data[start:]
+
+        if final:
+            break
+
+
+def probe_chunks(path,count=PROBE_CHUNKS):
+    #The first count chunks of the file, cut where chunks() would cut them
+
+    with open(path,"rb") as f:
+        return list(itertools.islice(chunks(f),count))
+
+
+def pack_chunk_list(chunk_list):
+    parts = [COUNT.pack(len(chunk_list))]
+    parts.extend(CHUNK.pack(digest,length) for offset,length,digest in chunk_list)
+    return b"".join(parts)
+
+def unpack_chunk_list(data,count):
+    #Offsets aren't sent, they follow from the lengths
+    chunk_list = []
+    offset = 0
+    for i in range(count):
+        digest,length = CHUNK.unpack_from(data,i*CHUNK.size)
+        chunk_list.append((offset,length,digest))
+        offset = offset + length
+    return chunk_list
+
+def pack_index_list(indexes):
+    return COUNT.pack(len(indexes)) + b"".join(INDEX.pack(i) for i in indexes)
+
+def unpack_index_list(data,count):
+    return [INDEX.unpack_from(data,i*INDEX.size)[0] for i in range(count)]
+
+
+class ChunkIndex(object):
+    #Knows which chunks the files in the folder are made of, kept in chunks.lb next to files.db
+    #Only files that changed since they were last chunked get read again. busy() is True while files
+    #are being sent or received, updates wait for it
+
+    def __init__(self,index_file="chunks.lb",busy=None):
+
+        self.index_file = index_file
+        self._busy = busy
+        self._files = {}
+        self._chunks = {}
+        self._dirty = False
+
+        #Used by the sending and the receiving thread at the same time
+        self._lock = threading.RLock()
+
+        #Files waiting to be chunked again, see update
+        self._updates = Queue.Queue()
+        self._updater = None
+
+        if os.path.exists(index_file):
+            try:
+                with open(index_file,"rb") as f:
+                    self._files = pickle.load(f)
+            except:
+                self._files = {}
+
+        for path in self._files:
+            self._add_chunks(path,self._files[path][2])
+
+    def _add_chunks(self,path,chunk_list):
+        for offset,length,digest in chunk_list:
+            self._chunks.setdefault(digest,[]).append((path,offset,length))
+
+    def _remove_chunks(self,path):
+        for offset,length,digest in self._files[path][2]:
+            locations = [location for location in self._chunks.get(digest,[]) if location[0] != path]
+            if locations:
+                self._chunks[digest] = locations
+            else:
+                self._chunks.pop(digest,None)
+
+    def chunks_for(self,path):
+        #Chunk list of one file, from the index if the file hasn't changed since
+
+        st = os.stat(path)
+        with self._lock:
+            entry = self._files.get(path)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime:
+            return entry[2]
+
+        with open(path,"rb") as f:
+            chunk_list = list(chunks(f))
+
+        self.add(path,st.st_size,st.st_mtime,chunk_list)
+        return chunk_list
+
+    def add(self,path,size,mtime,chunk_list):
+
+        with self._lock:
+            if path in self._files:
+                self._remove_chunks(path)
+
+            self._files[path] = (size,mtime,chunk_list)
+            self._add_chunks(path,chunk_list)
+            self._dirty = True
+
+    def remove(self,path):
+
+        with self._lock:
+            if path in self._files:
+                self._remove_chunks(path)
+                del self._files[path]
+                self._dirty = True
+
+    def refresh(self,paths,min_size=0):
+        #Brings the index up to date with the given files, forgets files that are gone
+
+        paths = set(paths)
+        with self._lock:
+            known = list(self._files)
+
+        for path in known:
+            if path not in paths:
+                self.remove(path)
+
+        for path in paths:
+            self._refresh_file(path,min_size)
+
+    def _refresh_file(self,path,min_size):
+        try:
+            if os.path.getsize(path) >= min_size:
+                self.chunks_for(path)
+            else:
+                self.remove(path)
+        except (IOError,OSError):
+            self.remove(path)
+
+    def update(self,paths,min_size=0,complete=False):
+        #Has the files chunked again if they changed, or forgotten if they are gone, on the index's own
+        #thread. complete: paths are all the files there are, the others are forgotten too
+
+        with self._lock:
+            if self._updater is None:
+                self._updater = threading.Thread(target = self._update_files)
+                self._updater.daemon = True
+                self._updater.start()
+
+        self._updates.put((list(paths),min_size,complete))
+
+    def _update_files(self):
+
+        while True:
+            updates = [self._updates.get()]
+            while True:
+                try:
+                    updates.append(self._updates.get(timeout=UPDATE_DELAY))
+                except Queue.Empty:
+                    break
+
+            while self._busy is not None and self._busy():
+                time.sleep(UPDATE_DELAY)
+
+            for paths,min_size,complete in updates:
+                if complete:
+                    self.refresh(paths,min_size)
+                else:
+                    for path in paths:
+                        self._refresh_file(path,min_size)
+
+            self.save()
+
+    def lookup(self,digest):
+        #Every (path,offset,length) the chunk can be found at, the caller should verify them
+        with self._lock:
+            return list(self._chunks.get(digest,[]))
+
+    def reader(self):
+        return ChunkReader(self)
+
+    def save(self):
+
+        with self._lock:
+            if not self._dirty:
+                return
+            with open(self.index_file,"wb") as f:
+                pickle.dump(self._files,f)
+            self._dirty = False
+
+
+class ChunkReader(object):
+    #Reads chunks out of local files for one assembly, keeping the source files open between chunks
+
+    def __init__(self,index):
+        self.index = index
+        self._open_files = {}
+
+    def read_verified(self,digest):
+        #Data of a local chunk if it still matches its hash, None otherwise
+
+        for path,offset,length in self.index.lookup(digest):
+
+            try:
+                if path not in self._open_files:
+                    self._open_files[path] = open(path,"rb")
+                f = self._open_files[path]
+                f.seek(offset)
+                data = f.read(length)
+            except (IOError,OSError):
+                continue
+
+            if len(data) == length and chunk_hash(data) == digest:
+                return data
+
+            #File changed since it was chunked, forget it, it is chunked again once a sync finds it changed
+            self.index.remove(path)
+
+        return None
+
+    def close(self):
+        for f in self._open_files.values():
+            f.close()
+        self._open_files = {}
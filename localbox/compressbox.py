@@ -0,0 +1,173 @@
+'''
+## COMPRESSBOX 1.0
+## Compression of file data on the wire. Every codec this python has is offered in HELLO, the sender
+## uses the first one of its preference the peer offers too.
+## The sender decides frame by frame: a few small samples of the data are compressed first and a frame
+## that barely shrinks (media, zips, anything already compressed) goes out as it is, so no CPU is spent
+## on data that won't get smaller
+'''
+
+import threading
+import time
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#Fast levels, the link is only worth saving as long as compressing keeps up with it
+ZLIB_LEVEL = 1
+LZMA_PRESET = 1
+ZSTD_LEVEL = 3
+
+#Data shorter than this isn't worth compressing at all
+MIN_COMPRESS_SIZE = 512
+
+#Samples of the data taken from its start, middle and end, compressed with zlib to guess how it compresses
+SAMPLE_SIZE = 4*1024
+SAMPLE_COUNT = 3
+
+#Data is only sent compressed if it shrinks to at most this much of its size (the samples too)
+MAX_RATIO = 0.9
+
+#The order codecs are picked in, when both peers have them
+DEFAULT_COMPRESSION = ["zstd","zlib","lzma"]
+
+#Codec ids as they go out in FILE_DATA_COMPRESSED
+CODEC_IDS = {"zlib": 1, "lzma": 2, "zstd": 3}
+
+
+def _zlib_decompress(data,size):
+    #Never more than size bytes come out, whatever the frame says
+
+    d = zlib.decompressobj()
+    data = d.decompress(data,size)
+    if d.unconsumed_tail:
+        raise ValueError("Data decompresses to more than %s bytes"%size)
+    return data
+
+_COMPRESS = {"zlib": lambda data: zlib.compress(data,ZLIB_LEVEL)}
+_DECOMPRESS = {"zlib": _zlib_decompress}
+
+if lzma is not None:
+    _COMPRESS["lzma"] = lambda data: lzma.compress(data,preset=LZMA_PRESET)
+    _DECOMPRESS["lzma"] = lambda data,size: lzma.decompress(data)
+
+if zstandard is not None:
+    _COMPRESS["zstd"] = lambda data: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    _DECOMPRESS["zstd"] = lambda data,size: zstandard.ZstdDecompressor().decompress(data,max_output_size=size)
+
+#The codecs this python has, offered in HELLO
+CODECS = [codec for codec in sorted(CODEC_IDS) if codec in _COMPRESS]
+
+_CODEC_NAMES = dict((codec_id,codec) for codec,codec_id in CODEC_IDS.items())
+
+
+def choose_codec(peer_capabilities,preference=DEFAULT_COMPRESSION):
+    #The codec to send to a peer with, None if we don't share one (or compression is off)
+
+    for codec in preference or ():
+        if codec in CODECS and codec in peer_capabilities:
+            return codec
+    return None
+
+def decompress(codec_id,data,size):
+    #size is the length of the original data, anything else coming out means the frame is broken
+
+    codec = _CODEC_NAMES.get(codec_id)
+    if codec not in _DECOMPRESS:
+        raise ValueError("Unknown codec %s"%codec_id)
+
+    try:
+        data = _DECOMPRESS[codec](data,size)
+    except ValueError:
+        raise
+    except Exception as e:
+        #zlib.error, lzma.LZMAError or zstandard.ZstdError
+        raise ValueError("Data doesn't decompress: %s"%e)
+
+    if len(data) != size:
+        raise ValueError("Data decompressed to %s bytes instead of %s"%(len(data),size))
+    return data
+
+def compresses(data):
+    #Guesses from a few samples whether data is worth compressing
+
+    if len(data) <= SAMPLE_SIZE*SAMPLE_COUNT:
+        return True
+
+    step = (len(data)-SAMPLE_SIZE)//(SAMPLE_COUNT-1)
+    sample = b"".join(data[i*step:i*step+SAMPLE_SIZE] for i in range(SAMPLE_COUNT))
+    return len(zlib.compress(sample,1)) <= len(sample)*MAX_RATIO
+
+
+class CompressionStats(object):
+    #Totals of everything a node compressed, added to by every sending thread
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.seconds = 0.0
+        self.skipped = 0
+
+    def add(self,compressor):
+
+        with self._lock:
+            self.raw_bytes = self.raw_bytes + compressor.raw_bytes
+            self.sent_bytes = self.sent_bytes + compressor.sent_bytes
+            self.seconds = self.seconds + compressor.seconds
+            self.skipped = self.skipped + compressor.skipped
+
+    def saved(self):
+        return self.raw_bytes - self.sent_bytes
+
+
+class Compressor(object):
+    #Compresses the frames of one transfer and counts what that saved and cost
+
+    def __init__(self,codec):
+
+        self.codec = codec
+        self.codec_id = CODEC_IDS[codec]
+        self._compress = _COMPRESS[codec]
+
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.seconds = 0.0
+        #Frames sent as they are because they wouldn't compress
+        self.skipped = 0
+
+    def compress(self,data):
+        #The compressed data, or None if data should go out as it is
+
+        start = time.time()
+        packed = None
+
+        if len(data) >= MIN_COMPRESS_SIZE and compresses(data):
+            packed = self._compress(data)
+            if len(packed) > len(data)*MAX_RATIO:
+                packed = None
+
+        self.seconds = self.seconds + time.time() - start
+        self.raw_bytes = self.raw_bytes + len(data)
+
+        if packed is None:
+            self.skipped = self.skipped + 1
+            self.sent_bytes = self.sent_bytes + len(data)
+        else:
+            self.sent_bytes = self.sent_bytes + len(packed)
+        return packed
+
+    def saved(self):
+        return self.raw_bytes - self.sent_bytes
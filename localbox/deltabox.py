@@ -0,0 +1,329 @@
+'''
+## DELTABOX 1.0
+## Rsync style delta transfer for files that changed on one peer
+## The receiver describes the copy it already has as block signatures (a rolling weak checksum
+## plus a strong hash per block), the sender slides over its new version looking for those blocks
+## and sends back only block references and the literal bytes in between.
+## The receiver then rebuilds the new version from its old copy and the literals
+'''
+
+import hashlib
+import struct
+import zlib
+
+DEFAULT_DELTA_THRESHOLD = 8*1024*1024
+
+MIN_BLOCK_SIZE = 2*1024
+MAX_BLOCK_SIZE = 128*1024
+
+#adler32 is computed modulo this, which is also what makes it cheap to roll one byte at a time
+_ADLER_MOD = 65521
+
+#How much of the new file is held in memory at once while looking for matches
+_READ_SIZE = 4*1024*1024
+
+#The largest literal run sent as one op
+_MAX_LITERAL = 1024*1024
+
+#Rolling one byte at a time is the slow part in python. In a long run with no matches (new or rewritten
+#data) only the first _ROLL_LIMIT bytes of every _SKIP_PERIOD are rolled, the rest is tested block by block
+_ROLL_LIMIT = 256*1024
+_SKIP_PERIOD = 8*1024*1024
+
+SIGNATURE_HEADER = struct.Struct(">IQI")
+SIGNATURE = struct.Struct(">I16s")
+
+#Signatures sent in one frame, a long list is split over several and ends with the first one that has fewer
+SIGNATURES_PER_FRAME = 64*1024
+
+OP_COPY = b"C"
+OP_DATA = b"D"
+OP_END = b"E"
+COPY_OP = struct.Struct(">II")
+DATA_OP = struct.Struct(">I")
+
+
+def block_size_for(size):
+    #Same idea as rsync: roughly the square root of the file size, so the signature list and
+    #the number of block references both grow slowly with huge files
+
+    block_size = int(size**0.5) & ~1023
+    return max(MIN_BLOCK_SIZE,min(MAX_BLOCK_SIZE,block_size))
+
+def weak_checksum(data):
+    return zlib.adler32(data) & 0xffffffff
+
+def strong_checksum(data):
+    return hashlib.md5(data).digest()
+
+
+def signatures(f,block_size):
+    #Yields (weak,strong) for every block of the file, the last block may be short
+
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        yield weak_checksum(block),strong_checksum(block)
+
+def pack_signatures(block_size,basis_size,sigs):
+    sigs = list(sigs)
+    parts = [SIGNATURE_HEADER.pack(block_size,basis_size,len(sigs))]
+    parts.extend(SIGNATURE.pack(weak,strong) for weak,strong in sigs)
+    return b"".join(parts)
+
+def signature_frames(block_size,basis_size,sigs):
+    #The payloads of the frames sigs go out in, SIGNATURES_PER_FRAME at most in each. The last one has
+    #fewer, it is empty if they all fit in full ones
+
+    batch = []
+    for sig in sigs:
+        batch.append(sig)
+        if len(batch) == SIGNATURES_PER_FRAME:
+            yield pack_signatures(block_size,basis_size,batch)
+            batch = []
+    yield pack_signatures(block_size,basis_size,batch)
+
+def unpack_signature_header(data):
+    #Returns (block_size,basis_size,count), count signatures of SIGNATURE.size bytes follow
+    return SIGNATURE_HEADER.unpack(data)
+
+def unpack_signatures(data,count):
+    return [SIGNATURE.unpack_from(data,i*SIGNATURE.size) for i in range(count)]
+
+def signature_table(payloads):
+    #SignatureTable from the frames signature_frames produced, payloads yields them one by one.
+    #None if it is cut off
+
+    sigs = []
+    for data in payloads:
+        if data is None:
+            return None
+        block_size,basis_size,count = unpack_signature_header(data[:SIGNATURE_HEADER.size])
+        sigs.extend(unpack_signatures(data[SIGNATURE_HEADER.size:],count))
+        if count < SIGNATURES_PER_FRAME:
+            return SignatureTable(block_size,basis_size,sigs)
+    return None
+
+
+class SignatureTable(object):
+    #Looks blocks of the basis file up by weak checksum first, strong hash only on a weak hit
+
+    def __init__(self,block_size,basis_size,sigs):
+
+        self.block_size = block_size
+        self.basis_size = basis_size
+        self._weak = {}
+        self._strong = []
+
+        for index,(weak,strong) in enumerate(sigs):
+            self._weak.setdefault(weak,[]).append(index)
+            self._strong.append(strong)
+
+        #The basis' last block is usually shorter, it can only match the end of the new file
+        self.tail_size = basis_size - (len(self._strong)-1)*block_size if self._strong else 0
+
+    def __len__(self):
+        return len(self._strong)
+
+    def has_weak(self,weak):
+        return weak in self._weak
+
+    def find(self,weak,window):
+
+        candidates = self._weak.get(weak)
+        if not candidates:
+            return None
+
+        strong = strong_checksum(window)
+        for index in candidates:
+            if self._strong[index] == strong:
+                return index
+
+        return None
+
+
+def delta_ops(f,table):
+    #Walks the new file and yields ("copy",first_block,count), ("data",bytes) and finally ("end",md5 of the new file)
+
+    block_size = table.block_size
+    file_hash = hashlib.md5()
+
+    buf = bytearray()
+    start = 0
+    literal_start = 0
+    eof = False
+
+    pending_copy = None
+    weak = None
+    unmatched = 0
+
+    while True:
+
+        #Keep at least one full window in the buffer until the file runs out
+        if not eof and len(buf) - start < block_size:
+            data = f.read(_READ_SIZE)
+            if data:
+                file_hash.update(data)
+                if literal_start > 0:
+                    #drop what was already sent or matched
+                    del buf[:literal_start]
+                    start = start - literal_start
+                    literal_start = 0
+                buf.extend(data)
+            else:
+                eof = True
+            continue
+
+        remaining = len(buf) - start
+        if remaining == 0:
+            break
+
+        if remaining < block_size:
+            #Only the basis' tail block can still match, and only the very end of the file
+            window = bytes(buf[start:])
+            index = None
+            if remaining == table.tail_size and len(table) > 0:
+                index = table.find(weak_checksum(window),window)
+                if index != len(table)-1:
+                    index = None
+
+            if index is None:
+                break
+
+            weak = None
+        else:
+            if weak is None:
+                weak = weak_checksum(bytes(buf[start:start+block_size]))
+
+            index = None
+            if table.has_weak(weak):
+                index = table.find(weak,bytes(buf[start:start+block_size]))
+
+            if index is None:
+                if unmatched % _SKIP_PERIOD < _ROLL_LIMIT:
+                    #No match here, slide the window one byte
+                    out_byte = buf[start]
+                    if start + block_size < len(buf):
+                        in_byte = buf[start+block_size]
+                        a = weak & 0xffff
+                        b = weak >> 16
+                        a = (a - out_byte + in_byte) % _ADLER_MOD
+                        b = (b - block_size*out_byte + a - 1) % _ADLER_MOD
+                        weak = (b << 16) | a
+                    else:
+                        weak = None
+                    start = start + 1
+                    unmatched = unmatched + 1
+                else:
+                    #Long run without matches, skip a whole block
+                    step = min(block_size,len(buf)-start)
+                    weak = None
+                    start = start + step
+                    unmatched = unmatched + step
+
+                if start - literal_start >= _MAX_LITERAL:
+                    if pending_copy:
+                        yield ("copy",pending_copy[0],pending_copy[1])
+                        pending_copy = None
+                    yield ("data",bytes(buf[literal_start:start]))
+                    literal_start = start
+                continue
+
+            weak = None
+
+        unmatched = 0
+
+        #A block matched at start, flush the literal before it
+        if start > literal_start:
+            if pending_copy:
+                yield ("copy",pending_copy[0],pending_copy[1])
+                pending_copy = None
+            yield ("data",bytes(buf[literal_start:start]))
+
+        if pending_copy and pending_copy[0] + pending_copy[1] == index:
+            pending_copy[1] = pending_copy[1] + 1
+        else:
+            if pending_copy:
+                yield ("copy",pending_copy[0],pending_copy[1])
+            pending_copy = [index,1]
+
+        start = min(start + block_size,len(buf))
+        literal_start = start
+
+    if pending_copy:
+        yield ("copy",pending_copy[0],pending_copy[1])
+
+    if len(buf) > literal_start:
+        yield ("data",bytes(buf[literal_start:]))
+
+    yield ("end",file_hash.digest())
+
+
+def pack_op(op):
+    #Wire form of one op from delta_ops, data ops carry their bytes right after the header
+
+    if op[0] == "copy":
+        return OP_COPY + COPY_OP.pack(op[1],op[2])
+    elif op[0] == "data":
+        return OP_DATA + DATA_OP.pack(len(op[1])) + op[1]
+    else:
+        return OP_END + op[1]
+
+
+def unpack_ops(data):
+    #The ops of a buffer filled by pack_op, in order
+
+    offset = 0
+    while offset < len(data):
+
+        op = data[offset:offset+1]
+        offset = offset + 1
+
+        if op == OP_COPY:
+            index,count = COPY_OP.unpack_from(data,offset)
+            offset = offset + COPY_OP.size
+            yield ("copy",index,count)
+        elif op == OP_DATA:
+            length, = DATA_OP.unpack_from(data,offset)
+            offset = offset + DATA_OP.size
+            yield ("data",data[offset:offset+length])
+            offset = offset + length
+        elif op == OP_END:
+            yield ("end",data[offset:offset+16])
+            offset = offset + 16
+        else:
+            raise IOError("Unknown delta op %r"%op)
+
+
+class DeltaPatcher(object):
+    #Rebuilds the new version of a file into out from the receiver's old copy (basis) and the ops
+
+    def __init__(self,basis,out,block_size,basis_size):
+
+        self.basis = basis
+        self.out = out
+        self.block_size = block_size
+        self.basis_size = basis_size
+        self._hash = hashlib.md5()
+
+    def copy(self,index,count):
+
+        offset = index*self.block_size
+        remaining = min(count*self.block_size,self.basis_size-offset)
+        self.basis.seek(offset)
+
+        while remaining > 0:
+            data = self.basis.read(min(remaining,_READ_SIZE))
+            if not data:
+                raise IOError("Delta references data past the end of the basis file")
+            self.write(data)
+            remaining = remaining - len(data)
+
+    def write(self,data):
+        self._hash.update(data)
+        self.out.write(data)
+
+    def finish(self,digest):
+        #True if the rebuilt file is exactly what the sender has
+        return self._hash.digest() == digest
@@ -0,0 +1,325 @@
+'''
+## FRAMEBOX 1.0
+## The LocalBox wire protocol. Everything sent between peers is a frame: a fixed header
+## (frame type, stream id, payload length) followed by the payload, so a message never depends
+## on how recv happens to split the bytes up.
+## Every file transfer (and every directory reconcile) gets its own stream id, which lets many of
+## them be in flight on one connection at the same time. The receiver acknowledges each stream once
+## it is done and the sender keeps at most a window of unacknowledged streams open
+'''
+
+import struct
+import threading
+
+from compressbox import CODECS
+
+PROTOCOL_VERSION = 3
+
+#type, stream id, payload length
+FRAME_HEADER = struct.Struct(">BII")
+MAX_PAYLOAD = 64*1024*1024
+
+#File data goes out in frames of at most this many bytes
+DATA_FRAME_SIZE = 1024*1024
+
+#Unacknowledged file transfers a sender keeps in flight
+DEFAULT_WINDOW = 64
+
+#Data connections a sender opens to its peer, and the size of the byte ranges big files are split into
+#so they can be sent over all of them at once
+DEFAULT_CONNECTIONS = 4
+DEFAULT_STRIPE_SIZE = 16*1024*1024
+
+#Connection level
+HELLO = 0x01
+BYE = 0x02
+#Sent on an idle connection so the peer's server doesn't drop it (see serverbox), nothing answers it
+PING = 0x03
+
+#A file transfer
+FILE_BEGIN = 0x10
+FILE_DATA = 0x11
+FILE_END = 0x12
+FILE_ACK = 0x13
+
+#Peers the receiver passes the file on to once it has it (see peerbox), sent right after FILE_BEGIN
+FILE_RELAY = 0x14
+
+#FILE_DATA whose data is compressed (see compressbox)
+FILE_DATA_COMPRESSED = 0x15
+
+#What the receiver kept of a version of a file from an interrupted transfer, asked before it is sent
+RESUME_REQUEST = 0x16
+RESUME_REPLY = 0x17
+
+#A hole in a sparse file, (offset,length) bytes of zeros that are never sent (see sparsebox)
+FILE_HOLE = 0x18
+
+#Files renamed or moved, done by the peer to its copies, and the ones it couldn't do (see movebox)
+FILE_MOVE = 0x19
+FILE_MOVE_RESULT = 0x1A
+
+#Delta transfers (deltabox)
+DELTA_SIGNATURES = 0x20
+DELTA_OPS = 0x21
+
+#Chunked transfers (chunkbox)
+CHUNK_LIST = 0x30
+CHUNK_WANT = 0x31
+#The first chunks of a file the peer has no version of, the list follows only if it has some of them
+CHUNK_PROBE = 0x32
+CHUNK_PROBE_HIT = 0x33
+
+#Directory reconcile (treebox)
+TREE_ROOT = 0x40
+TREE_REQUEST = 0x41
+TREE_REPLY = 0x42
+
+#Flags of TREE_ROOT. The sender's index was empty when it started, so its tree doesn't tell what it
+#deleted, the peer only notes that the reconcile took place
+TREE_KEEP = 0x01
+
+#Multicast transfers (castbox): joining the group, ready for the datagrams, all of them sent, the pieces missed
+CAST_JOIN = 0x50
+CAST_READY = 0x51
+CAST_DONE = 0x52
+CAST_NACK = 0x53
+
+#How a file is sent, the mode of FILE_BEGIN
+MODE_WHOLE = 0
+MODE_DELTA = 1
+MODE_CHUNKS = 2
+#One byte range of a file, the size in FILE_BEGIN is the size of the whole file
+MODE_RANGE = 3
+#Many small files as one stream of records (bulkbox), the size in FILE_BEGIN is the number of files
+MODE_BULK = 4
+#A whole file multicast as UDP datagrams (castbox), CAST_JOIN follows and what is missed comes as FILE_DATA
+MODE_MULTICAST = 5
+#Or'ed into the mode of a whole or range transfer of a file with holes, which come as FILE_HOLE frames
+MODE_SPARSE = 0x80
+
+#FILE_ACK statuses
+STATUS_OK = 0
+STATUS_FAILED = 1
+STATUS_SEND_WHOLE = 2
+
+HELLO_PAYLOAD = struct.Struct(">H")
+#mode, size, mtime in nanoseconds
+BEGIN_PAYLOAD = struct.Struct(">BQq")
+DATA_PAYLOAD = struct.Struct(">Q")
+#offset, codec id, size of the data before it was compressed
+COMPRESSED_PAYLOAD = struct.Struct(">QBI")
+ACK_PAYLOAD = struct.Struct(">B")
+#size, mtime in nanoseconds
+RESUME_PAYLOAD = struct.Struct(">Qq")
+#After the root of the tree in TREE_ROOT, to peers that can "tree-from": the port the sender listens on,
+#which tells it apart from other peers on its host, and flags
+TREE_FROM = struct.Struct(">HB")
+#offset, length
+EXTENT = struct.Struct(">QQ")
+COUNT = struct.Struct(">I")
+
+#What this version can do, sent in HELLO, along with the compression codecs it has
+CAPABILITIES = ["delta","chunks","ranges","resume","tree-stream","bulk","sparse","moves","multicast","chunk-probe","tree-from"] + CODECS
+
+
+class ProtocolError(IOError):
+    pass
+
+
+def pack_hello(capabilities=CAPABILITIES):
+    return HELLO_PAYLOAD.pack(PROTOCOL_VERSION) + b",".join(capabilities)
+
+def unpack_hello(frame_type,payload):
+    #(version,capabilities) of the peer, the first frame it sends has to be its HELLO
+
+    if frame_type != HELLO:
+        raise ProtocolError("Peer didn't say hello (frame type %s)"%frame_type)
+
+    version, = HELLO_PAYLOAD.unpack_from(payload)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError("Peer speaks protocol version %s, we speak %s"%(version,PROTOCOL_VERSION))
+
+    rest = payload[HELLO_PAYLOAD.size:]
+    return version,rest.split(b",") if rest else []
+
+def pack_begin(mode,size,mtime_ns,name):
+    return BEGIN_PAYLOAD.pack(mode,size,mtime_ns) + name
+
+def unpack_begin(payload):
+    mode,size,mtime_ns = BEGIN_PAYLOAD.unpack_from(payload)
+    return mode,size,mtime_ns,payload[BEGIN_PAYLOAD.size:]
+
+def pack_resume(size,mtime_ns,name):
+    return RESUME_PAYLOAD.pack(size,mtime_ns) + name
+
+def unpack_resume(payload):
+    size,mtime_ns = RESUME_PAYLOAD.unpack_from(payload)
+    return size,mtime_ns,payload[RESUME_PAYLOAD.size:]
+
+def pack_tree_root(root,port=None,flags=0):
+    #port is None for a peer that can't "tree-from"
+    if port is None:
+        return root
+    return root + TREE_FROM.pack(port,flags)
+
+def unpack_tree_root(payload,has_from):
+    #(root,port,flags), port is None if the peer doesn't send it
+    if not has_from:
+        return payload,None,0
+    port,flags = TREE_FROM.unpack_from(payload,len(payload)-TREE_FROM.size)
+    return payload[:-TREE_FROM.size],port,flags
+
+def pack_extents(extents):
+    return COUNT.pack(len(extents)) + b"".join(EXTENT.pack(offset,length) for offset,length in extents)
+
+def unpack_extents(payload):
+    count, = COUNT.unpack_from(payload)
+    return [EXTENT.unpack_from(payload,COUNT.size+i*EXTENT.size) for i in range(count)]
+
+def pack_ack(status,message=b""):
+    return ACK_PAYLOAD.pack(status) + message
+
+def unpack_ack(payload):
+    return ACK_PAYLOAD.unpack_from(payload)[0],payload[ACK_PAYLOAD.size:]
+
+def data_frame(stream,offset,data,compressor=None):
+    #(type,stream,payload) of a FILE_DATA frame, or a FILE_DATA_COMPRESSED one if the compressor finds it worth it
+
+    if compressor is not None:
+        packed = compressor.compress(data)
+        if packed is not None:
+            return FILE_DATA_COMPRESSED,stream,COMPRESSED_PAYLOAD.pack(offset,compressor.codec_id,len(data))+packed
+
+    return FILE_DATA,stream,DATA_PAYLOAD.pack(offset)+data
+
+
+class Connection(object):
+    #A socket speaking frames. Frames can be sent from several threads, only one thread reads
+
+    def __init__(self,sock,engine,limiter=None):
+        #limiter paces everything sent, see shapebox.RateLimit
+
+        self.sock = sock
+        self.engine = engine
+        self.limiter = limiter
+        self.peer_version = None
+        self.peer_capabilities = []
+
+        #Whatever the user of a received connection wants to keep with it
+        self.session = None
+
+        self._send_lock = threading.Lock()
+        self._header = bytearray(FRAME_HEADER.size)
+
+    def handshake(self,capabilities=CAPABILITIES):
+        #Both ends send HELLO right away and then read the other one's
+
+        self.send_frame(HELLO,0,pack_hello(capabilities))
+
+        frame_type,stream,length = self.read_header()
+        self.peer_version,self.peer_capabilities = unpack_hello(frame_type,self.read_payload(length))
+
+    def can(self,capability):
+        return capability in self.peer_capabilities
+
+    def send_frame(self,frame_type,stream,payload=b""):
+
+        header = FRAME_HEADER.pack(frame_type,stream,len(payload))
+        self._throttle(len(header)+len(payload))
+        with self._send_lock:
+            if len(payload) < 64*1024:
+                self.sock.sendall(header+payload)
+            else:
+                self.sock.sendall(header)
+                self.sock.sendall(payload)
+
+    def send_frames(self,frames):
+        #Several (type,stream,payload) frames in one write, for transfers too small to bother splitting
+
+        data = b"".join(FRAME_HEADER.pack(frame_type,stream,len(payload))+payload for frame_type,stream,payload in frames)
+        self._throttle(len(data))
+        with self._send_lock:
+            self.sock.sendall(data)
+
+    def send_file_data(self,stream,f,offset,length,compressor=None):
+        #FILE_DATA frames for length bytes of the open file f starting at offset, the payload
+        #goes through the transfer engine so it is still sent zero-copy.
+        #With a compressor every frame is read and compressed first, if it is worth it
+
+        end = offset + length
+
+        if compressor is not None:
+            while offset < end:
+                n = min(DATA_FRAME_SIZE,end-offset)
+                f.seek(offset)
+                data = f.read(n)
+                #A file that shrank while it was sent is padded, like the engine does
+                data = data + b"\0"*(n-len(data))
+                self.send_frame(*data_frame(stream,offset,data,compressor))
+                offset = offset + n
+            return
+
+        while offset < end:
+            n = min(DATA_FRAME_SIZE,end-offset)
+            header = FRAME_HEADER.pack(FILE_DATA,stream,DATA_PAYLOAD.size+n) + DATA_PAYLOAD.pack(offset)
+            self._throttle(len(header)+n)
+            with self._send_lock:
+                self.sock.sendall(header)
+                self.engine.send_from(self.sock,f,offset,n)
+            offset = offset + n
+
+    def _throttle(self,size):
+        #Waits before taking the send lock, not while holding it
+        if self.limiter is not None:
+            self.limiter.take(size)
+
+    def send_data(self,stream,offset,data):
+        self.send_frame(FILE_DATA,stream,DATA_PAYLOAD.pack(offset)+data)
+
+    def read_header(self):
+
+        self._read_exact_into(self._header)
+        frame_type,stream,length = FRAME_HEADER.unpack(bytes(self._header))
+        if length > MAX_PAYLOAD:
+            raise ProtocolError("Frame of %s bytes is too big"%length)
+        return frame_type,stream,length
+
+    def read_payload(self,length):
+
+        data = bytearray(length)
+        self._read_exact_into(data)
+        return bytes(data)
+
+    def read_data_offset(self):
+        #First part of a FILE_DATA payload, the data itself follows
+        return DATA_PAYLOAD.unpack(self.read_payload(DATA_PAYLOAD.size))[0]
+
+    def read_into_file(self,out,offset,length):
+        #length bytes of payload written into out (a writebox.OutputFile) at offset
+
+        if self.engine.receive_at(self.sock,out,offset,length) < length:
+            raise ProtocolError("Connection closed")
+
+    def skip(self,length):
+
+        while length > 0:
+            n = min(length,DATA_FRAME_SIZE)
+            self.read_payload(n)
+            length = length - n
+
+    def _read_exact_into(self,buf):
+
+        view = memoryview(buf)
+        received = 0
+        while received < len(buf):
+            n = self.sock.recv_into(view[received:],len(buf)-received)
+            if n == 0:
+                raise ProtocolError("Connection closed")
+            received = received + n
+
+    def close(self):
+        try:
+            self.sock.close()
+        except:
+            pass
@@ -0,0 +1,175 @@
+'''
+## HASHBOX 1.0
+## Content hashes of the files in the folder. A hash is kept in hashes.db (next to files.db) under the
+## device, inode, size and mtime in ns of the file it was taken of, so an unchanged file is never read
+## again, not after a restart and not after it was renamed. A file that changed gets a new hash, the old
+## entry is replaced, and a full scan evicts the entries of files that are gone.
+## New and changed files are hashed on a pool of processes, one file each at a time, hashing doesn't let
+## go of the GIL in python 2. Files are read through mmap in windows of HASH_MAP_SIZE bytes, the hash runs
+## straight over the page cache without a copy into a buffer first. A few small files are hashed in the
+## calling process, handing them out would take longer. The pool is started with the cache, before the
+## program starts any threads: a process forked later gets a copy of every lock some other thread held
+'''
+
+import hashlib
+import io
+import mmap
+import multiprocessing
+import os
+import sqlite3
+import threading
+
+from indexbox import mtime_ns
+
+#Bytes of a file mapped at a time, a multiple of mmap.ALLOCATIONGRANULARITY
+HASH_MAP_SIZE = 64*1024*1024
+HASH_READ_SIZE = 1024*1024
+
+#Batches of files smaller than this in all are hashed without the pool
+POOL_MIN_BYTES = 64*1024*1024
+
+try:
+    DEFAULT_HASH_PROCESSES = multiprocessing.cpu_count()
+except NotImplementedError:
+    DEFAULT_HASH_PROCESSES = 1
+
+
+def file_hash(path):
+    #SHA-1 of the content of the file
+
+    digest = hashlib.sha1()
+    with io.open(path,"rb") as f:
+        size = os.fstat(f.fileno()).st_size
+
+        try:
+            for offset in range(0,size,HASH_MAP_SIZE):
+                view = mmap.mmap(f.fileno(),min(HASH_MAP_SIZE,size-offset),access=mmap.ACCESS_READ,offset=offset)
+                try:
+                    digest.update(view)
+                finally:
+                    view.close()
+            return digest.digest()
+        except (mmap.error,ValueError):
+            #Can't be mapped (some filesystems, or it shrank), read it instead
+            digest = hashlib.sha1()
+
+        f.seek(0)
+        while True:
+            data = f.read(HASH_READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.digest()
+
+def _pool_hash(path):
+    #Runs in a pool process, (path,hash) or (path,None) if the file can't be read
+    try:
+        return path,file_hash(path)
+    except (IOError,OSError):
+        return path,None
+
+def _key(st):
+    #None where there is no inode to go by (stats from scandir on windows)
+    if not st.st_ino:
+        return None
+    return (getattr(st,"st_dev",0),st.st_ino)
+
+
+class HashCache(object):
+
+    def __init__(self,db_path="hashes.db",processes=DEFAULT_HASH_PROCESSES):
+
+        self.processes = processes
+        self._pool = multiprocessing.Pool(processes) if processes > 1 else None
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path,check_same_thread=False,isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS hashes ("
+                           "dev INTEGER NOT NULL, inode INTEGER NOT NULL, size INTEGER NOT NULL, "
+                           "mtime_ns INTEGER NOT NULL, hash BLOB NOT NULL, PRIMARY KEY (dev,inode))")
+
+    def get(self,st):
+        #The hash of the file as st describes it, None if it isn't known
+
+        key = _key(st)
+        if key is None:
+            return None
+
+        with self._lock:
+            row = self._conn.execute("SELECT size,mtime_ns,hash FROM hashes WHERE dev=? AND inode=?",key).fetchone()
+
+        if row is None or (row[0],row[1]) != (st.st_size,mtime_ns(st)):
+            return None
+        return bytes(row[2])
+
+    def put(self,entries):
+        #entries: [(stat,hash)], replaces what was known about those files
+
+        rows = [_key(st)+(st.st_size,mtime_ns(st),sqlite3.Binary(digest)) for st,digest in entries if _key(st) is not None]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR REPLACE INTO hashes (dev,inode,size,mtime_ns,hash) VALUES (?,?,?,?,?)",rows)
+            self._conn.execute("COMMIT")
+
+    def evict(self,stats):
+        #Forgets every file but the ones of stats, the whole folder as a full scan found it
+
+        keep = set(_key(st) for st in stats)
+        with self._lock:
+            stale = [key for key in self._conn.execute("SELECT dev,inode FROM hashes") if key not in keep]
+            self._conn.execute("BEGIN")
+            self._conn.executemany("DELETE FROM hashes WHERE dev=? AND inode=?",stale)
+            self._conn.execute("COMMIT")
+        return len(stale)
+
+    def file_hash(self,path,st=None):
+        #Hash of one file, from the cache if it hasn't changed
+        return self.hash_files([(path,st or os.stat(path))]).get(path)
+
+    def hash_files(self,files):
+        #files: [(path,stat)]. Returns {path: hash}, the files that can't be read are left out
+
+        hashes = {}
+        missing = []
+        for path,st in files:
+            digest = self.get(st)
+            if digest is None:
+                missing.append((path,st))
+            else:
+                hashes[path] = digest
+
+        if not missing:
+            return hashes
+
+        stats = dict(missing)
+        #Biggest first, so the pool doesn't end up waiting on one big file at the end
+        paths = [path for path,st in sorted(missing,key=lambda entry: -entry[1].st_size)]
+
+        total = sum(st.st_size for st in stats.values())
+        if self._pool is not None and len(paths) > 1 and total >= POOL_MIN_BYTES:
+            #Small files go to the processes a few at a time, one by one they would cost more to hand out than to hash
+            chunksize = 1
+            if total < len(paths)*HASH_READ_SIZE:
+                chunksize = max(1,min(64,len(paths)//(self.processes*8)))
+            results = self._pool.imap_unordered(_pool_hash,paths,chunksize)
+        else:
+            results = (_pool_hash(path) for path in paths)
+
+        found = []
+        for path,digest in results:
+            if digest is not None:
+                hashes[path] = digest
+                found.append((stats[path],digest))
+
+        self.put(found)
+        return hashes
+
+    def close(self):
+
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+            self._conn.close()
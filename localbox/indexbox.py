@@ -0,0 +1,248 @@
+'''
+## INDEXBOX 1.0
+## The persistent file index, what LocalBox last knew about every file in the folder
+## It lives in an SQLite database (files.db) so a sync only writes the rows that changed,
+## and a crash in the middle of an update leaves the previous state behind instead of a broken pickle
+## Entries hold size, mtime in nanoseconds and inode, so edits within the same second are still seen,
+## plus an optional content hash. The index also keeps the hash tree of its file names (see treebox)
+## and the pieces of files received so far by transfers that haven't finished (see receivebox), and when the
+## file name tree was last reconciled with each peer
+'''
+
+import array
+import bisect
+import collections
+import contextlib
+import os
+import sqlite3
+import stat
+import threading
+from treebox import NameTree
+
+FileEntry = collections.namedtuple("FileEntry",["path","size","mtime_ns","inode","hash"])
+
+
+def mtime_ns(st):
+    #st_mtime_ns only exists from python 3.3, the float is good to about a microsecond
+    if hasattr(st,"st_mtime_ns"):
+        return st.st_mtime_ns
+    return int(round(st.st_mtime*1000000))*1000
+
+def is_file(st):
+    return st is not None and stat.S_ISREG(st.st_mode)
+
+def signature(st):
+    #What the index compares to tell whether a file changed
+    return (st.st_size,mtime_ns(st),st.st_ino)
+
+
+class FileIndex(object):
+
+    def __init__(self,db_path="files.db",root=".."):
+
+        self.db_path = db_path
+        self.root = os.path.realpath(root)
+
+        #One connection shared by the sending and receiving threads, guarded by the lock
+        self._lock = threading.RLock()
+        self._depth = 0
+
+        self._conn = sqlite3.connect(db_path,check_same_thread=False,isolation_level=None)
+        self._conn.text_factory = str
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS files ("
+                           "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+                           "inode INTEGER NOT NULL, hash BLOB)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS partials ("
+                           "path TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+                           "offset INTEGER NOT NULL, length INTEGER NOT NULL, PRIMARY KEY (path,offset))")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS peers ("
+                           "address TEXT PRIMARY KEY, reconciled_ns INTEGER NOT NULL)")
+
+        self._build_tree()
+
+    def _build_tree(self):
+        self.tree = NameTree(self.name(path) for path in self.paths())
+
+    def name(self,path):
+        #The name a file is known by on every peer, its path relative to the synced folder
+        return os.path.relpath(path,self.root).replace(os.sep,"/")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        #Groups many updates into one commit, nested transactions join the outer one
+
+        with self._lock:
+            if self._depth == 0:
+                self._conn.execute("BEGIN")
+            self._depth = self._depth + 1
+
+            try:
+                yield self
+            except:
+                self._depth = self._depth - 1
+                if self._depth == 0:
+                    self._conn.execute("ROLLBACK")
+                    self._build_tree()
+                raise
+
+            self._depth = self._depth - 1
+            if self._depth == 0:
+                self._conn.execute("COMMIT")
+
+    def get(self,path):
+
+        with self._lock:
+            row = self._conn.execute("SELECT path,size,mtime_ns,inode,hash FROM files WHERE path=?",(path,)).fetchone()
+
+        if row is None:
+            return None
+        #sqlite gives blobs back as buffers on python 2
+        path,size,mtime,inode,hash = row
+        return FileEntry(path,size,mtime,inode,None if hash is None else bytes(hash))
+
+    def changed(self,path,st):
+        #True if the file is new or differs from what the index last recorded
+
+        entry = self.get(path)
+        if entry is None:
+            return True
+        return (entry.size,entry.mtime_ns,entry.inode) != signature(st)
+
+    def update(self,path,st,hash=None):
+        #Records the file as it is now, the hash is dropped unless a new one is given
+
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO files (path,size,mtime_ns,inode,hash) VALUES (?,?,?,?,?)",
+                               (path,st.st_size,mtime_ns(st),st.st_ino,None if hash is None else sqlite3.Binary(hash)))
+            self.tree.add(self.name(path))
+
+    def set_hashes(self,entries):
+        #entries: [(path,stat,hash)] of files recorded without their hash, each one only goes in if the
+        #entry is still the file the stat was taken of
+
+        with self.transaction():
+            for path,st,hash in entries:
+                self._conn.execute("UPDATE files SET hash=? WHERE path=? AND size=? AND mtime_ns=? AND inode=?",
+                                   (sqlite3.Binary(hash),path,st.st_size,mtime_ns(st),st.st_ino))
+
+    def remove(self,path):
+
+        with self._lock:
+            self._conn.execute("DELETE FROM files WHERE path=?",(path,))
+            self.tree.remove(self.name(path))
+
+    def partial_extents(self,path,size,mtime_ns):
+        #(offset,length) of the pieces of this version of the file that are in its partial file
+
+        with self._lock:
+            return [tuple(row) for row in self._conn.execute("SELECT offset,length FROM partials WHERE path=? AND size=? AND mtime_ns=? "
+                                                             "ORDER BY offset",(path,size,mtime_ns))]
+
+    def add_partial(self,path,size,mtime_ns,offset,length):
+        #Records length bytes from offset as in, a piece from the same offset is replaced
+        #Pieces of any other version of the file are dropped
+
+        with self.transaction():
+            self._conn.execute("DELETE FROM partials WHERE path=? AND (size!=? OR mtime_ns!=?)",(path,size,mtime_ns))
+            self._conn.execute("INSERT OR REPLACE INTO partials (path,size,mtime_ns,offset,length) VALUES (?,?,?,?,?)",
+                               (path,size,mtime_ns,offset,length))
+
+    def remove_partial(self,path):
+
+        with self._lock:
+            self._conn.execute("DELETE FROM partials WHERE path=?",(path,))
+
+    def reconciled(self,address):
+        #When the last reconcile with the peer at address began, in ns, None if there never was one
+
+        with self._lock:
+            row = self._conn.execute("SELECT reconciled_ns FROM peers WHERE address=?",(address,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_reconciled(self,address,when_ns):
+        #A reconcile with the peer that began at when_ns is done, one that began earlier doesn't go back on it
+
+        with self._lock:
+            last = self.reconciled(address)
+            if last is None or when_ns > last:
+                self._conn.execute("INSERT OR REPLACE INTO peers (address,reconciled_ns) VALUES (?,?)",(address,when_ns))
+
+    def paths(self):
+
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT path FROM files")]
+
+    def snapshot(self):
+        #Every entry as it is now, a full scan compares against this instead of querying once per file
+        with self._lock:
+            return IndexSnapshot(self._conn.execute("SELECT path,size,mtime_ns,inode FROM files ORDER BY path"))
+
+    def __contains__(self,path):
+        return self.get(path) is not None
+
+    def __len__(self):
+
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def close(self):
+
+        with self._lock:
+            self._conn.close()
+
+
+def _packed(signed):
+    #An array of 64 bit integers. array only has "q" from python 3.3, "l" is 64 bits everywhere
+    #but windows, where a plain list has to do
+
+    for typecode in ("q","l") if signed else ("Q","L"):
+        try:
+            packed = array.array(typecode)
+        except ValueError:
+            continue
+        if packed.itemsize == 8:
+            return packed
+    return []
+
+
+class IndexSnapshot(object):
+    #The index entries in sorted arrays, the paths in one list and size, mtime and inode in packed
+    #arrays next to it, found by bisecting. Much smaller than a dict of tuples on a big folder
+
+    def __init__(self,rows):
+
+        self.paths = []
+        self.sizes = _packed(True)
+        self.mtimes = _packed(True)
+        self.inodes = _packed(False)
+
+        for path,size,mtime,inode in rows:
+            self.paths.append(path)
+            self.sizes.append(size)
+            self.mtimes.append(mtime)
+            self.inodes.append(inode)
+
+    def _find(self,path):
+        i = bisect.bisect_left(self.paths,path)
+        if i < len(self.paths) and self.paths[i] == path:
+            return i
+        return -1
+
+    def changed(self,path,st):
+        #Like FileIndex.changed, against the snapshot
+
+        i = self._find(path)
+        if i < 0:
+            return True
+        return (self.sizes[i],self.mtimes[i],self.inodes[i]) != signature(st)
+
+    def __contains__(self,path):
+        return self._find(path) >= 0
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
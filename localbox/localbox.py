@@ -4,7 +4,7 @@
 ## WHAT:
 ## It is a network based P2P folder syncing client. 
 ## It works with any folder, just add the localbox folder, edit the hosts file and run
-## It currently only works with files. Folders won't be synced. Zip a folder first to transfer it.
+## It syncs the files of the folder and of every folder in it. Empty folders aren't synced.
 ## 
 ## WHY:
 ## I wanted a fast way to tranfer HUGE files between two computers connected to the same wifi, but with a dropbox style UX
@@ -15,14 +15,14 @@
 ##
 ## IMPORTANT: 
 ## I recommend using a brand new folders because in an effort to sync directories, it might end up deleting some files
-## Before running the localbox.py file add the peers IP and Port to the first line,
+## Before running the localbox.py file add the peers IP and Port, one peer per line,
 ## in the hosts.txt file in the format, HOST_IP(space)PORT e.g. 127.0.0.1 101.
 ## Localbox uses port 100 by default for the server thread (that others can connect to) but you can change it to whatever you want
+## With more than two nodes changes are relayed from peer to peer (see peerbox), loopbox.py runs a few nodes on one machine
+## and benchbox.py measures how fast they sync
 ##      
 ## POSSIBLE IMPROVEMENTS: 
-## Add folder sync
-## To get a full Dropbox experience (more than two nodes) on LAN, if you have a huge local network,
-## you could spin up a separate server to handle multiple clients without a drastic change to the code              
+## Sync empty folders
 ##
 ## Author: Shimpano Mutangama
 
@@ -34,401 +34,1142 @@ import time
 import sys
 import os
 import pickle
+import Queue
+import collections
 from watchbox import Watcher
+from sendbox import TransferEngine, DEFAULT_SEND_BUFFER_SIZE, DEFAULT_RECV_BUFFER_SIZE
+from deltabox import DEFAULT_DELTA_THRESHOLD
+from indexbox import FileIndex, is_file, mtime_ns
+from treebox import Reconciler
+from chunkbox import DEFAULT_DEDUP_THRESHOLD, ChunkIndex, pack_index_list
+from framebox import Connection, ProtocolError, DEFAULT_WINDOW, DEFAULT_CONNECTIONS, DEFAULT_STRIPE_SIZE, unpack_begin, pack_ack, unpack_resume, pack_extents
+from framebox import BYE, PING, FILE_BEGIN, FILE_DATA, FILE_DATA_COMPRESSED, FILE_END, FILE_ACK, FILE_RELAY, RESUME_REQUEST, RESUME_REPLY, TREE_ROOT, TREE_REQUEST, TREE_REPLY, STATUS_OK, STATUS_FAILED, MODE_BULK
+from framebox import FILE_HOLE, FILE_MOVE, FILE_MOVE_RESULT, MODE_SPARSE, EXTENT, TREE_KEEP, unpack_tree_root
+from receivebox import TRANSFER_MODES, BulkStream, Session, DEFAULT_RESUME_THRESHOLD, held_extents
+from serverbox import FrameServer, DEFAULT_TIMEOUT
+from peerbox import Peer, DEFAULT_RELAY_FANOUT, relay_groups, unpack_route
+from compressbox import DEFAULT_COMPRESSION, CompressionStats
+from schedulebox import SyncScheduler, DEFAULT_QUIET_WINDOW, DEFAULT_SETTLE_TIME
+from walkbox import walk_files, DEFAULT_WALK_THREADS
+from metricsbox import Metrics, SyncProfiler, serve_stats, write_stats, DEFAULT_STATS_INTERVAL
+from shapebox import TokenBucket, transfer_priority
+from writebox import SyncBatch
+from bulkbox import BULK_MIN_FILES, BULK_FILE_SIZE, bulk_batches
+from movebox import find_moves, unpack_moves
+from hashbox import HashCache, DEFAULT_HASH_PROCESSES
+from castbox import Multicaster, CastListener, DEFAULT_MULTICAST_THRESHOLD, DEFAULT_MULTICAST_RATE, MIN_CAST_PEERS, parse_group
+
+def _raise(error):
+    raise error
+
+def _relayed_paths(filename,byte_range):
+    #The files of an entry of the relay queue (see LocalBox._relay)
+    if filename is None:
+        return [new for old,new,size,digest in byte_range]
+    if isinstance(filename,list):
+        return filename
+    return [filename]
 
 class LocalBoxWatcher(Watcher):
     #Inherits Watchbox class, necessary for overrides and provide functionality
 
     def __init__(self,files,box):
         self.box = box
-        super(LocalBoxWatcher,self).__init__(files=files)
+        super(LocalBoxWatcher,self).__init__(files=files,exclude=[box._program_folder],metrics=box._metrics)
     
-    def lb_file_changed(self):
-        self.box.sync_files()
+    def lb_file_changed(self,paths):
+        self.box._metrics.count("localbox_watcher_events_total",len(paths))
+        self.box._scheduler.add(paths)
 
-    def lb_file_added(self):
-        self.box.sync_files()
+    def lb_file_added(self,paths):
+        self.box._metrics.count("localbox_watcher_events_total",len(paths))
+        self.box._scheduler.add(paths)
 
-    def lb_file_deleted(self):
-        self.box.sync_files()
+    def lb_file_deleted(self,paths):
+        self.box._metrics.count("localbox_watcher_events_total",len(paths))
+        self.box._scheduler.add(paths)
+
+
+class LocalBoxServer(FrameServer):
+    #Inherits the FrameServer class, every peer's frames are received on the one server thread
+
+    def __init__(self,server_socket,box,timeout):
+        self.box = box
+        super(LocalBoxServer,self).__init__(server_socket,timeout=timeout)
+
+    def peer_connected(self,conn):
+        print "\nSuccessfully Connected (protocol %s, %s)"%(conn.peer_version,",".join(conn.peer_capabilities))
+        conn.session = Session()
+
+    def frame_received(self,conn,frame_type,stream,length):
+        return self.box._handle_frame(conn,conn.session,frame_type,stream,length)
+
+    def peer_closed(self,conn,error):
+
+        if error is not None:
+            print "\nConnection lost: %s"%error
+
+        if conn.session is not None:
+            self.box._end_session(conn.session)
 
 
 class LocalBox:
 
-    def __init__(self):
+    def __init__(self,send_buffer_size=DEFAULT_SEND_BUFFER_SIZE,recv_buffer_size=DEFAULT_RECV_BUFFER_SIZE,delta_threshold=DEFAULT_DELTA_THRESHOLD,
+                 dedup_threshold=DEFAULT_DEDUP_THRESHOLD,window=DEFAULT_WINDOW,connections=DEFAULT_CONNECTIONS,stripe_size=DEFAULT_STRIPE_SIZE,
+                 server_mode="select",peer_timeout=DEFAULT_TIMEOUT,relay_fanout=DEFAULT_RELAY_FANOUT,port=101,
+                 compression=DEFAULT_COMPRESSION,resume_threshold=DEFAULT_RESUME_THRESHOLD,quiet_window=DEFAULT_QUIET_WINDOW,
+                 settle_time=DEFAULT_SETTLE_TIME,walk_threads=DEFAULT_WALK_THREADS,stats_port=None,stats_file=None,
+                 stats_interval=DEFAULT_STATS_INTERVAL,profile=None,profile_dir="profiles",rate_limit=None,peer_rate_limit=None,
+                 hash_processes=DEFAULT_HASH_PROCESSES,multicast=None,multicast_interface=None,multicast_threshold=DEFAULT_MULTICAST_THRESHOLD,
+                 multicast_rate=DEFAULT_MULTICAST_RATE):
         
         print "\nIniltializing LocalBox..."
         
-        self._directory_files = {}
-        self._file_queue = []
-        self._client_socket = None
+        self._file_queue = collections.deque()
+        self._queued_at = None
+        self._flushing = False
+
+        #Files a sync found renamed or moved, (old path,new path,size,check) each, the peers do the same
+        #to their copies before the file queue is sent (see movebox)
+        self._moves = []
+
+        #Files a sync found that weren't in the index, the peers have no older version of them to patch
+        #either (see peerbox). On the first scan of a folder there is no telling, none are
+        self._new_files = set()
+
+        #What the sync pipeline is doing, served on 127.0.0.1:STATS_PORT and/or written to STATS_FILE every
+        #STATS_INTERVAL seconds in the Prometheus text format. None turns either off (see metricsbox)
+        #PROFILE is "cprofile" or "sample" to profile every sync into PROFILE_DIR
+        self.STATS_PORT = stats_port
+        self.STATS_FILE = stats_file
+        self.STATS_INTERVAL = stats_interval
+        self._metrics = Metrics()
+        self._profiler = SyncProfiler(profile,profile_dir)
         self._server_socket = None
 
-        self.BUFFER_SIZE = 1024
+        #Everything goes over the connection as frames (see framebox), file data through the transfer engine
+        self.SEND_BUFFER_SIZE = send_buffer_size
+        self.RECV_BUFFER_SIZE = recv_buffer_size
+        self._engine = TransferEngine(send_buffer_size=send_buffer_size,recv_buffer_size=recv_buffer_size)
+
+        #Files at least this big are sent as a delta against the peer's copy, smaller ones go whole
+        self.DELTA_THRESHOLD = delta_threshold
+
+        #Files at least this big are offered as a list of chunks first, only chunks the peer
+        #can't find anywhere in its own folder are sent
+        self.DEDUP_THRESHOLD = dedup_threshold
+        self._chunk_index = ChunkIndex("chunks.lb",busy=self._transferring)
+
+        #Whole files are sent without waiting for the peer, at most WINDOW of them unacknowledged
+        self.WINDOW = window
+
+        #Whole files are sent by a pool of workers, one per data connection to the peer, files of at least
+        #two stripes are split into STRIPE_SIZE ranges so every connection works on them at once
+        self.CONNECTIONS = connections
+        self.STRIPE_SIZE = stripe_size
+
+        #The peers of hosts.txt in order, by "host:port", and every peer we send to (see peerbox)
+        #Changes go to RELAY_FANOUT of them, which pass them on to the others
+        self.RELAY_FANOUT = relay_fanout
+        self._hosts = []
+        self._peers = {}
+        self._peers_lock = threading.Lock()
+        self._relays = Queue.Queue()
+
+        #How many times every file is waiting for the relay thread or being passed on by it, a reconcile
+        #doesn't remove those (see _remove_extra)
+        self._relaying = collections.Counter()
+        self._relaying_lock = threading.Lock()
+
+        #Everything sent goes out at most RATE_LIMIT bytes a second in all and PEER_RATE_LIMIT bytes a second
+        #to every peer (a number, or a {"host:port": number} dict), None for no limit (see shapebox)
+        self.RATE_LIMIT = rate_limit
+        self.PEER_RATE_LIMIT = peer_rate_limit
+        self._rate_limit = TokenBucket(rate_limit) if rate_limit else None
+
+        #Files of at least MULTICAST_THRESHOLD bytes going to several peers are multicast once to MULTICAST,
+        #"group:port", at most MULTICAST_RATE bytes a second instead of sent to each of them. None keeps
+        #everything on TCP. Groups are sent to and joined on MULTICAST_INTERFACE, any if None (see castbox)
+        self.MULTICAST = multicast
+        self.MULTICAST_INTERFACE = multicast_interface
+        self.MULTICAST_THRESHOLD = multicast_threshold
+        self.MULTICAST_RATE = multicast_rate
+        self._caster = None
+        self._cast_listeners = {}
+        self._cast_lock = threading.Lock()
+        if multicast:
+            group,cast_port = parse_group(multicast)
+            try:
+                self._caster = Multicaster(self,group,cast_port,multicast_rate,multicast_interface)
+            except socket.error as e:
+                print "\nMulticast isn't available, files go over TCP only: %s"%e
+
+        #File data is compressed with the first codec of COMPRESSION the peer has too, frames that don't
+        #compress go out as they are. None or [] turns compression off (see compressbox)
+        self.COMPRESSION = compression
+        self._compression_stats = CompressionStats()
+
+        #Watcher events are collected until QUIET_WINDOW seconds pass without one, files modified less
+        #than SETTLE_TIME seconds ago are held back until they stop changing (see schedulebox)
+        self.QUIET_WINDOW = quiet_window
+        self.SETTLE_TIME = settle_time
+        self._scheduler = SyncScheduler(self,quiet_window=quiet_window,settle_time=settle_time)
+
+        #The port the server thread listens on
+        self.PORT = port
+
+        #"select" serves every peer connection from the server thread (see serverbox), "threads" gives
+        #each connection its own thread. Peers quiet for PEER_TIMEOUT seconds are dropped by the first
+        self.SERVER_MODE = server_mode
+        self.PEER_TIMEOUT = peer_timeout
+
+        #The select server's blocking disk work (fsyncs, hashing, copying from local files, finishing
+        #transfers) runs on a thread of its own so it doesn't hold up every other peer's frames (see _in_background).
+        #It runs in the order it was handed over, a transfer's work always before its FILE_END
+        self._frame_server = None
+        self._background = Queue.Queue()
+
+        #Files being received into their partial files, by path (see receivebox)
+        #Transfers of files at least RESUME_THRESHOLD big that get cut off are resumed where they left off
+        self._partials = {}
+        self._partial_lock = threading.Lock()
+        self.RESUME_THRESHOLD = resume_threshold
+
+        #Received files put in place since the peer's last sync cycle ended, fsynced together (see writebox)
+        self._sync_batch = SyncBatch()
+
         self._friend_host_saved = False
         self._friend_port_saved = False
         self._client_connected = False
 
+        #The synced folder is scanned by WALK_THREADS threads, subfolders included (see walkbox)
+        #The localbox folder itself is left out, it is never synced
+        self.WALK_THREADS = walk_threads
+        self._program_folder = os.path.realpath(".")
+
         #Files used to help the program function
-        self._ignore_list = ["files.lb","localbox.py","localbox.pyc","watchbox.py","watchbox.pyc","server.py","hosts.txt"]
+        self._ignore_list = ["files.lb","files.db","files.db-wal","files.db-shm","hashes.db","hashes.db-wal","hashes.db-shm","chunks.lb","localbox.py","localbox.pyc","watchbox.py","watchbox.pyc","server.py","hosts.txt"]
 
         #When files are being sent from the peer to the user, they trigger a transfer
         #back to the user, the temp ignore list allows you to ignore the files currently being transfered
     
         self._temp_ignore_list = []
 
+        #What we last knew about every file in the folder, see indexbox
+        self._index = FileIndex("files.db",root="..")
+        self._load_file_list()
+
+        #Content hashes of new and changed files, taken by HASH_PROCESSES processes and kept by inode,
+        #size and mtime so no file is hashed twice (see hashbox). Renames across filesystems are found by them.
+        #Files that can't be one of those are sent first and hashed on a thread of their own after (see _hash_later)
+        self.HASH_PROCESSES = hash_processes
+        self._hashes = HashCache("hashes.db",hash_processes)
+        self._unhashed = Queue.Queue()
+        self._hasher = None
+        self._hasher_lock = threading.Lock()
+
     def _accept_connections(self):
 
         while True:
             connection,address = self._server_socket.accept()
             print "\nReceived connection from: ",address
-            connection.send("\nSuccessfully Connected")
 
-            self._handle_file_receive(connection)
+            #A peer opens several connections at once, each one is received on its own thread
+            t = threading.Thread(target = self._handle_file_receive,args = (connection,))
+            t.daemon = True
+            t.start()
 
     def server_thread(self):
 
         #The server thread deals exclusively with receiving files
 
         host = '0.0.0.0'
-        port  = 101
+        port  = self.PORT
 
         server_tuple = (host,port)
         self._server_socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        if os.name != "nt":
+            #Lets a node that was stopped in the middle of a transfer listen again straight away, so it can resume
+            self._server_socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
         self._server_socket.bind(server_tuple)
-        self._server_socket.listen(5)
+        self._server_socket.listen(64)
 
         print "\nWaiting for a connection....."
 
-        self._accept_connections()
-        self._server_socket.close()
+        t = threading.Thread(target = self._relay_thread)
+        t.daemon = True
+        t.start()
 
+        if self.SERVER_MODE == "threads":
+            self._accept_connections()
+        else:
+            self._frame_server = LocalBoxServer(self._server_socket,box=self,timeout=self.PEER_TIMEOUT)
 
-    def _execute_directory_sync_command(self,c,message):
-        #command to sync, usually happens if a file is deleted or the directory changes
-        #we receive a directory list from the peer
-        c.send(message)
+            t = threading.Thread(target = self._background_thread)
+            t.daemon = True
+            t.start()
 
-        directory_data = ''
-        chunk = c.recv(self.BUFFER_SIZE)
+            self._frame_server.serve_forever()
 
-        while chunk:
-            
-            directory_data+=chunk
+        self._server_socket.close()
 
-            if directory_data[-2:] == "/0":
-                break
 
-            chunk = c.recv(self.BUFFER_SIZE)
+    def _in_background(self,conn,work,done=None):
+        #work() for a connection of the select server runs on the background thread and done(result) back
+        #on the server thread, once it is finished. A connection of its own thread just waits for it
 
-        #print "\nDirectory: %s\n"%directory_data
+        if self._frame_server is None:
+            result = work()
+            if done is not None:
+                done(result)
+            return
 
-        directory_list = pickle.loads(directory_data[:-2])
-        directory_list = {os.path.realpath("../%s"%os.path.basename(key)):directory_list[key] for key in directory_list}
-        current_directory = map(lambda x: os.path.realpath("../%s"%x),os.listdir(".."))
+        self._background.put((conn,work,done))
 
-        for file_object in current_directory:
-            
-            if os.path.isfile(file_object):
-                #if file is being ignored or is already in the directory list, do nothing
-                #otherwise remove it because the remote peer doesn't have it
+    def _background_thread(self):
 
-                if file_object in directory_list or file_object in self._ignore_list: 
-                    pass
+        while True:
+            conn,work,done = self._background.get()
+
+            try:
+                result = work()
+            except Exception as e:
+                if conn is None:
+                    print "\nBackground work failed: %s"%e
                 else:
-                    os.remove(file_object)
-                    
+                    #Takes the connection down, as if reading from it had failed
+                    self._frame_server.call_soon(conn,_raise,e)
+                continue
+
+            if done is not None:
+                self._frame_server.call_soon(conn,done,result)
+
+    def _refuse(self,conn,stream,status):
+        #The transfer on stream can't go on this way, the peer sends the file differently
+
+        transfer = conn.session.transfers.pop(stream,None)
+        if transfer is None:
+            return
+
+        transfer.abort()
+        self._received(transfer.path,False)
+        conn.send_frame(FILE_ACK,stream,pack_ack(status))
+
+    def _reconcile_step(self,conn,session,stream,reply=None):
+        #Takes the peer's reply (None to start) and sends the next question about its file name tree
+        #Files the peer doesn't have anymore are removed as the reconciler finds them, in one
+        #transaction per reply
+
+        reconciler = session.reconciles[stream]
+        with self._index.transaction():
+            if reply is None:
+                request = reconciler.start()
             else:
+                request = reconciler.feed(reply)
+
+        if request is not None:
+            conn.send_frame(TREE_REQUEST,stream,request)
+
+        if not reconciler.done:
+            return
+        del session.reconciles[stream]
+
+        address,started,kept = session.reconcile_peers.pop(stream)
+        removed = reconciler.extra_count-len(kept)
+
+        #The peer had every file we had when it began, if we kept none. Files we kept may still be on
+        #their way to it, they are no reason to remove anything next time
+        if not kept:
+            self._reconciled(address,started)
+
+        self._metrics.observe("localbox_tree_exchange_bytes",reconciler.exchanged_bytes)
+        self._metrics.observe("localbox_tree_exchange_round_trips",reconciler.round_trips)
+
+        print "\nSynced Remote Directory (%s round trips, %s removed, %s kept)"%(reconciler.round_trips,removed,len(kept))
+
+        #Deletions we took from the peer are passed on like our own, to the peers that never reconciled
+        #with it after they got those files
+        if removed > 0:
+            t = threading.Thread(target = self._sync_directory)
+            t.daemon = True
+            t.start()
+
+    def _start_reconcile(self,conn,session,stream,payload,started):
+
+        root,port,flags = unpack_tree_root(payload,conn.can("tree-from"))
+
+        #The peer by its ip and the port it listens on, as it is known when we sync with it (see Peer.sync_directory)
+        address = conn.sock.getpeername()[0]
+        if port is not None:
+            address = "%s:%s"%(address,port)
+
+        #Nothing is removed for a peer we never reconciled with, or one that had nothing to go by
+        since = None if flags & TREE_KEEP else self._index.reconciled(address)
+        kept = []
+
+        def remove(name):
+            if not self._remove_extra(name,since):
+                kept.append(name)
+
+        session.reconcile_peers[stream] = (address,started,kept)
+        session.reconciles[stream] = Reconciler(self._index.tree,root,remove,conn.can("tree-stream"))
+        self._reconcile_step(conn,session,stream)
+
+    def _reconciled(self,address,started):
+        #A reconcile with the peer at address that began at started (a time.time()) is done, files put in
+        #place before it began can be removed when the peer doesn't have them
+        self._index.set_reconciled(address,int(started*1000000000))
+
+    def _moved(self,conn,stream,route,moves,failed):
+
+        conn.send_frame(FILE_MOVE_RESULT,stream,pack_index_list(failed))
+
+        print "\nMoved %s of %s files"%(len(moves)-len(failed),len(moves))
+
+        skipped = set(failed)
+        moved = [(self._local_path(old),self._local_path(new),size,digest) for i,(old,new,size,digest) in enumerate(moves) if i not in skipped]
+        if moved and route:
+            self._relay(None,0,0,moved,unpack_route(route),False)
+
+    def _remove_extra(self,name,since):
+        #A file the peer doesn't have, removed if it doesn't have it anymore. since is when the last reconcile
+        #with the peer began (ns), None to remove nothing. Returns False if the file is kept
+
+        file_object = self._local_path(name)
+
+        #if file is being ignored do nothing, otherwise remove it because the remote peer doesn't have it
+        if os.path.basename(file_object) in self._ignore_list:
+            return False
+
+        #Still coming in, waiting to be sent or being passed on: the peer hasn't got it yet
+        if file_object in self._temp_ignore_list or file_object in self._file_queue or file_object in self._relaying:
+            return False
+
+        #A file that came in or changed since the last reconcile may still be on its way to the peer,
+        #through other peers too
+        if since is None or self._changed_since(file_object,since):
+            return False
+
+        if os.path.isfile(file_object):
+            os.remove(file_object)
+            self._remove_empty_folders(os.path.dirname(file_object))
+        self._index.remove(file_object)
+        return True
+
+    def _changed_since(self,path,since):
+        #The file's mtime in the index or the time it was put in place (its ctime) is after since (ns)
+
+        entry = self._index.get(path)
+        if entry is not None and entry.mtime_ns > since:
+            return True
+
+        try:
+            return int(os.stat(path).st_ctime*1000000000) > since
+        except OSError:
+            return False
+
+    def _move_file(self,old_name,new_name,size,digest):
+        #A file the peer renamed or moved, done to our copy of it. Returns False if we don't have the same
+        #file under the old name, the peer sends it then
+
+        old = self._local_path(old_name)
+        new = self._local_path(new_name)
+        if old in self._temp_ignore_list or new in self._temp_ignore_list or os.path.exists(new):
+            return False
+
+        try:
+            st = os.stat(old)
+            if not is_file(st) or st.st_size != size or (digest and self._hashes.file_hash(old,st) != digest):
+                return False
+        except (IOError,OSError):
+            return False
+
+        #Neither name goes back to the peer when the watcher sees the rename
+        self._temp_ignore_list.append(old)
+        self._temp_ignore_list.append(new)
+
+        moved = False
+        try:
+            folder = os.path.dirname(new)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            os.rename(old,new)
+            self._sync_batch.add(new)
+            moved = True
+        except OSError as e:
+            print "\nCouldn't move %s: %s"%(old_name,e)
+        finally:
+            if moved:
+                self._index.remove(old)
+            self._received(new,moved)
+            self._temp_ignore_list.remove(old)
+
+        if moved:
+            self._remove_empty_folders(os.path.dirname(old))
+        return moved
+
+    def _received(self,filename,complete):
+
+        #Add the received file to the index before it stops being ignored, so the watcher doesn't send it back
+        if complete and os.path.exists(filename):
+            self._index.update(filename,os.stat(filename))
+            self._chunk_index.update([filename],self.DEDUP_THRESHOLD)
+
+        self._temp_ignore_list.remove(filename)
+
+    def _finish(self,transfer):
+        #FILE_END of a transfer, returns the status to acknowledge
+
+        try:
+            status = transfer.finish()
+        except (IOError,OSError) as e:
+            print "\nCouldn't finish %s: %s"%(transfer.path,e)
+            transfer.abort()
+            status = STATUS_FAILED
+        if transfer.path is not None:
+            self._received(transfer.path,status == STATUS_OK)
+
+        if status == STATUS_OK:
+            seconds = time.time() - transfer.started
+            self._metrics.count("localbox_receive_files_total")
+            self._metrics.observe("localbox_receive_seconds",seconds)
+            if seconds > 0:
+                self._metrics.observe("localbox_receive_bytes_per_second",transfer.wire_bytes/seconds)
+
+        if status == STATUS_OK and transfer.route:
+            byte_range = transfer.relayed_range()
+            if byte_range is not False:
+                self._relay(transfer.path,transfer.size,transfer.mtime_ns,byte_range,transfer.route,transfer.new)
+
+        return status
+
+    def _end_session(self,session):
+        #The connection is gone, drop whatever it was in the middle of. Its transfers are dropped after the
+        #work still queued for them
+
+        transfers = session.transfers.values()
+        session.transfers.clear()
+        session.reconciles.clear()
+        session.reconcile_peers.clear()
+        self._in_background(None,lambda: self._drop_transfers(transfers))
+
+    def _drop_transfers(self,transfers):
+
+        for transfer in transfers:
+            transfer.abort()
+            if transfer.path is not None:
+                self._received(transfer.path,False)
+
+        self._sync_batch.flush()
 
-                pass
-        
     def _handle_file_receive(self,c):
-        
-        while True:
-                
-            #Add recently received file to the _directory_files dictionary
-            for current_object in self._temp_ignore_list:
 
-                if os.path.exists(current_object):
-                    last_modified_epoch = os.path.getmtime(current_object)
-                    last_modified = time.strftime('%Y/%m/%d %H:%M:%S',time.localtime(last_modified_epoch))
-                    self._directory_files[current_object] = last_modified
-                    
-            #If the temp ignore list has files, update files.lb
-            if len(self._temp_ignore_list) > 0:
-                with open("files.lb","wb") as f:
-                    pickle.dump(self._directory_files,f)
+        conn = Connection(c,self._engine)
 
-            #Empty the list
-            self._temp_ignore_list = []
+        try:
+            conn.handshake()
+        except (IOError,socket.error) as e:
+            print "\nHandshake failed: %s"%e
+            conn.close()
+            return
 
-            print "\nWaiting for file..."
+        print "\nSuccessfully Connected (protocol %s, %s)"%(conn.peer_version,",".join(conn.peer_capabilities))
 
-            #A message is the first thing sent by the peer, could be file details, a sync command or a break
-            message = c.recv(self.BUFFER_SIZE)
+        conn.session = session = Session()
 
-            print "\nMessage: %s"%message
+        try:
+            while True:
+                frame_type,stream,length = conn.read_header()
+                if not self._handle_frame(conn,session,frame_type,stream,length):
+                    break
+        except (IOError,OSError,socket.error) as e:
+            print "\nConnection lost: %s"%e
+        finally:
+            self._end_session(session)
+            conn.close()
 
-            if message == '':
-                c.close()
-                break
+    def _handle_frame(self,conn,session,frame_type,stream,length):
+        #Everything the peer sends comes through here, whichever server mode reads it
+        #Returns False once the peer says goodbye
+
+        with self._metrics.timer("localbox_receive_frame_seconds"):
+            return self._dispatch_frame(conn,session,frame_type,stream,length)
+
+    def _dispatch_frame(self,conn,session,frame_type,stream,length):
+
+        incoming = session.transfers
+        if stream in incoming:
+            incoming[stream].wire_bytes = incoming[stream].wire_bytes + length
+            self._metrics.count("localbox_receive_bytes_total",length)
+
+        if frame_type == BYE:
+            conn.skip(length)
+            return False
+
+        if frame_type == PING:
+            #Only keeps the connection from timing out
+            conn.skip(length)
+            return True
+
+        if frame_type == FILE_BEGIN:
+
+            mode,file_size,file_mtime,name = unpack_begin(conn.read_payload(length))
+
+            if mode == MODE_BULK:
+                #Many small files in one stream, each one is taken care of as it comes in
+                print "\nReceiving %s files in bulk"%file_size
+                incoming[stream] = BulkStream(self,conn,stream,None,file_size,file_mtime)
+                incoming[stream].start()
+                return True
+
+            sparse = bool(mode & MODE_SPARSE)
+            mode = mode & ~MODE_SPARSE
+
+            #avoid sync loops, ignore files you're currently receiving
+            filename = self._local_path(name)
+            self._temp_ignore_list.append(filename)
+
+            print "\nReceiving %s (%s bytes)"%(name,file_size)
+
+            if mode in TRANSFER_MODES:
+                transfer = TRANSFER_MODES[mode](self,conn,stream,filename,file_size,file_mtime)
+                transfer.sparse = sparse
+                status = transfer.start()
+            else:
+                status = STATUS_FAILED
+
+            if status is None:
+                incoming[stream] = transfer
+            else:
+                self._received(filename,False)
+                conn.send_frame(FILE_ACK,stream,pack_ack(status))
+
+        elif frame_type == FILE_DATA:
 
-            elif message[:3] == 'cmd':
-                m = "\nSynced Remote Directory"
-                self._execute_directory_sync_command(c,m)
-                
+            if stream in incoming:
+                incoming[stream].on_data(length)
             else:
+                conn.skip(length)
+
+        elif frame_type == FILE_DATA_COMPRESSED:
+
+            if stream in incoming:
+                incoming[stream].on_compressed(length)
+            else:
+                conn.skip(length)
+
+        elif frame_type == FILE_HOLE:
+
+            if stream in incoming:
+                offset,hole_length = EXTENT.unpack_from(conn.read_payload(length))
+                incoming[stream].on_hole(offset,hole_length)
+            else:
+                conn.skip(length)
+
+        elif frame_type == FILE_END:
+
+            conn.skip(length)
+            transfer = incoming.pop(stream,None)
+
+            if transfer is None:
+                conn.send_frame(FILE_ACK,stream,pack_ack(STATUS_FAILED))
+            else:
+                #Putting the file in place, after whatever work of the transfer is still queued
+                self._in_background(conn,lambda: self._finish(transfer),lambda status: conn.send_frame(FILE_ACK,stream,pack_ack(status)))
+
+        elif frame_type == RESUME_REQUEST:
+
+            #The peer asks what we kept of a file from an interrupted transfer before it sends the rest
+            file_size,file_mtime,name = unpack_resume(conn.read_payload(length))
+            filename = self._local_path(name)
+            conn.send_frame(RESUME_REPLY,stream,pack_extents(held_extents(self,filename,file_size,file_mtime)))
+
+        elif frame_type == FILE_MOVE:
+
+            #Files the peer renamed or moved, our copies are moved too instead of being sent again
+            #Checking a copy is the same file can mean hashing it
+            route,moves = unpack_moves(conn.read_payload(length))
+            self._in_background(conn,lambda: [i for i,move in enumerate(moves) if not self._move_file(*move)],
+                                lambda failed: self._moved(conn,stream,route,moves,failed))
+
+        elif frame_type == FILE_RELAY:
+
+            if stream in incoming:
+                incoming[stream].route = unpack_route(conn.read_payload(length))
+            else:
+                conn.skip(length)
+
+        elif frame_type == TREE_ROOT:
+
+            #command to sync, sent once the peer is done sending its changes
+            #What it sent is made durable first, then the peer's file name tree is compared with ours
+            payload = conn.read_payload(length)
+            started = time.time()
+            self._in_background(conn,self._sync_batch.flush,lambda synced: self._start_reconcile(conn,session,stream,payload,started))
+
+        elif frame_type == TREE_REPLY and stream in session.reconciles:
+            self._reconcile_step(conn,session,stream,conn.read_payload(length))
+
+        elif stream in incoming:
+            status = incoming[stream].on_frame(frame_type,conn.read_payload(length))
+
+            if status is not None:
+                self._refuse(conn,stream,status)
 
-                file_array = message.split(",")
-                filename = file_array[0]
-                file_size = int(file_array[1])
+        else:
+            conn.skip(length)
 
-                #avoid sync loops, ignore files you're currently receiving
-                file_str = "../%s"%filename
-                filename = os.path.realpath(file_str)
-                self._temp_ignore_list.append(filename)
+        return True
 
-                c.send("OK TO SEND")
+    def _transferring(self):
+        #Files are being sent or received
+        return self._flushing or len(self._temp_ignore_list) > 0
 
-                with open(filename,"wb") as f:
+    def _folder_files(self):
+        #{full path: stat} of the files (not folders) in the synced folder and all its subfolders
+        return walk_files(self._index.root,[self._program_folder],self.WALK_THREADS)
 
-                    chunk = c.recv(self.BUFFER_SIZE)
-                    total = len(chunk)
+    def _local_path(self,name):
+        #The full path of a file name the peer sent. It has to be inside the synced folder and outside the localbox folder
 
-                    while chunk:
+        path = os.path.realpath(os.path.join(self._index.root,name))
+        inside = path.startswith(self._index.root + os.sep)
+        if not inside or path == self._program_folder or path.startswith(self._program_folder + os.sep):
+            raise ProtocolError("File name outside the synced folder: %r"%name)
+        return path
 
-                        f.write(chunk)
+    def _replace_file(self,source,destination):
 
-                        if total < file_size:
-                            chunk = c.recv(self.BUFFER_SIZE)
-                            total = total + len(chunk)
-                        else:
-                            break
+        #The peer's file can be in a folder we don't have yet
+        folder = os.path.dirname(destination)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
 
-                #c.send("Successfully uploaded")
-                print "\nSuccessfully downloaded %s!"%filename
-                m = "\n Successfully Uploaded!"
-                self._execute_directory_sync_command(c,m)
+        #os.rename won't replace an existing file on windows
+        if os.name == "nt" and os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source,destination)
+        self._sync_batch.add(destination)
 
+    def _remove_empty_folders(self,folder):
+        #Removes folder and the folders above it once the last file in them is gone, up to the synced folder
 
-             
+        while folder.startswith(self._index.root + os.sep):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                #Not empty
+                return
+            folder = os.path.dirname(folder)
 
 
     def client_thread(self):
 
         #The client thread dealse exclusively with detecting changes and sending files
 
+        #Every line of hosts.txt is a peer, HOST PORT
         with open("hosts.txt","rb") as f:
-            remote_server_string = f.readline()
+            remote_server_array = [line.split() for line in f if line.strip()]
 
-        remote_server_array = remote_server_string.split(" ")
+        for host,port in remote_server_array:
+            peer = self._peer(host,int(port))
+            self._hosts.append(peer.address)
 
-        host = remote_server_array[0]
-        port = remote_server_array[1]
-        
         self._friend_port_saved = True
         self._friend_host_saved = True
 
-        port = int(port)
+        print "\nConnecting to: ",self._hosts
 
-        client_data = (host,port)
+        #This continously checks if the peers successfully connect, each one on its own thread.
+        #If a peer isn't ready it waits 10 seconds and tries to reconnect
+        threads = []
+        for address in self._hosts:
+            t = threading.Thread(target = self._peers[address].connect)
+            t.daemon = True
+            t.start()
+            threads.append(t)
 
-        print "\nConnecting to: ",client_data
-
-        #This continously checks if the client successfully connects. If the remote peer
-        #isn't ready wait 10 seconds and try to reconnect
-        while self._client_connected == False:
-            
-            try:
-                self._client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self._client_socket.connect(client_data)
-                self._client_connected = True
-            except:
-                time.sleep(10)
-                continue
+        for t in threads:
+            while t.is_alive():
+                t.join(1)
 
-        data = self._client_socket.recv(self.BUFFER_SIZE)
-        print data
+        self._client_connected = True
 
         self.sync_files()
 
-        #This finds the full path of the objects in the folder one level up
-        #These will be watched
-        files = map(lambda x: os.path.realpath("../%s"%x),os.listdir(".."))
-        
+        #From here on changes the watcher sees are batched up by the scheduler
+        self._scheduler.start()
+
+        #Every file in the folder one level up and in its subfolders will be watched
+        files = self._folder_files().keys()
+
 
         watcher = LocalBoxWatcher(files=files,box=self)
         watcher.monitor()
         
 
-        
-    def _sync_directory(self,args=None):
-        #This sends the "cmd:..." message to the remote host to sync itself
-        if args is not None:
-            
-            self._client_socket.sendall(args)
-            response = self._client_socket.recv(self.BUFFER_SIZE)
-            print response
+    def _peer(self,host,port):
+        #The Peer for host:port, made the first time it is needed
+
+        with self._peers_lock:
+            address = "%s:%s"%(host,port)
+            if address not in self._peers:
+                self._peers[address] = Peer(self,host,port)
+            return self._peers[address]
+
+    def _route(self,addresses):
+        #The first peer of every relay group that can be reached, with the rest of its group as its route
+        #A peer that is down is skipped, the next one in its group takes its place
+
+        routes = []
+        for group in relay_groups(addresses,self.RELAY_FANOUT):
+            for i,address in enumerate(group):
+                host,port = address.rsplit(":",1)
+                peer = self._peer(host,int(port))
+                if peer.connect(retry=False):
+                    routes.append((peer,group[i+1:]))
+                    break
+        return routes
 
-        
-        directory_table = pickle.dumps(self._directory_files)
-        self._client_socket.sendall(directory_table+"/0")
+    def _relay(self,filename,file_size,file_mtime,byte_range,route,new):
+        #Hands files we received to the relay thread. filename is a list for a bulk stream and None for
+        #moves, byte_range holds them then
+
+        with self._relaying_lock:
+            self._relaying.update(_relayed_paths(filename,byte_range))
+        self._relays.put((filename,file_size,file_mtime,byte_range,route,new))
 
+    def _relay_thread(self):
+        #Passes files (and ranges of striped files) we received on to the peers routed through us
+
+        while True:
+            filename,file_size,file_mtime,byte_range,route,new = self._relays.get()
+            try:
+                self._pass_on(filename,file_size,file_mtime,byte_range,route,new)
+            finally:
+                with self._relaying_lock:
+                    for path in _relayed_paths(filename,byte_range):
+                        self._relaying[path] = self._relaying[path] - 1
+                        if self._relaying[path] <= 0:
+                            del self._relaying[path]
 
-    def _flush_queue(self):
+    def _pass_on(self,filename,file_size,file_mtime,byte_range,route,new):
+
+        for peer,rest in self._route(route):
+            try:
+                if filename is None:
+                    #Files moved here, byte_range holds the moves. The ones the peer can't do are sent
+                    for new in peer.send_moves(byte_range,rest):
+                        peer.send_file(new,rest)
+                    continue
+
+                if isinstance(filename,list):
+                    #The files of a bulk stream, passed on as one too
+                    print "\nRelaying %s files to %s"%(len(filename),peer.address)
+                    peer.send_bulk(filename,rest)
+                    continue
+
+                print "\nRelaying %s to %s"%(os.path.basename(filename),peer.address)
+                if byte_range is None:
+                    peer.send_file(filename,rest,new)
+                else:
+                    offset,length,source = byte_range
+                    peer.send_range(filename,file_size,offset,length,rest,file_mtime,source)
+            except (IOError,OSError,socket.error) as e:
+                print "\nRelay to %s Failed: %s"%(peer.address,e)
+
+    def _sync_directory(self,keep=False):
+        #Lets every peer we can reach catch up on deletions. A peer that was lost is tried again first, it
+        #may be back before its reconnect gets to it. keep: our index was empty when we started, they
+        #remove nothing
+
+        for address in self._hosts:
+            peer = self._peers[address]
+            if peer.connect(retry=False):
+                try:
+                    peer.sync_directory(keep)
+                except (IOError,socket.error) as e:
+                    print "\nCouldn't sync directory with %s: %s"%(address,e)
+
+
+    def _flush_queue(self,keep=False):
 
         #This gets the file queue (which contains files recently changed, added or deleted)
-        #and acts on them
+        #and acts on them. Each file goes to the first peer of every relay group, which passes it on
+        routes = self._route(self._hosts)
+
+        #Renames and moves first, the folder sync at the end would delete the old names. A file matched on
+        #size and mtime alone is moved only if the peer's copy has the same content
+        moves = [(old,new,size,self._hashes.file_hash(new) if check else b"") for old,new,size,check in self._moves if os.path.isfile(new)]
+        self._moves = []
+        for peer,route in routes:
+            for new in peer.send_moves(moves,route):
+                peer.send_file(new,route)
+
+        new_files = self._new_files
+        self._new_files = set()
+
+        #Small and recently changed files are handed to the peers first, the delta and chunk
+        #transfers of big files hold up everything after them (see shapebox)
+        queued = []
         for i in range(0,len(self._file_queue)):
 
-            filename = self._file_queue.pop(0)
+            filename = self._file_queue.popleft()
+            self._metrics.observe("localbox_file_queue_wait_seconds",time.time()-self._queued_at)
+            self._metrics.set("localbox_file_queue_depth",len(self._file_queue))
 
-            if os.stat(filename).st_size != 0:
+            st = os.stat(filename)
+            if st.st_size != 0:
+                queued.append((transfer_priority(st.st_size,mtime_ns(st)),i,filename,st.st_size))
 
-                self._send_file(filename)
-                self._sync_directory()
+        queued.sort()
 
-    def _send_file(self,filename):
+        #Lots of small files go in bulk streams, many files per stream (see bulkbox)
+        small = [(filename,size) for priority,i,filename,size in queued if size < BULK_FILE_SIZE]
+        if len(small) >= BULK_MIN_FILES:
+            for peer,route in routes:
+                for batch in bulk_batches(small):
+                    peer.send_bulk(batch,route)
+            queued = [entry for entry in queued if entry[3] >= BULK_FILE_SIZE]
 
-        if filename == 'q' or filename == 'Q':
-            self._client_socket.send(filename)
-            self._client_socket.close()
-        else:
-            file_size = os.stat(filename).st_size
-            file_stats = "%s,%s"%(os.path.basename(filename),file_size)
+        #Big files are multicast once to every peer that takes it, after everything else is queued
+        cast = []
+        if self._caster is not None and len(self._cast_peers()) >= MIN_CAST_PEERS:
+            cast = [filename for priority,i,filename,size in queued if size >= self.MULTICAST_THRESHOLD]
+            queued = [entry for entry in queued if entry[3] < self.MULTICAST_THRESHOLD]
 
-            print "Filename: ",filename
-            print "File Stats: ",file_stats
+        for priority,i,filename,size in queued:
+            for peer,route in routes:
+                peer.send_file(filename,route,filename in new_files)
 
-            #Gets file stats i.e. name and size and sends them to the remote peer before sending
-            #the file itself
-            self._client_socket.send(file_stats)
-            self._client_socket.recv(self.BUFFER_SIZE)
+        for filename in cast:
+            self._cast_file(filename,filename in new_files)
 
-            while True:
+        #Once everything is sent, let the peers catch up on deletions
+        self._sync_directory(keep)
 
-                #Read file data and send it in chunks.
-                try:
-                    with open(filename,"rb") as f:
-                        
-                        file_data = f.read(self.BUFFER_SIZE)
-
-                        while file_data:
-                            self._client_socket.send(file_data)
-                            file_data = f.read(self.BUFFER_SIZE)
-
-                            if file_data == '':
-                                break
-
-                        response = self._client_socket.recv(self.BUFFER_SIZE)
-                        print response
-                        break
-                except IOError:
-                    #This is triggered if the file is still being copied to the folder and can't be read
-                    #It waits 10 seconds for a reasonable amount of data and tries again
-                    time.sleep(10)
-                    continue
-                except:
-                    break
-    
+    def _cast_peers(self):
+        return [self._peers[address] for address in self._hosts if self._peers[address].connected and self._peers[address].multicast]
+
+    def _cast_file(self,filename,new=False):
+        #Multicasts the file to the peers that take it, the others and the ones it didn't reach get it over TCP
+
+        peers = self._cast_peers()
+        missed = self._caster.send_file(filename,peers) if peers else []
+
+        others = [address for address in self._hosts if self._peers[address] not in peers or self._peers[address] in missed]
+        for peer,route in self._route(others):
+            peer.send_file(filename,route,new)
+
+    def _cast_listener(self,group,port):
+        #Where the datagrams of a multicast group come in, it is joined the first time a peer multicasts to it
+
+        with self._cast_lock:
+            if (group,port) not in self._cast_listeners:
+                self._cast_listeners[(group,port)] = CastListener(group,port,self.MULTICAST_INTERFACE)
+            return self._cast_listeners[(group,port)]
+
+    def _send_file(self,filename):
+
+        if filename == 'q' or filename == 'Q':
+            for peer in self._peers.values():
+                peer.close()
+        else:
+            for peer,route in self._route(self._hosts):
+                peer.send_file(filename,route)
         
     def _load_file_list(self):
 
-        #The files.lb file holds the current directories file list.
-        #This function reads it if it already exists, creates it if it doesn't
-        #and re-creates it if it is corrupt and can't be loaded by pickle module
+        #files.lb held the file list of older versions, a pickled {path: "Y/m/d H:M:S"} dict.
+        #Files whose mtime still matches are carried into the index so they aren't all sent again,
+        #then files.lb is removed
 
-        if os.path.exists("files.lb"):
+        if not os.path.exists("files.lb"):
+            return
 
-            try:
-                with open("files.lb","rb") as f:
-                    self._directory_files = pickle.load(f)
-            except:
-                open("files.lb").close()
+        try:
+            with open("files.lb","rb") as f:
+                directory_files = pickle.load(f)
+        except:
+            directory_files = {}
 
-        else:
-            with open("files.lb","wb") as f:
-                self._directory_files = {}
+        with self._index.transaction():
+            for current_object in directory_files:
+                if os.path.isfile(current_object) and current_object not in self._index:
+                    last_modified_epoch = os.path.getmtime(current_object)
+                    last_modified = time.strftime('%Y/%m/%d %H:%M:%S',time.localtime(last_modified_epoch))
+                    if directory_files[current_object] == last_modified:
+                        self._index.update(current_object,os.stat(current_object))
 
-    def sync_files(self):
+        os.remove("files.lb")
+
+    def sync_files(self,paths=None):
+
+        #paths are the files the scheduler settled on, only those are looked at, in that order
+        #Without paths (at start up) the whole folder is scanned
         
-        #Don't sync anything until the files being received are added
-        while True:
+        #Don't scan anything until the files being received are added
+        #(the scheduler already holds back the paths that are still coming in)
+        while paths is None:
             if len(self._temp_ignore_list) == 0:
                 break
             time.sleep(5)
 
-        self._load_file_list()
-        current_directory = map(lambda x: os.path.realpath("../%s"%x),os.listdir(".."))
+        #Every sync is timed and, if it is turned on, profiled
+        started = time.time()
+        with self._profiler.cycle():
+            self._sync_files(paths)
 
-        for current_object in current_directory:
+        self._metrics.count("localbox_sync_cycles_total")
+        self._metrics.observe("localbox_sync_seconds",time.time()-started)
 
-            if os.path.isfile(current_object):
+    def _sync_files(self,paths):
 
-                if current_object in self._ignore_list:
-                    pass
-                else:
+        started = time.time()
 
-                    #If file is deleted before this block of code is reached an error is thrown
-                    #so check if file exists and get its modified time if it does
-                    if os.path.exists(current_object):
-                        last_modified_epoch = os.path.getmtime(current_object)
-                        last_modified = time.strftime('%Y/%m/%d %H:%M:%S',time.localtime(last_modified_epoch))
-                    else:
-                        #file doesn't exist, was likely deleted
-                        last_modified = ""
-
-                    if current_object in self._directory_files:
-                        #if file hasn't changed since last sync leave it alone
-                        if self._directory_files[current_object] == last_modified:
-                            pass
-                        #file was deleted, do nothing
-                        elif last_modified == "":
-                            pass
-                        
-                        else:
-                            #file changed, update the directory file table and add it to the sync queue
-                            self._directory_files[current_object] = last_modified
-                            self._file_queue.append(current_object)
-                            
-                    else:
-                        #file is new and was just added, add it to directory file table and add it to sync queue
-                        self._directory_files[current_object] = last_modified
-                        self._file_queue.append(current_object)
-
-        print "\nFile Queue: %s"%map(os.path.basename,self._file_queue)
-
-        #Now we reconstruct the self._directory_files and files.lb file
-        #We do this so in case any files are deleted, the reconstructed file will omit them
-
-        self._directory_files = {}
-        current_directory = map(lambda x: os.path.realpath("../%s"%x),os.listdir(".."))
-        
-        for current_object in current_directory:
-            if os.path.isfile(current_object):
-                if current_object in self._ignore_list or current_object in self._temp_ignore_list:
-                    pass
-                else:
-                    last_modified_epoch = os.path.getmtime(current_object)
-                    last_modified = time.strftime('%Y/%m/%d %H:%M:%S',time.localtime(last_modified_epoch))
-                    
-                    self._directory_files[current_object] = last_modified
+        #What was deleted and what is new, to tell renames and moves apart from them
+        removed = {}
+        added = {}
+
+        if paths is None:
+            #One walk of the whole tree, its stats are used as they are instead of stating every file again
+            #and they are compared against the index read in one go
+            found = self._folder_files()
+            known = self._index.snapshot()
+            changed = known.changed
+            current_directory = sorted(found)
+
+            #Files in the index that aren't in the folder anymore were deleted while we weren't running
+            with self._index.transaction():
+                for current_object in known:
+                    if current_object not in found:
+                        removed[current_object] = self._index.get(current_object)[1:]
+                        self._index.remove(current_object)
+
+            #Hashes of files that are gone aren't kept
+            self._hashes.evict(found.values())
+
+            #Nor are their chunks, files that changed are chunked again in the background
+            self._chunk_index.update(found,self.DEDUP_THRESHOLD,complete=True)
+        else:
+            known = self._index
+            found = {}
+            changed = self._index.changed
+            current_directory = paths
+
+        #Only entries of files that were added, changed or deleted are written
+        changed_files = []
+        with self._index.transaction():
+            for current_object in current_directory:
 
+                if current_object in self._ignore_list:
+                    continue
+
+                st = found.get(current_object)
+                if st is None:
+                    try:
+                        st = os.stat(current_object)
+                    except OSError:
+                        st = None
+
+                if not is_file(st):
+                    #file was deleted, leave it out of the index so the peer removes it too
+                    entry = self._index.get(current_object)
+                    if entry is not None:
+                        removed[current_object] = entry[1:]
+                        self._index.remove(current_object)
+
+                elif changed(current_object,st):
+                    #file is new or changed (size, mtime in ns or inode) since the last sync,
+                    #add it to the sync queue, it is recorded once the ones that may be moves are hashed
+                    if current_object not in known:
+                        added[current_object] = st
+                    changed_files.append((current_object,st))
+                    self._file_queue.append(current_object)
+
+        #Only new files as big as a deleted one with a hash can be matched on their content (see movebox),
+        #those are hashed now, on the process pool. The others are hashed once they are sent
+        sizes = set(entry[0] for entry in removed.values() if entry[3] is not None)
+        hashes = self._hashes.hash_files([(path,st) for path,st in added.items() if st.st_size in sizes])
+        with self._index.transaction():
+            for current_object,st in changed_files:
+                self._index.update(current_object,st,hashes.get(current_object))
+
+        if paths is not None:
+            self._chunk_index.update([current_object for current_object,st in changed_files]+list(removed),self.DEDUP_THRESHOLD)
+
+        #New files that are deleted ones under another name aren't sent, the peers move their copies
+        moves = find_moves(removed,added,hashes)
+        moved = set(new for old,new,size,check in moves)
+        if moves:
+            self._file_queue = collections.deque(path for path in self._file_queue if path not in moved)
+            self._moves.extend(moves)
+            self._metrics.count("localbox_sync_moved_files_total",len(moves))
+
+        if paths is not None or len(known) > 0:
+            self._new_files.update(path for path in added if path not in moved)
+
+        self._queued_at = time.time()
+        self._metrics.observe("localbox_sync_scan_seconds",self._queued_at-started)
+        self._metrics.count("localbox_sync_scanned_files_total",len(current_directory))
+        self._metrics.count("localbox_sync_changed_files_total",len(self._file_queue))
+        self._metrics.set("localbox_file_queue_depth",len(self._file_queue))
+
+        if len(self._file_queue) > 100:
+            print "\nFile Queue: %s files"%len(self._file_queue)
+        else:
+            print "\nFile Queue: %s"%map(self._index.name,self._file_queue)
 
-        if len(self._file_queue)==0:
+        if len(self._file_queue)==0 and not self._moves:
             #no files were in the queue to send so files were deleted, so send sync command
-            #so files on the remote computer are removed as well
-            self._sync_directory(args="cmd:sync_directory")
+            #so files on the remote computer are removed as well. A batch of the scheduler's where nothing
+            #changed or went (files we just received) has nothing to sync, the peers may still be sending us
+            #files our tree doesn't have yet and would delete them. Nor does a start up with an empty index,
+            #we don't have the peers' files yet and our tree would delete them all
+            if (paths is None and len(known) > 0) or removed:
+                self._sync_directory()
         else:
-            #send newly as=dded and modified files
-            self._flush_queue()
+            #send newly as=dded and modified files. After a start up with an empty index the peers only
+            #note the reconcile, our tree lacks their files because we never had them
+            self._flushing = True
+            try:
+                self._flush_queue(keep=paths is None and len(known) == 0)
+            finally:
+                self._flushing = False
+
+        self._hash_later([(path,st) for path,st in changed_files if path not in hashes])
+
+    def _hash_later(self,files):
+        #files: [(path,stat)] recorded without their hash, hashed on the hasher's thread
+
+        if not files:
+            return
+
+        with self._hasher_lock:
+            if self._hasher is None:
+                self._hasher = threading.Thread(target = self._hash_thread)
+                self._hasher.daemon = True
+                self._hasher.start()
+
+        self._unhashed.put(files)
 
-        with open("files.lb","wb") as f:
-            pickle.dump(self._directory_files,f)
-                    
-        print""
-        for filename in self._directory_files:
-            print "\nFile: %s Last Modified: %s"%(os.path.basename(filename),self._directory_files[filename])
+    def _hash_thread(self):
+        #Waits for files to stop being sent or received, they read the same disk
+
+        while True:
+            files = self._unhashed.get()
+            while True:
+                try:
+                    files.extend(self._unhashed.get_nowait())
+                except Queue.Empty:
+                    break
+
+            while self._transferring():
+                time.sleep(1)
+
+            hashes = self._hashes.hash_files(files)
+            self._index.set_hashes([(path,st,hashes[path]) for path,st in files if path in hashes])
 
             
     def start_server(self):
@@ -439,6 +1180,13 @@ class LocalBox:
         t.daemon = True
         t.start()
 
+        if self.STATS_PORT is not None:
+            serve_stats(self._metrics,self.STATS_PORT)
+            print "\n Serving stats on http://127.0.0.1:%s/metrics"%self.STATS_PORT
+
+        if self.STATS_FILE is not None:
+            write_stats(self._metrics,self.STATS_FILE,self.STATS_INTERVAL)
+
     def start_client(self):
 
         print "\n Starting Client... "
@@ -453,8 +1201,15 @@ class LocalBox:
             
 
 def main():
-    
-    box = LocalBox()
+
+    #The port to listen on can be given on the command line, e.g. python localbox.py 1101, and after it
+    #the multicast group to send big files to, e.g. python localbox.py 1101 239.192.76.66:45454
+    if len(sys.argv) > 2:
+        box = LocalBox(port=int(sys.argv[1]),multicast=sys.argv[2])
+    elif len(sys.argv) > 1:
+        box = LocalBox(port=int(sys.argv[1]))
+    else:
+        box = LocalBox()
     box.start_server()
     box.start_client()
 
@@ -463,6 +1218,9 @@ def main():
     choice = raw_input(">")
     while True:
         if choice == "q" or choice == "Q":
+            stats = box._compression_stats
+            if stats.raw_bytes:
+                print "\nCompression saved %s of %s bytes sent in %.1f seconds"%(stats.saved(),stats.raw_bytes,stats.seconds)
             break
         time.sleep(5)
         
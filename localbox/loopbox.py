@@ -0,0 +1,236 @@
+'''
+## LOOPBOX 1.0
+## Runs several LocalBox nodes on this machine, each in its own temp folder with its own port and every other
+## node in its hosts.txt, drops a big file and a few small ones into the first node's folder and waits until
+## every node has an exact copy. Relayed transfers show up as "Relaying" lines in the node logs
+## Then it drops a bigger file into the first node and deletes a small file on the last one while the
+## big file is still being relayed to it, and waits until every node, the first one too, has the big file
+## and none has the small one
+## benchbox.py runs its workloads on these nodes too
+## With a multicast group the nodes multicast big files to each other (see castbox)
+## Usage: python loopbox.py [nodes] [size in MB] [first port] [multicast group:port]
+'''
+
+import glob
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from walkbox import walk_files
+
+PROGRAM_DIR = os.path.dirname(os.path.realpath(__file__))
+
+#How long the nodes get to connect to each other, and then to get the files everywhere
+CONNECT_TIMEOUT = 60
+SYNC_TIMEOUT = 300
+
+#The file relayed while a node deletes another is this many times the size of the first one
+RELAYED_SIZE = 4
+
+
+def file_digest(path):
+
+    h = hashlib.md5()
+    with open(path,"rb") as f:
+        while True:
+            data = f.read(1024*1024)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def write_file(path,size):
+    #Written next to the folder first and moved in, so the watcher never sees it half written
+
+    temp = os.path.join(os.path.dirname(os.path.dirname(path)),os.path.basename(path))
+    with open(temp,"wb") as f:
+        remaining = size
+        while remaining > 0:
+            n = min(remaining,1024*1024)
+            f.write(os.urandom(n))
+            remaining = remaining - n
+    os.rename(temp,path)
+
+
+class LoopbackNodes(object):
+
+    def __init__(self,count,first_port,multicast=None):
+
+        self.multicast = multicast
+        self.root = tempfile.mkdtemp(prefix="localbox-loopback-")
+        self.ports = [first_port+i for i in range(count)]
+        self.folders = []
+        self.processes = []
+        self.logs = []
+
+        for i,port in enumerate(self.ports):
+            folder = os.path.join(self.root,"nodes","node%s"%i)
+            program = os.path.join(folder,"localbox")
+            os.makedirs(program)
+
+            for filename in glob.glob(os.path.join(PROGRAM_DIR,"*.py")):
+                shutil.copy(filename,program)
+
+            with open(os.path.join(program,"hosts.txt"),"wb") as f:
+                for other in self.ports:
+                    if other != port:
+                        f.write("127.0.0.1 %s\n"%other)
+
+            self.folders.append(folder)
+
+    def start(self):
+
+        for i,folder in enumerate(self.folders):
+            program = os.path.join(folder,"localbox")
+            log = open(os.path.join(self.root,"node%s.log"%i),"wb")
+
+            #stdin stays open so the node doesn't quit
+            arguments = [sys.executable,"-u","localbox.py",str(self.ports[i])]
+            if self.multicast:
+                arguments.append(self.multicast)
+            process = subprocess.Popen(arguments,cwd=program,
+                                       stdin=subprocess.PIPE,stdout=log,stderr=subprocess.STDOUT)
+            self.processes.append(process)
+            self.logs.append(log)
+
+    def log(self,i):
+        with open(os.path.join(self.root,"node%s.log"%i),"rb") as f:
+            return f.read()
+
+    def wait_connected(self,timeout):
+        #Every node prints its file queue once it is connected to all its peers and has synced
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if all("File Queue" in self.log(i) for i in range(len(self.folders))):
+                return True
+            time.sleep(0.5)
+        return False
+
+    def wait_receiving(self,i,name,timeout):
+        #Until node i has started receiving name, its partial files are kept in its localbox folder
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if glob.glob(os.path.join(self.folders[i],"localbox",name+".*")):
+                return True
+            time.sleep(0.05)
+        return False
+
+    def files(self,i):
+        #{name: size} of every file in node i's folder, subfolders included
+
+        folder = self.folders[i]
+        files = walk_files(folder,[os.path.join(folder,"localbox")])
+        return dict((os.path.relpath(path,folder).replace(os.sep,"/"),st.st_size) for path,st in files.items())
+
+    def wait_synced(self,expected,timeout,interval=0.5):
+        #expected: {name: (size,md5)}. Once every node has exactly those files, returns when the check
+        #that found them started (reading every file can take a while), None if they didn't in time
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            checked = time.time()
+            if all(self._has(i,expected) for i in range(len(self.folders))):
+                return checked
+            time.sleep(interval)
+        return None
+
+    def _has(self,i,expected):
+
+        #Names and sizes first, the files are only read once those match
+        files = self.files(i)
+        if len(files) != len(expected):
+            return False
+        for name,(size,digest) in expected.items():
+            if files.get(name) != size:
+                return False
+
+        for name,(size,digest) in expected.items():
+            if file_digest(os.path.join(self.folders[i],name)) != digest:
+                return False
+        return True
+
+    def stop(self):
+
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+
+        for log in self.logs:
+            log.close()
+
+    def remove(self):
+        shutil.rmtree(self.root,ignore_errors=True)
+
+
+def main():
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    size = int(sys.argv[2])*1024*1024 if len(sys.argv) > 2 else 64*1024*1024
+    first_port = int(sys.argv[3]) if len(sys.argv) > 3 else 21000
+    multicast = sys.argv[4] if len(sys.argv) > 4 else None
+
+    nodes = LoopbackNodes(count,first_port,multicast)
+    print "Running %s nodes in %s"%(count,nodes.root)
+
+    passed = False
+    try:
+        nodes.start()
+
+        if not nodes.wait_connected(CONNECT_TIMEOUT):
+            print "FAILED: the nodes didn't connect to each other"
+            return 1
+
+        expected = {}
+        for name,file_size in [("big.bin",size)] + [("small%s.txt"%i,1000+i) for i in range(10)]:
+            path = os.path.join(nodes.folders[0],name)
+            write_file(path,file_size)
+            expected[name] = (file_size,file_digest(path))
+
+        start = time.time()
+        synced = nodes.wait_synced(expected,SYNC_TIMEOUT)
+        passed = synced is not None
+
+        relays = sum(nodes.log(i).count("Relaying") for i in range(count))
+        casts = nodes.log(0).count("Multicasting")
+
+        if passed:
+            print "PASSED: %s files (%s MB) on all %s nodes in %.1f seconds, %s relayed transfers, %s multicast"%(len(expected),size//(1024*1024),count,synced-start,relays,casts)
+        else:
+            print "FAILED: not every node had the files after %s seconds, logs are in %s"%(SYNC_TIMEOUT,nodes.root)
+            return 1
+
+        #The last node gets big2.bin relayed and pushes its tree for the deletion meanwhile, nobody may
+        #take that tree as a reason to delete big2.bin. It is big enough to still be on its way after the
+        #last node's quiet window
+        path = os.path.join(nodes.folders[0],"big2.bin")
+        write_file(path,size*RELAYED_SIZE)
+        expected["big2.bin"] = (size*RELAYED_SIZE,file_digest(path))
+        nodes.wait_receiving(count-1,"big2.bin",SYNC_TIMEOUT)
+        os.remove(os.path.join(nodes.folders[count-1],"small0.txt"))
+        del expected["small0.txt"]
+
+        start = time.time()
+        synced = nodes.wait_synced(expected,SYNC_TIMEOUT)
+        passed = synced is not None
+
+        if passed:
+            print "PASSED: deleted a file while another was relayed, all %s nodes agree after %.1f seconds"%(count,synced-start)
+        else:
+            print "FAILED: the nodes didn't agree after deleting a file while another was relayed, logs are in %s"%nodes.root
+
+    finally:
+        nodes.stop()
+        if passed:
+            nodes.remove()
+
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
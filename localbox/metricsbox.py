@@ -0,0 +1,310 @@
+'''
+## METRICSBOX 1.0
+## Counters, gauges and histograms of what the sync pipeline is doing: how long scans take, how deep the send
+## queue gets and how long files wait in it, how fast files go out and come in and how long transfers stall,
+## how much the directory exchange carries and what the watcher costs.
+## They are rendered in the Prometheus text format, served on 127.0.0.1:STATS_PORT/metrics and/or written to
+## STATS_FILE every STATS_INTERVAL seconds (for the node exporter's textfile collector)
+## Every sync cycle can also be profiled into PROFILE_DIR, with cProfile (the syncing thread only, a .prof
+## file for pstats) or by sampling the stacks of every thread (a .folded file for flame graph tools)
+'''
+
+import BaseHTTPServer
+import contextlib
+import cProfile
+import os
+import sys
+import threading
+import time
+
+MB = 1024*1024
+
+TIME_BUCKETS = (0.001,0.005,0.01,0.05,0.1,0.5,1,5,10,60,300)
+SIZE_BUCKETS = (1024,16*1024,256*1024,4*MB,64*MB,1024*MB)
+RATE_BUCKETS = (1*MB,10*MB,50*MB,100*MB,250*MB,500*MB,1000*MB)
+COUNT_BUCKETS = (1,2,5,10,100,1000,10000,100000)
+
+#Every metric: name -> (type, help, histogram buckets)
+METRICS = {
+    "localbox_sync_cycles_total": ("counter","Syncs run, full scans and scheduled batches",None),
+    "localbox_sync_seconds": ("histogram","Time of one sync, until the peers have acknowledged everything",TIME_BUCKETS),
+    "localbox_sync_scan_seconds": ("histogram","Time a sync takes to find the files that changed",TIME_BUCKETS),
+    "localbox_sync_scanned_files_total": ("counter","Files looked at by syncs",None),
+    "localbox_sync_changed_files_total": ("counter","Files syncs found added or changed",None),
+    "localbox_sync_moved_files_total": ("counter","Files syncs found renamed or moved, sent as moves",None),
+    "localbox_file_queue_depth": ("gauge","Changed files waiting to be sent",None),
+    "localbox_file_queue_wait_seconds": ("histogram","Time a changed file waited in the queue",TIME_BUCKETS),
+    "localbox_send_bytes_total": ("counter","File bytes sent, before compression",None),
+    "localbox_send_files_total": ("counter","Files, ranges of files and bulk streams sent",None),
+    "localbox_send_seconds": ("histogram","Time to send one file or range",TIME_BUCKETS),
+    "localbox_send_bytes_per_second": ("histogram","Speed of every file or range sent",RATE_BUCKETS),
+    "localbox_send_stall_seconds_total": ("counter","Time sends waited for the peer to acknowledge earlier files or for a file to be readable",None),
+    "localbox_send_throttle_seconds_total": ("counter","Time sends waited for the rate limits",None),
+    "localbox_send_preemptions_total": ("counter","Ranges of bulk transfers that gave way to more urgent files",None),
+    "localbox_multicast_bytes_total": ("counter","File bytes multicast, once for all the peers that got them",None),
+    "localbox_multicast_repair_bytes_total": ("counter","Bytes of multicast files peers missed, sent to them over TCP",None),
+    "localbox_receive_bytes_total": ("counter","File data bytes received, as they came over the wire",None),
+    "localbox_receive_files_total": ("counter","Files, ranges of files and bulk streams received",None),
+    "localbox_receive_seconds": ("histogram","Time from the start of a file or range to its end",TIME_BUCKETS),
+    "localbox_receive_bytes_per_second": ("histogram","Speed of every file or range received",RATE_BUCKETS),
+    "localbox_receive_frame_seconds": ("histogram","Time to handle one received frame, nothing else is read meanwhile",TIME_BUCKETS),
+    "localbox_tree_exchange_bytes": ("histogram","Bytes of one directory exchange, both ways",SIZE_BUCKETS),
+    "localbox_tree_exchange_round_trips": ("histogram","Round trips of one directory exchange",COUNT_BUCKETS),
+    "localbox_watcher_poll_seconds": ("histogram","Time the watcher spends on one pass or one batch of events",TIME_BUCKETS),
+    "localbox_watcher_events_total": ("counter","Files the watcher reported",None),
+}
+
+DEFAULT_STATS_INTERVAL = 10
+
+#How often the sampling profiler takes the stacks of every thread
+SAMPLE_INTERVAL = 0.005
+
+
+class Histogram(object):
+
+    def __init__(self,buckets):
+        self.buckets = buckets
+        self.counts = [0]*len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self,value):
+        for i,bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] = self.counts[i] + 1
+                break
+        self.count = self.count + 1
+        self.sum = self.sum + value
+
+
+class Metrics(object):
+    #Every metric of one LocalBox by name and labels, safe to update from any thread
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self,name,labels):
+        if name not in METRICS:
+            raise KeyError("Unknown metric %s"%name)
+        return name,tuple(sorted(labels.items()))
+
+    def count(self,name,value=1,**labels):
+
+        key = self._key(name,labels)
+        with self._lock:
+            self._values[key] = self._values.get(key,0) + value
+
+    def set(self,name,value,**labels):
+
+        key = self._key(name,labels)
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self,name,value,**labels):
+
+        key = self._key(name,labels)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = Histogram(METRICS[name][2])
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self,name,**labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name,time.time()-started,**labels)
+
+    def get(self,name,**labels):
+        #A counter or gauge as it is now, 0 if it was never touched
+        with self._lock:
+            return self._values.get(self._key(name,labels),0)
+
+    def render(self):
+        #Everything in the Prometheus text exposition format
+
+        with self._lock:
+            values = sorted((key,value if not isinstance(value,Histogram) else _copy(value)) for key,value in self._values.items())
+
+        lines = []
+        described = set()
+
+        for (name,labels),value in values:
+
+            kind,help,buckets = METRICS[name]
+            if name not in described:
+                lines.append("# HELP %s %s"%(name,help))
+                lines.append("# TYPE %s %s"%(name,kind))
+                described.add(name)
+
+            if kind != "histogram":
+                lines.append("%s%s %s"%(name,_labels(labels),_number(value)))
+                continue
+
+            cumulative = 0
+            for bound,count in zip(value.buckets,value.counts):
+                cumulative = cumulative + count
+                lines.append("%s_bucket%s %s"%(name,_labels(labels+(("le",_number(bound)),)),cumulative))
+            lines.append("%s_bucket%s %s"%(name,_labels(labels+(("le","+Inf"),)),value.count))
+            lines.append("%s_sum%s %s"%(name,_labels(labels),_number(value.sum)))
+            lines.append("%s_count%s %s"%(name,_labels(labels),value.count))
+
+        return "\n".join(lines) + "\n"
+
+def _copy(histogram):
+    copy = Histogram(histogram.buckets)
+    copy.counts = list(histogram.counts)
+    copy.count = histogram.count
+    copy.sum = histogram.sum
+    return copy
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}"%",".join('%s="%s"'%(name,str(value).replace("\\","\\\\").replace('"','\\"')) for name,value in labels)
+
+def _number(value):
+    if isinstance(value,float):
+        return repr(value)
+    return str(value)
+
+
+class _StatsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        if self.path.split("?")[0] not in ("/","/metrics"):
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type","text/plain; version=0.0.4")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        #Scrapes would flood the console
+        pass
+
+def serve_stats(metrics,port,host="127.0.0.1"):
+    #Serves the metrics on http://host:port/metrics from a thread of its own
+
+    server = BaseHTTPServer.HTTPServer((host,port),_StatsHandler)
+    server.metrics = metrics
+
+    t = threading.Thread(target = server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+def write_stats(metrics,path,interval=DEFAULT_STATS_INTERVAL):
+    #Rewrites path with the metrics every interval seconds, from a thread of its own
+
+    def writer():
+        while True:
+            temp = path + ".tmp"
+            with open(temp,"wb") as f:
+                f.write(metrics.render())
+            if os.name == "nt" and os.path.exists(path):
+                os.remove(path)
+            os.rename(temp,path)
+            time.sleep(interval)
+
+    t = threading.Thread(target = writer)
+    t.daemon = True
+    t.start()
+
+
+class StackSampler(object):
+    #Takes the stack of every thread every interval seconds, counted by stack as "thread;file:function;..."
+
+    def __init__(self,interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = {}
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target = self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+
+    def _run(self):
+
+        me = threading.current_thread().ident
+        while self._running:
+            names = dict((t.ident,t.name) for t in threading.enumerate())
+
+            for ident,frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s:%s"%(os.path.basename(code.co_filename),code.co_name))
+                    frame = frame.f_back
+
+                key = ";".join([names.get(ident,str(ident))]+stack[::-1])
+                self.stacks[key] = self.stacks.get(key,0) + 1
+
+            time.sleep(self.interval)
+
+    def dump(self,path):
+        with open(path,"wb") as f:
+            for stack,count in sorted(self.stacks.items()):
+                f.write("%s %s\n"%(stack,count))
+
+
+class SyncProfiler(object):
+    #Profiles every sync cycle into its own file in folder. mode is "cprofile", "sample" or None for off
+
+    def __init__(self,mode=None,folder="profiles"):
+
+        if mode not in (None,"cprofile","sample"):
+            raise ValueError("Unknown profiler %s"%mode)
+
+        self.mode = mode
+        self.folder = folder
+        self._cycles = 0
+
+    @contextlib.contextmanager
+    def cycle(self):
+
+        if self.mode is None:
+            yield
+            return
+
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        self._cycles = self._cycles + 1
+        name = os.path.join(self.folder,"sync-%04d-%s"%(self._cycles,time.strftime("%Y%m%d-%H%M%S")))
+
+        if self.mode == "cprofile":
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                profile.dump_stats(name + ".prof")
+                print "\nProfile of this sync saved in %s.prof"%name
+        else:
+            sampler = StackSampler()
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                sampler.dump(name + ".folded")
+                print "\nStack samples of this sync saved in %s.folded"%name
@@ -0,0 +1,91 @@
+'''
+## MOVEBOX 1.0
+## Renamed and moved files. A sync that finds a file gone and a new one with the same size, mtime in ns
+## and inode has seen a rename (or a move within the filesystem), and the peers are only told the old and
+## the new name, they rename their copies with os.rename instead of getting the data again. A folder
+## renamed with thousands of files in it costs one FILE_MOVE frame instead of a full transfer.
+## Files moved across filesystems get a new inode, those are matched on their content hash (see hashbox),
+## or on size and mtime alone if the old file was never hashed, and the peer checks the hash of its copy
+## before it moves it. A move the peer can't do (it doesn't have the file, or not the same file) is
+## answered in FILE_MOVE_RESULT and the file is sent as usual
+'''
+
+import struct
+
+from indexbox import mtime_ns
+
+#size of the file, lengths of the old name, the new name and the content hash
+MOVE_HEADER = struct.Struct(">QIIB")
+ROUTE_HEADER = struct.Struct(">I")
+
+#Moves sent in one FILE_MOVE frame
+MOVES_PER_FRAME = 10000
+
+
+def find_moves(removed,added,hashes={}):
+    #removed: {path: (size,mtime_ns,inode,hash)} of the files gone since the last sync, hash None if it
+    #wasn't taken, added: {path: stat} of the new ones and hashes: {path: hash} of those.
+    #Returns [(old path,new path,size,check)], check is True for the files not matched on the inode, the
+    #peer has to compare their content. Empty files are left alone, they don't cost a transfer
+
+    by_identity = {}
+    by_hash = {}
+    by_mtime = {}
+    for path,(size,mtime,inode,digest) in sorted(removed.items()):
+        if size == 0:
+            continue
+        #Some platforms (windows without a stat call) give every file inode 0
+        if inode:
+            by_identity.setdefault((size,mtime,inode),[]).append(path)
+        if digest is not None:
+            by_hash.setdefault((size,digest),[]).append(path)
+        else:
+            by_mtime.setdefault((size,mtime),[]).append(path)
+
+    moves = []
+    taken = set()
+    for path,st in sorted(added.items()):
+        key = (st.st_size,mtime_ns(st))
+        tiers = ((by_identity.get(key+(st.st_ino,)),False),(by_hash.get((st.st_size,hashes.get(path))),True),(by_mtime.get(key),True))
+        for candidates,check in tiers:
+            old = next((old for old in candidates or () if old not in taken),None)
+            if old is not None:
+                taken.add(old)
+                moves.append((old,path,st.st_size,check))
+                break
+
+    return moves
+
+def pack_moves(route,moves):
+    #route: the packed route the peer passes the moves on to, moves: [(old name,new name,size,hash)],
+    #hash is b"" for the ones matched on the inode
+
+    parts = [ROUTE_HEADER.pack(len(route)),route,ROUTE_HEADER.pack(len(moves))]
+    for old,new,size,digest in moves:
+        parts.append(MOVE_HEADER.pack(size,len(old),len(new),len(digest)))
+        parts.extend((old,new,digest))
+    return b"".join(parts)
+
+def unpack_moves(payload):
+    #(route,moves) as given to pack_moves
+
+    length, = ROUTE_HEADER.unpack_from(payload)
+    position = ROUTE_HEADER.size
+    route = payload[position:position+length]
+    position = position + length
+
+    count, = ROUTE_HEADER.unpack_from(payload,position)
+    position = position + ROUTE_HEADER.size
+
+    moves = []
+    for i in range(count):
+        size,old_length,new_length,hash_length = MOVE_HEADER.unpack_from(payload,position)
+        position = position + MOVE_HEADER.size
+        old = payload[position:position+old_length]
+        position = position + old_length
+        new = payload[position:position+new_length]
+        position = position + new_length
+        moves.append((old,new,size,payload[position:position+hash_length]))
+        position = position + hash_length
+
+    return route,moves
@@ -0,0 +1,851 @@
+'''
+## PEERBOX 1.0
+## The sending side of one peer: its control connection, the pool of data connections and the streams
+## in flight on them. LocalBox keeps one Peer for every line of hosts.txt (plus any peer it relays to)
+## A changed file isn't sent to every peer by the node it changed on. The peers are split into relay groups,
+## the first peer of each group gets the file along with the rest of its group as its route and passes it
+## on the same way, range by range for striped files, so no single uplink carries every copy
+## Queued transfers go out by priority class and at most as fast as the node's and the peer's rate limits
+## allow (see shapebox)
+'''
+
+import collections
+import io
+import os
+import Queue
+import socket
+import threading
+import time
+
+from framebox import Connection, ProtocolError, DATA_FRAME_SIZE, pack_begin, unpack_ack, data_frame, pack_resume, unpack_extents, pack_tree_root, TREE_KEEP
+from framebox import BYE, PING, FILE_BEGIN, FILE_END, FILE_ACK, FILE_RELAY, FILE_HOLE, MODE_SPARSE, EXTENT, DELTA_SIGNATURES, DELTA_OPS, CHUNK_LIST, CHUNK_WANT, CHUNK_PROBE, CHUNK_PROBE_HIT
+from framebox import FILE_MOVE, FILE_MOVE_RESULT, CAST_JOIN, CAST_READY, CAST_DONE, CAST_NACK, MODE_MULTICAST, RESUME_REQUEST, RESUME_REPLY, TREE_ROOT, TREE_REPLY, MODE_WHOLE, MODE_DELTA, MODE_CHUNKS, MODE_RANGE, MODE_BULK, STATUS_OK
+from deltabox import signature_table, delta_ops, pack_op
+from chunkbox import COUNT, pack_chunk_list, unpack_index_list, probe_chunks
+from treebox import serve_reconcile
+from compressbox import Compressor, choose_codec
+from indexbox import mtime_ns
+from receivebox import missing_extents
+from shapebox import TransferQueue, TokenBucket, RateLimit, PRIORITY_SMALL, transfer_priority
+from bulkbox import record_stream
+from sparsebox import has_holes, data_extents, frame_pieces
+from movebox import MOVES_PER_FRAME, pack_moves
+from castbox import pack_join
+
+#Peers a node sends a changed file to itself, every other peer gets it through one of them
+DEFAULT_RELAY_FANOUT = 2
+
+#Every connection to the peer is pinged this often, or three times within box.PEER_TIMEOUT if that is shorter
+PING_INTERVAL = 60
+
+#A lost peer is tried again after RECONNECT_DELAY seconds, twice as long after every try up to MAX_RECONNECT_DELAY
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
+
+#A whole file or one range of it waiting for a data connection. It is read from source, which is filename
+#unless a range is relayed before the file is complete (then it is the partial file it comes in to)
+#A bulk stream has no filename, its source is the (filename,name,size,mtime_ns) of every file in it
+TransferJob = collections.namedtuple("TransferJob",["filename","name","size","mtime_ns","mode","offset","length","route","source"])
+
+
+def relay_groups(addresses,fanout):
+    #Splits the peers into at most fanout groups of about the same size, in order
+    count = len(addresses)
+    groups = [addresses[i*count//fanout:(i+1)*count//fanout] for i in range(fanout)]
+    return [group for group in groups if group]
+
+def pack_route(addresses):
+    return b",".join(addresses)
+
+def unpack_route(payload):
+    return payload.split(b",") if payload else []
+
+
+class Peer(object):
+
+    def __init__(self,box,host,port):
+
+        self.box = box
+        self.host = host
+        self.port = port
+        self.address = "%s:%s"%(host,port)
+        self.connected = False
+
+        #The compression codec both ends have (see compressbox), None to send data as it is
+        self.codec = None
+
+        #The peer takes multicast transfers (see castbox). Cleared once a multicast doesn't reach it,
+        #it gets its files over TCP until it connects again
+        self.multicast = False
+
+        self._connect_lock = threading.Lock()
+        self._conn = None
+        self._data_conns = []
+
+        #Whole files are sent without waiting for the peer, at most box.WINDOW of them unacknowledged
+        self._next_stream = 1
+        self._stream_lock = threading.Lock()
+        self._acknowledged = threading.Condition(self._stream_lock)
+        self._in_flight = {}
+        self._replies = {}
+
+        #Whole files and ranges waiting for a data connection, most urgent first, and the threads sending them
+        self._transfers = TransferQueue()
+        self._workers = []
+
+        #Everything sent to the peer is paced by its own token bucket and the node's, box.PEER_RATE_LIMIT
+        #is bytes a second for every peer or a {"host:port": bytes a second} dict, None for no limit
+        rate = box.PEER_RATE_LIMIT
+        if isinstance(rate,dict):
+            rate = rate.get(self.address)
+        self._rate_limit = RateLimit([box._rate_limit,TokenBucket(rate) if rate else None],box._metrics,self.address)
+
+        #Files whose transfer was cut off with the connection, by filename with their route. They are sent
+        #again once the peer is back, which only sends what it didn't keep of them
+        self._interrupted = {}
+        self._closed = False
+        self._pinging = False
+
+    def connect(self,retry=True):
+        #Returns True once connected. If the peer isn't ready and retry is set, wait 10 seconds and try again
+
+        while True:
+            with self._connect_lock:
+                if self.connected:
+                    return True
+                connected = self._connect()
+
+            if connected:
+                self._send_interrupted()
+                return True
+
+            if not retry:
+                return False
+            time.sleep(10)
+
+    def _send_interrupted(self):
+
+        with self._stream_lock:
+            interrupted = self._interrupted
+            self._interrupted = {}
+
+        for filename,route in interrupted.items():
+            #Files still coming in themselves are passed on once they are in
+            if not os.path.isfile(filename) or filename in self.box._temp_ignore_list:
+                continue
+
+            print "\nSending %s to %s again"%(os.path.basename(filename),self.address)
+            try:
+                self.send_file(filename,route)
+            except (IOError,OSError,socket.error) as e:
+                print "\nTransfer Failed: %s (%s)"%(filename,e)
+
+    def _connect(self):
+
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((self.host,self.port))
+            conn = Connection(sock,self.box._engine,self._rate_limit)
+            conn.handshake()
+        except (IOError,socket.error):
+            return False
+
+        self.codec = choose_codec(conn.peer_capabilities,self.box.COMPRESSION)
+        self.multicast = conn.can("multicast")
+
+        print "\nSuccessfully Connected to %s (protocol %s, %s, compression %s)"%(self.address,conn.peer_version,",".join(conn.peer_capabilities),self.codec or "off")
+
+        old = self._conn
+        self._retire_connections()
+        with self._stream_lock:
+            self._conn = conn
+        if old is not None:
+            #Lost already, or left behind when a data connection was lost
+            old.close()
+        self.connected = True
+
+        t = threading.Thread(target = self._read_replies,args = (conn,))
+        t.daemon = True
+        t.start()
+
+        self._open_data_connections()
+
+        if not self._pinging:
+            self._pinging = True
+            t = threading.Thread(target = self._keepalive)
+            t.daemon = True
+            t.start()
+        return True
+
+    def _keepalive(self):
+        #The peer's server drops connections that stay quiet too long, an idle one would be gone by the time
+        #the next change has to go out
+
+        interval = PING_INTERVAL
+        if self.box.PEER_TIMEOUT:
+            interval = min(interval,self.box.PEER_TIMEOUT/3.0)
+
+        while not self._closed:
+            time.sleep(interval)
+
+            with self._stream_lock:
+                conns = set(self._data_conns+[self._conn]) if self.connected else set()
+
+            for conn in conns:
+                try:
+                    conn.send_frame(PING,0)
+                except (IOError,socket.error):
+                    #Its reply reader finds out too
+                    pass
+
+    def _retire_connections(self):
+        #Closes the data connections of the last time the peer was connected and stops their workers.
+        #Whatever is still queued for them fails first and is sent again once the peer is back, anything
+        #queued from now on waits for the new workers
+
+        transfers = self._transfers
+        self._transfers = TransferQueue()
+
+        with self._stream_lock:
+            conns = self._data_conns
+            self._data_conns = []
+
+        #The control connection is closed once it is replaced
+        for conn in conns:
+            if conn is not self._conn:
+                conn.close()
+
+        transfers.stop(len(self._workers))
+        for t in self._workers:
+            t.join()
+        self._workers = []
+
+    def _open_data_connections(self):
+        #The pool of connections whole files and ranges are sent over, each with a worker sending
+        #whatever is queued next. If the peer won't take more connections the first one is used
+
+        data_conns = []
+
+        for i in range(self.box.CONNECTIONS):
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.connect((self.host,self.port))
+                conn = Connection(sock,self.box._engine,self._rate_limit)
+                conn.handshake()
+            except (IOError,socket.error) as e:
+                print "\nCouldn't open data connection: %s"%e
+                break
+            data_conns.append(conn)
+
+        if not data_conns:
+            data_conns.append(self._conn)
+
+        with self._stream_lock:
+            self._data_conns = data_conns
+
+        for conn in data_conns:
+
+            if conn is not self._conn:
+                t = threading.Thread(target = self._read_replies,args = (conn,))
+                t.daemon = True
+                t.start()
+
+            t = threading.Thread(target = self._transfer_worker,args = (conn,self._transfers))
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+        print "\n%s data connection(s) open"%len(self._data_conns)
+
+    def close(self):
+
+        self._closed = True
+        for conn in set(self._data_conns+[self._conn]):
+            if conn is not None:
+                try:
+                    conn.send_frame(BYE,0)
+                except (IOError,socket.error):
+                    pass
+                conn.close()
+
+    def _open_stream(self,label=None,job=None):
+        #A new stream id. Replies on it are queued for the caller to wait on, unless it carries (part of)
+        #a whole file (label names it, job is its TransferJob), those are only counted against the window
+        #until the peer acknowledges them
+
+        with self._stream_lock:
+            if not self.connected:
+                #Nothing would ever answer on it
+                raise ProtocolError("Connection closed")
+
+            stream = self._next_stream
+            self._next_stream = self._next_stream + 1
+
+            if label is None:
+                self._replies[stream] = Queue.Queue()
+                return stream
+
+            if len(self._in_flight) >= self.box.WINDOW:
+                stalled = time.time()
+                while len(self._in_flight) >= self.box.WINDOW and self.connected:
+                    self._acknowledged.wait()
+                self.box._metrics.count("localbox_send_stall_seconds_total",time.time()-stalled,peer=self.address)
+            if not self.connected:
+                raise ProtocolError("Connection closed")
+
+            self._in_flight[stream] = (label,job)
+            return stream
+
+    def _close_stream(self,stream):
+        with self._stream_lock:
+            self._replies.pop(stream,None)
+
+    def _wait_reply(self,stream):
+
+        frame_type,payload = self._replies[stream].get()
+        if frame_type is None:
+            raise ProtocolError("Connection closed")
+        return frame_type,payload
+
+    def wait_acknowledged(self):
+        #Until every queued file is sent and the peer has acknowledged it
+
+        self._transfers.join()
+
+        with self._stream_lock:
+            while self._in_flight and self.connected:
+                self._acknowledged.wait()
+
+    def _read_replies(self,conn):
+        #Runs in its own thread for every connection and reads everything the peer sends back on it
+
+        try:
+            while True:
+                frame_type,stream,length = conn.read_header()
+                payload = conn.read_payload(length)
+
+                with self._stream_lock:
+                    entry = self._in_flight.pop(stream,None) if frame_type == FILE_ACK else None
+                    queue = self._replies.get(stream)
+                    if entry is not None:
+                        self._acknowledged.notify_all()
+
+                if entry is not None:
+                    label,job = entry
+                    status,message = unpack_ack(payload)
+                    if status == STATUS_OK:
+                        print "\nSuccessfully Uploaded %s to %s!"%(label,self.address)
+                    else:
+                        print "\nTransfer Failed: %s"%label
+                elif queue is not None:
+                    queue.put((frame_type,payload))
+
+        except (IOError,socket.error) as e:
+            print "\nConnection to %s lost: %s"%(self.address,e)
+
+        finally:
+            #Wake up everything still waiting on the peer, unless this is a connection of the last time
+            #it was connected, closed once it connected again
+            with self._stream_lock:
+                current = conn is self._conn or conn in self._data_conns
+                queues = []
+                if current:
+                    self.connected = False
+                    for label,job in self._in_flight.values():
+                        self._interrupt(job)
+                    self._in_flight.clear()
+                    queues = self._replies.values()
+                    self._acknowledged.notify_all()
+
+            for queue in queues:
+                queue.put((None,None))
+
+            if current and conn is self._conn and not self._closed:
+                t = threading.Thread(target = self._reconnect,args = (self._transfers,))
+                t.daemon = True
+                t.start()
+
+    def _reconnect(self,transfers):
+        #Once the transfers that were queued have failed too, keeps trying until the peer is back, whatever
+        #was cut off is sent again then. Another thread may connect it first
+
+        transfers.join()
+
+        delay = RECONNECT_DELAY
+        while not self._closed and not self.connect(retry=False):
+            time.sleep(delay)
+            delay = min(2*delay,MAX_RECONNECT_DELAY)
+
+    def sync_directory(self,keep=False):
+        #Once the peer has acknowledged everything in flight this sends the root of our file name tree
+        #so it can sync itself, then answers its questions about the parts of the tree that differ.
+        #keep: our index was empty when we started, the peer removes nothing (see framebox.TREE_KEEP)
+
+        self.wait_acknowledged()
+
+        stream = self._open_stream()
+        started = time.time()
+
+        def send(payload):
+            self._conn.send_frame(TREE_REPLY,stream,payload)
+
+        def recv():
+            return self._wait_reply(stream)[1]
+
+        try:
+            port = self.box.PORT if self._conn.can("tree-from") else None
+            self._conn.send_frame(TREE_ROOT,stream,pack_tree_root(self.box._index.tree.root(),port,TREE_KEEP if keep else 0))
+            serve_reconcile(send,recv,self.box._index.tree)
+        finally:
+            self._close_stream(stream)
+
+        #Under its ip and the port it listens on, the address it has when it syncs with us
+        self.box._reconciled("%s:%s"%self._conn.sock.getpeername()[:2],started)
+
+    def send_file(self,filename,route=(),new=False):
+        #route: the peers this one passes the file on to. new: there was no older version of the file here
+        #when it was found, so the peer has none to patch either
+
+        box = self.box
+        st = os.stat(filename)
+        file_size = st.st_size
+        file_mtime = mtime_ns(st)
+        name = box._index.name(filename)
+
+        print "Filename: ",filename
+        print "File Size: ",file_size
+
+        #A big file the peer got part of before a transfer was cut off only needs the rest sent
+        if file_size >= box.RESUME_THRESHOLD and self._conn.can("resume") and self._send_rest(filename,name,file_size,file_mtime,route):
+            return
+
+        #Both of these read all of the file, holes too, a sparse file only has its data sent instead
+        sparse = self._conn.can("sparse") and has_holes(st)
+
+        #Big files the peer already has an older copy of only need the changed parts sent
+        if file_size >= box.DELTA_THRESHOLD and not new and not sparse and self._conn.can("delta") and self._send_delta(filename,name,file_size,file_mtime,route):
+            return
+
+        #Other big files may share most of their chunks with files the peer already has
+        if file_size >= box.DEDUP_THRESHOLD and not sparse and self._conn.can("chunks") and self._send_chunks(filename,name,file_size,file_mtime,route,new):
+            return
+
+        #Big files go as ranges even over one connection, a range can give way to more urgent files
+        if file_size >= 2*box.STRIPE_SIZE and self._conn.can("ranges"):
+            for offset in range(0,file_size,box.STRIPE_SIZE):
+                self.send_range(filename,file_size,offset,min(box.STRIPE_SIZE,file_size-offset),route,file_mtime)
+        else:
+            job = TransferJob(filename,name,file_size,file_mtime,MODE_WHOLE,0,file_size,route,filename)
+            self._transfers.put_job(job,transfer_priority(file_size,file_mtime))
+
+    def send_range(self,filename,file_size,offset,length,route=(),file_mtime=None,source=None):
+        #file_mtime is the mtime the peer knows this version of the file by
+
+        if file_mtime is None:
+            file_mtime = mtime_ns(os.stat(filename))
+
+        job = TransferJob(filename,self.box._index.name(filename),file_size,file_mtime,MODE_RANGE,offset,length,route,source or filename)
+        self._transfers.put_job(job,transfer_priority(file_size,file_mtime))
+
+    def send_bulk(self,filenames,route=()):
+        #Small files as one stream of records (see bulkbox), one by one if the peer can't take that
+
+        if not self._conn.can("bulk"):
+            for filename in filenames:
+                self.send_file(filename,route)
+            return
+
+        entries = []
+        for filename in filenames:
+            st = os.stat(filename)
+            entries.append((filename,self.box._index.name(filename),st.st_size,mtime_ns(st)))
+
+        total = sum(entry[2] for entry in entries)
+        print "Bulk: %s files, %s bytes"%(len(entries),total)
+
+        job = TransferJob(None,"%s files"%len(entries),len(entries),0,MODE_BULK,0,total,route,tuple(entries))
+        self._transfers.put_job(job,PRIORITY_SMALL)
+
+    def send_moves(self,moves,route=()):
+        #moves: [(old path,new path,size,hash)] of files renamed or moved (see movebox). Returns the new paths
+        #of the ones the peer couldn't do, those have to be sent
+
+        if not moves:
+            return []
+        if not self._conn.can("moves"):
+            return [new for old,new,size,digest in moves]
+
+        name = self.box._index.name
+        failed = []
+
+        for start in range(0,len(moves),MOVES_PER_FRAME):
+            batch = moves[start:start+MOVES_PER_FRAME]
+            try:
+                stream = self._open_stream()
+                try:
+                    self._conn.send_frame(FILE_MOVE,stream,pack_moves(pack_route(route),[(name(old),name(new),size,digest) for old,new,size,digest in batch]))
+                    frame_type,payload = self._wait_reply(stream)
+                finally:
+                    self._close_stream(stream)
+            except (IOError,socket.error) as e:
+                print "\nCouldn't move files on %s: %s"%(self.address,e)
+                frame_type = None
+
+            if frame_type == FILE_MOVE_RESULT:
+                count, = COUNT.unpack_from(payload)
+                missed = unpack_index_list(payload[COUNT.size:],count)
+            else:
+                missed = range(len(batch))
+            failed.extend(batch[i][1] for i in missed)
+
+        print "Moved %s of %s files on %s"%(len(moves)-len(failed),len(moves),self.address)
+        return failed
+
+    def cast_begin(self,session,group,port,name,file_size,file_mtime):
+        #Asks the peer to join the multicast of a file (see castbox). Returns the stream to finish it on,
+        #None if the peer can't take it
+
+        stream = self._open_stream()
+        try:
+            self._conn.send_frames([(FILE_BEGIN,stream,pack_begin(MODE_MULTICAST,file_size,file_mtime,name)),(CAST_JOIN,stream,pack_join(session,group,port))])
+            frame_type,payload = self._wait_reply(stream)
+        except:
+            self._close_stream(stream)
+            raise
+
+        if frame_type != CAST_READY:
+            self._close_stream(stream)
+            return None
+        return stream
+
+    def cast_finish(self,stream,filename):
+        #Once the multicast is out, sends the pieces the peer missed over the control connection.
+        #Returns True if the peer has the file
+
+        try:
+            self._conn.send_frame(CAST_DONE,stream)
+            frame_type,payload = self._wait_reply(stream)
+
+            if frame_type != CAST_NACK:
+                #None of it got there
+                self.multicast = False
+                return False
+
+            repaired = 0
+            with io.open(filename,"rb") as f:
+                for offset,length in unpack_extents(payload):
+                    f.seek(offset)
+                    for start in range(offset,offset+length,DATA_FRAME_SIZE):
+                        data = f.read(min(DATA_FRAME_SIZE,offset+length-start))
+                        self._conn.send_frame(*data_frame(stream,start,data))
+                        repaired = repaired + len(data)
+
+            self._conn.send_frame(FILE_END,stream)
+            frame_type,payload = self._wait_reply(stream)
+        finally:
+            self._close_stream(stream)
+
+        self.box._metrics.count("localbox_multicast_repair_bytes_total",repaired,peer=self.address)
+        if frame_type != FILE_ACK or unpack_ack(payload)[0] != STATUS_OK:
+            return False
+
+        print "\nSuccessfully Multicast %s to %s! (%s bytes repaired)"%(os.path.basename(filename),self.address,repaired)
+        self.box._metrics.count("localbox_send_files_total",peer=self.address)
+        return True
+
+    def _send_rest(self,filename,name,file_size,file_mtime,route):
+        #Returns False if the peer has nothing of this version of the file
+
+        stream = self._open_stream()
+        try:
+            self._conn.send_frame(RESUME_REQUEST,stream,pack_resume(file_size,file_mtime,name))
+            frame_type,payload = self._wait_reply(stream)
+        finally:
+            self._close_stream(stream)
+
+        if frame_type != RESUME_REPLY:
+            return False
+
+        held = unpack_extents(payload)
+        if not held:
+            return False
+
+        missing = missing_extents(held,file_size)
+        if not missing:
+            #Every piece made it but the file was never put in place, the last range finishes it
+            missing = [(max(0,file_size-self.box.STRIPE_SIZE),min(file_size,self.box.STRIPE_SIZE))]
+
+        print "Resuming: %s of %s bytes are left to send"%(sum(length for offset,length in missing),file_size)
+
+        for offset,length in missing:
+            for start in range(offset,offset+length,self.box.STRIPE_SIZE):
+                self.send_range(filename,file_size,start,min(self.box.STRIPE_SIZE,offset+length-start),route,file_mtime)
+        return True
+
+    def _transfer_worker(self,conn,transfers):
+        #Runs in its own thread for every data connection
+
+        while True:
+            priority,order,job = transfers.get_job()
+            if job is None:
+                #The connection was retired
+                transfers.task_done()
+                return
+            try:
+                if job.mode == MODE_BULK:
+                    self._send_bulk(conn,job)
+                else:
+                    self._send_whole(conn,job,priority,order,transfers)
+            except (IOError,socket.error) as e:
+                print "\nTransfer Failed: %s (%s)"%(job.name,e)
+                with self._stream_lock:
+                    self._interrupt(job)
+            finally:
+                transfers.task_done()
+
+    def _interrupt(self,job):
+        #The caller holds the stream lock
+
+        if job.mode == MODE_BULK:
+            for filename,name,size,mtime in job.source:
+                self._interrupted[filename] = job.route
+        else:
+            self._interrupted[job.filename] = job.route
+
+    def _compressor(self):
+        #A fresh Compressor for one transfer, None if the data goes out as it is
+        if self.codec is None:
+            return None
+        return Compressor(self.codec)
+
+    def _report_compression(self,name,compressor):
+
+        if compressor is None:
+            return
+
+        stats = self.box._compression_stats
+        stats.add(compressor)
+
+        if compressor.saved() > 0:
+            print "Compressed: sent %s of %s bytes of %s in %.3f seconds (%s bytes saved in %.1f seconds so far)"%(
+                compressor.sent_bytes,compressor.raw_bytes,name,compressor.seconds,stats.saved(),stats.seconds)
+
+    def _begin_frames(self,stream,mode,file_size,file_mtime,name,route):
+
+        frames = [(FILE_BEGIN,stream,pack_begin(mode,file_size,file_mtime,name))]
+        if route:
+            frames.append((FILE_RELAY,stream,pack_route(route)))
+        return frames
+
+    def _send_whole(self,conn,job,priority,order,transfers):
+        #A whole file or one range of it, goes out without waiting for the peer, its acknowledgement
+        #is picked up by the reply reader. A range stops early when a more urgent job is waiting in
+        #transfers, the rest of it is queued again with its priority and order
+
+        filename,name,file_size,file_mtime,mode,offset,length,route,source = job
+
+        while True:
+            try:
+                f = io.open(source,"rb")
+                break
+            except IOError:
+                if source != filename:
+                    #The partial file was completed and renamed in the meantime
+                    source = filename
+                    continue
+                if not os.path.isfile(filename):
+                    return
+                #This is triggered if the file is still being copied to the folder and can't be read
+                #It waits 10 seconds for a reasonable amount of data and tries again
+                time.sleep(10)
+                self.box._metrics.count("localbox_send_stall_seconds_total",10,peer=self.address)
+
+        if mode == MODE_RANGE:
+            stream = self._open_stream("%s (bytes %s-%s)"%(name,offset,offset+length),job)
+        else:
+            stream = self._open_stream(name,job)
+
+        compressor = self._compressor()
+        started = time.time()
+        holes = 0
+
+        with f:
+            #Only the data of a file with holes is read and sent (see sparsebox)
+            sparse = length > DATA_FRAME_SIZE//16 and self._conn.can("sparse") and has_holes(os.fstat(f.fileno()))
+            if sparse:
+                extents = data_extents(source,offset,length)
+                begin = self._begin_frames(stream,mode | MODE_SPARSE,file_size,file_mtime,name,route)
+            else:
+                extents = [(offset,length,True)]
+                begin = self._begin_frames(stream,mode,file_size,file_mtime,name,route)
+
+            if length <= DATA_FRAME_SIZE//16:
+                #Small files go out in one write
+                data = f.read(length)
+                data = data + b"\0"*(length-len(data))
+                conn.send_frames(begin+[data_frame(stream,offset,data,compressor),(FILE_END,stream,b"")])
+            else:
+                #The file data goes through the transfer engine (zero-copy where the platform allows it),
+                #or through the compressor frame by frame
+                conn.send_frames(begin)
+                sent = 0
+                for piece_offset,n,is_data in frame_pieces(extents,DATA_FRAME_SIZE):
+                    if is_data:
+                        conn.send_file_data(stream,f,piece_offset,n,compressor)
+                    else:
+                        conn.send_frame(FILE_HOLE,stream,EXTENT.pack(piece_offset,n))
+                        holes = holes + n
+                    sent = sent + n
+
+                    #The peer keeps a range that ends early and waits for the rest, a whole file has to
+                    #be sent in one go
+                    if sent < length and mode == MODE_RANGE and transfers.more_urgent(priority):
+                        rest = job._replace(offset=offset+sent,length=length-sent,source=source)
+                        transfers.put_job(rest,priority,order)
+                        self.box._metrics.count("localbox_send_preemptions_total",peer=self.address)
+                        length = sent
+                        break
+
+                conn.send_frame(FILE_END,stream)
+
+        self._report_sent(length-holes,time.time()-started)
+        self._report_compression(name,compressor)
+
+    def _send_bulk(self,conn,job):
+        #The records go out in full frames, the peer acknowledges the stream once
+
+        stream = self._open_stream(job.name,job)
+        compressor = self._compressor()
+        started = time.time()
+
+        conn.send_frames(self._begin_frames(stream,MODE_BULK,job.size,0,b"",job.route))
+
+        offset = 0
+        for data in record_stream(job.source,DATA_FRAME_SIZE):
+            conn.send_frame(*data_frame(stream,offset,data,compressor))
+            offset = offset + len(data)
+
+        conn.send_frame(FILE_END,stream)
+
+        self._report_sent(offset,time.time()-started)
+        self._report_compression(job.name,compressor)
+
+    def _report_sent(self,length,seconds):
+
+        metrics = self.box._metrics
+        metrics.count("localbox_send_bytes_total",length,peer=self.address)
+        metrics.count("localbox_send_files_total",peer=self.address)
+        metrics.observe("localbox_send_seconds",seconds,peer=self.address)
+        if seconds > 0:
+            metrics.observe("localbox_send_bytes_per_second",length/seconds,peer=self.address)
+
+    def _send_delta(self,filename,name,file_size,file_mtime,route):
+        #Returns False if the peer has no copy to patch (or patching failed) and wants the whole file
+
+        stream = self._open_stream()
+        started = time.time()
+
+        try:
+            self._conn.send_frames(self._begin_frames(stream,MODE_DELTA,file_size,file_mtime,name,route))
+
+            frame_type,payload = self._wait_reply(stream)
+            if frame_type != DELTA_SIGNATURES:
+                return False
+
+            def payloads():
+                #The signatures of a big file come in several frames
+                yield payload
+                while True:
+                    frame_type,more = self._wait_reply(stream)
+                    yield more if frame_type == DELTA_SIGNATURES else None
+
+            table = signature_table(payloads())
+            if table is None:
+                return False
+
+            #Ops are gathered into frames of about DATA_FRAME_SIZE
+            literal_bytes = 0
+            ops = []
+            pending = 0
+
+            with io.open(filename,"rb") as f:
+                for op in delta_ops(f,table):
+                    if op[0] == "data":
+                        literal_bytes = literal_bytes + len(op[1])
+
+                    ops.append(pack_op(op))
+                    pending = pending + len(ops[-1])
+
+                    if pending >= DATA_FRAME_SIZE:
+                        self._conn.send_frame(DELTA_OPS,stream,b"".join(ops))
+                        ops = []
+                        pending = 0
+
+            if ops:
+                self._conn.send_frame(DELTA_OPS,stream,b"".join(ops))
+            self._conn.send_frame(FILE_END,stream)
+
+            status,message = unpack_ack(self._wait_reply(stream)[1])
+            if status != STATUS_OK:
+                print "\nTransfer Failed: %s"%name
+                return False
+
+            print "Delta: sent %s of %s bytes"%(literal_bytes,file_size)
+            self._report_sent(literal_bytes,time.time()-started)
+            return True
+
+        finally:
+            self._close_stream(stream)
+
+    def _send_chunks(self,filename,name,file_size,file_mtime,route,new=False):
+        #Returns False if the peer couldn't put the file together and wants the whole file.
+        #A new file is most likely new to the peer too, only its first chunks are offered until the
+        #peer says it has some of them, so the whole file isn't chunked for nothing
+
+        chunk_index = self.box._chunk_index
+        stream = self._open_stream()
+        started = time.time()
+
+        try:
+            begin = self._begin_frames(stream,MODE_CHUNKS,file_size,file_mtime,name,route)
+
+            if new and self._conn.can("chunk-probe"):
+                self._conn.send_frames(begin+[(CHUNK_PROBE,stream,pack_chunk_list(probe_chunks(filename)))])
+                if self._wait_reply(stream)[0] != CHUNK_PROBE_HIT:
+                    return False
+                begin = []
+
+            chunk_list = chunk_index.chunks_for(filename)
+            chunk_index.save()
+            self._conn.send_frames(begin+[(CHUNK_LIST,stream,pack_chunk_list(chunk_list))])
+
+            frame_type,payload = self._wait_reply(stream)
+            if frame_type != CHUNK_WANT:
+                return False
+
+            count, = COUNT.unpack_from(payload)
+            missing = unpack_index_list(payload[COUNT.size:],count)
+
+            #One frame per missing chunk, the peer checks each one against its hash
+            sent = 0
+            compressor = self._compressor()
+            with io.open(filename,"rb") as f:
+                for index in missing:
+                    offset,length,digest = chunk_list[index]
+                    self._conn.send_file_data(stream,f,offset,length,compressor)
+                    sent = sent + length
+
+            self._conn.send_frame(FILE_END,stream)
+
+            status,message = unpack_ack(self._wait_reply(stream)[1])
+            if status != STATUS_OK:
+                print "\nTransfer Failed: %s"%name
+                return False
+
+            print "Dedup: sent %s of %s bytes"%(sent,file_size)
+            self._report_sent(sent,time.time()-started)
+            self._report_compression(name,compressor)
+            return True
+
+        finally:
+            self._close_stream(stream)
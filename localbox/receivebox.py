@@ -0,0 +1,787 @@
+'''
+## RECEIVEBOX 1.0
+## The receiving end of a file transfer. Every FILE_BEGIN the peer sends starts one of these on its
+## stream, the server thread then hands it the frames of that stream as they arrive (they can be
+## interleaved with other streams) until FILE_END, when it reports the status that gets acknowledged.
+## Whole files and ranges are written into a partial file that is only renamed over the real one once
+## every byte is in (see writebox for how it is written and when it is made durable). What a transfer
+## has written is recorded in the index every CHECKPOINT_SIZE bytes (and when it is cut off), so the
+## sender can ask what is left of that version of the file and only send the rest
+'''
+
+import hashlib
+import io
+import os
+import socket
+import threading
+import time
+
+from framebox import ProtocolError, DELTA_SIGNATURES, DELTA_OPS, CHUNK_LIST, CHUNK_WANT, CHUNK_PROBE, CHUNK_PROBE_HIT
+from framebox import MODE_WHOLE, MODE_DELTA, MODE_CHUNKS, MODE_RANGE, STATUS_OK, STATUS_FAILED, STATUS_SEND_WHOLE, DATA_PAYLOAD
+from framebox import COMPRESSED_PAYLOAD, DATA_FRAME_SIZE, MODE_MULTICAST, CAST_JOIN, CAST_READY, CAST_DONE, CAST_NACK, pack_extents
+from compressbox import decompress
+from writebox import OutputFile, sync_file
+from deltabox import DeltaPatcher, block_size_for, signatures, signature_frames, unpack_ops
+from chunkbox import COUNT, unpack_chunk_list, pack_index_list, chunk_hash
+from bulkbox import RecordReader
+from castbox import CAST_BLOCK_SIZE, FEC_GROUP, KIND_DATA, QUIET_TIME, DRAIN_TIME, block_count, missing_blocks, xor_blocks, unpack_join
+
+#Files at least this big are resumed if a transfer of them was interrupted
+DEFAULT_RESUME_THRESHOLD = 16*1024*1024
+
+#How often a transfer's progress is made durable and recorded
+CHECKPOINT_SIZE = 8*1024*1024
+
+
+class Session(object):
+    #What one peer connection has going on: files being received and directory reconciles, by stream id
+
+    def __init__(self):
+
+        self.transfers = {}
+        self.reconciles = {}
+
+        #(the peer's address,when the reconcile began,names it didn't remove) of every reconcile
+        self.reconcile_peers = {}
+
+
+class IncomingFile(object):
+
+    def __init__(self,box,conn,stream,path,size,mtime_ns):
+
+        self.box = box
+        self.conn = conn
+        self.stream = stream
+        self.path = path
+        self.size = size
+        #The sender's mtime of the file, with the size it tells the versions of a file apart
+        self.mtime_ns = mtime_ns
+
+        #Peers to pass the file on to once it is in (FILE_RELAY), and whether we had no older copy of it
+        #for them to be sent a delta against either
+        self.route = []
+        self.new = False
+
+        #The file has holes, they come as FILE_HOLE frames instead of data (see sparsebox)
+        self.sparse = False
+
+        #For the metrics: when FILE_BEGIN came and how many bytes of data frames came since
+        self.started = time.time()
+        self.wire_bytes = 0
+
+    def relayed_range(self):
+        #(offset,length,file to read it from) of the part of the file to pass on, None for all of it
+        #or False for nothing
+        return None
+
+    def start(self):
+        #Called right after FILE_BEGIN, returns a status to acknowledge straight away or None to go on
+        return None
+
+    def on_data(self,length):
+        #A FILE_DATA frame, length counts the offset in front of the data too
+        self.conn.skip(length)
+
+    def on_compressed(self,length):
+        #A FILE_DATA_COMPRESSED frame, its data is written like FILE_DATA once it is decompressed
+
+        offset,codec_id,size = COMPRESSED_PAYLOAD.unpack(self.conn.read_payload(COMPRESSED_PAYLOAD.size))
+        packed = self.conn.read_payload(length-COMPRESSED_PAYLOAD.size)
+
+        if size > DATA_FRAME_SIZE:
+            raise ProtocolError("Compressed frame of %s bytes is too big"%size)
+
+        try:
+            data = decompress(codec_id,packed,size)
+        except ValueError as e:
+            raise ProtocolError("Bad compressed frame on stream %s: %s"%(self.stream,e))
+
+        self.write_data(offset,data)
+
+    def write_data(self,offset,data):
+        #The data of a FILE_DATA_COMPRESSED frame
+        raise ProtocolError("Unexpected data on stream %s"%self.stream)
+
+    def on_hole(self,offset,length):
+        #A FILE_HOLE frame, length bytes of zeros from offset
+        raise ProtocolError("Unexpected hole on stream %s"%self.stream)
+
+    def on_frame(self,frame_type,payload):
+        #Any other frame of the stream, returns a status to end the transfer early or None to go on
+        raise ProtocolError("Unexpected frame %s on stream %s"%(frame_type,self.stream))
+
+    def finish(self):
+        #FILE_END, returns the status to acknowledge
+        return STATUS_OK
+
+    def abort(self):
+        #The connection went away before FILE_END
+        pass
+
+    def _temp_name(self,suffix):
+        #Built in the localbox folder so the watcher never sees a half built file
+        return temp_name(self.path,suffix)
+
+    def _remove(self,path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def temp_name(path,suffix):
+    #A file in the localbox folder for path. Files of the same name in different folders
+    #are told apart by a hash of their full path
+    return os.path.realpath("%s.%s.%s"%(os.path.basename(path),hashlib.sha1(path).hexdigest()[:8],suffix))
+
+def partial_name(path):
+    #Kept in the localbox folder so the watcher never sees a half received file
+    return temp_name(path,"lbpart")
+
+def merge_extents(extents):
+    #Sorted (offset,length) pieces with the ones that touch or overlap joined up
+
+    merged = []
+    for offset,length in sorted(extents):
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            last_offset,last_length = merged[-1]
+            merged[-1] = (last_offset,max(last_length,offset+length-last_offset))
+        elif length > 0:
+            merged.append((offset,length))
+    return merged
+
+def missing_extents(extents,size):
+    #The pieces of a file of size bytes that extents don't cover
+
+    missing = []
+    position = 0
+    for offset,length in merge_extents(extents):
+        if offset > position:
+            missing.append((position,offset-position))
+        position = max(position,offset+length)
+
+    if position < size:
+        missing.append((position,size-position))
+    return missing
+
+def held_extents(box,path,size,mtime_ns):
+    #The pieces of this version of the file kept from an interrupted transfer, if its partial file is still there
+
+    temp = partial_name(path)
+    if not os.path.isfile(temp) or os.path.getsize(temp) != size:
+        return []
+    return merge_extents(box._index.partial_extents(path,size,mtime_ns))
+
+
+class PartialFile(object):
+    #The file a file is received into, shared by every transfer of it (each range of a striped file)
+    #extents are the (offset,length) pieces that are in
+
+    def __init__(self,box,path,size,mtime_ns,sparse=False):
+
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.temp = partial_name(path)
+
+        self.extents = held_extents(box,path,size,mtime_ns)
+
+        #Picked up where an interrupted transfer left off, the pieces it got were never all passed on
+        self.resumed = bool(self.extents)
+
+        if not self.resumed:
+            box._index.remove_partial(path)
+
+        #Preallocated to the full size unless it has holes, the transfers writing into it share one
+        #descriptor while any is open
+        self._output = OutputFile(self.temp,size,truncate=not self.resumed,sparse=sparse)
+        self._users = 0
+
+    def open(self):
+        #The caller holds the partial lock
+
+        if self._output is None:
+            self._output = OutputFile(self.temp)
+        self._users = self._users + 1
+        return self._output
+
+    def release(self):
+        #The caller holds the partial lock
+
+        self._users = self._users - 1
+        if self._users == 0:
+            self._output.close()
+            self._output = None
+
+    def complete(self):
+        extents = merge_extents(self.extents)
+        return self.size == 0 or (len(extents) == 1 and extents[0][0] == 0 and extents[0][1] >= self.size)
+
+
+class RangeFile(IncomingFile):
+    #One byte range of a file, written into the file's partial file at its offsets while the file's other
+    #ranges (on other connections) are written next to it. Striped files and resumed ones come in like this
+
+    def start(self):
+
+        box = self.box
+        with box._partial_lock:
+            partial = box._partials.get(self.path)
+
+            if partial is None:
+                #The file stays ignored until every range is in, not just this one
+                box._temp_ignore_list.append(self.path)
+
+            if partial is None or (partial.size,partial.mtime_ns) != (self.size,self.mtime_ns):
+                partial = PartialFile(box,self.path,self.size,self.mtime_ns,self.sparse)
+                box._partials[self.path] = partial
+
+            self._output = partial.open()
+
+        self._partial = partial
+        self._offset = None
+        self._received = 0
+        self._saved = 0
+        self._completed = False
+        return None
+
+    def relayed_range(self):
+
+        if not self._partial.resumed:
+            return self._offset,self._received,self._partial.temp
+
+        #What came in before the transfer was interrupted was never passed on, so the whole file is, once it is in
+        return None if self._completed else False
+
+    def on_data(self,length):
+        offset = self.conn.read_data_offset()
+        self.conn.read_into_file(self._output,offset,length-DATA_PAYLOAD.size)
+        self._written(offset,length-DATA_PAYLOAD.size)
+
+    def write_data(self,offset,data):
+        self._output.write_at(offset,data)
+        self._written(offset,len(data))
+
+    def on_hole(self,offset,length):
+        #Nothing to write, the partial file was extended without allocating and is still a hole there
+        self._written(offset,length)
+
+    def _written(self,offset,length):
+        #A range comes in front to back
+
+        if self._offset is None:
+            self._offset = offset
+        self._received = self._received + length
+
+        if self._received - self._saved >= CHECKPOINT_SIZE:
+            #An fsync and a commit, taken in the background while the rest keeps coming in
+            offset,received = self._offset,self._received
+            self._saved = received
+            self.box._in_background(self.conn,lambda: self._checkpoint(offset,received))
+
+    def _save_progress(self):
+        #Makes what came in so far durable and records it, an interrupted transfer resumes from here
+
+        if self._offset is None or self._received == self._saved:
+            return
+
+        self._saved = self._received
+        self._checkpoint(self._offset,self._received)
+
+    def _checkpoint(self,offset,received):
+
+        if sync_file(self._partial.temp):
+            self.box._index.add_partial(self.path,self.size,self.mtime_ns,offset,received)
+
+    def finish(self):
+
+        if self._received < self.size:
+            #Only part of the file, it is kept in case the other parts don't make it
+            self._save_progress()
+
+        with self.box._partial_lock:
+            self._partial.release()
+            self._partial.extents.append((self._offset or 0,self._received))
+            if not self._partial.complete():
+                return STATUS_OK
+            self._drop()
+
+        self.box._replace_file(self._partial.temp,self.path)
+        self.box._index.remove_partial(self.path)
+        self._completed = True
+
+        print "\nSuccessfully downloaded %s!"%self.path
+        return STATUS_OK
+
+    def abort(self):
+
+        try:
+            self._save_progress()
+        except (IOError,OSError):
+            pass
+
+        with self.box._partial_lock:
+            self._partial.release()
+            self._drop()
+
+    def _drop(self):
+        #The caller holds the partial lock
+        if self.box._partials.get(self.path) is self._partial:
+            del self.box._partials[self.path]
+            self.box._temp_ignore_list.remove(self.path)
+
+
+class WholeFile(RangeFile):
+    #The plain transfer, the whole file as one range. It is passed on whole
+
+    def start(self):
+        self.new = not os.path.isfile(self.path)
+        return RangeFile.start(self)
+
+    def relayed_range(self):
+        return None
+
+
+class DeltaFile(IncomingFile):
+    #Send our block signatures, then rebuild the new version from our copy and the ops that come back
+
+    def start(self):
+
+        if not os.path.isfile(self.path):
+            #Nothing to build on, the peer sends the whole file instead
+            return STATUS_SEND_WHOLE
+
+        basis_size = os.stat(self.path).st_size
+        block_size = block_size_for(basis_size)
+
+        self._temp = self._temp_name("lbdelta")
+        self._basis = io.open(self.path,"rb")
+        self._out = io.open(self._temp,"wb")
+        self._patcher = DeltaPatcher(self._basis,self._out,block_size,basis_size)
+        self._digest = None
+
+        #Reading all of our copy, the signatures go out once they are all taken
+        self.box._in_background(self.conn,lambda: self._signature_frames(block_size,basis_size),self._send_signatures)
+        return None
+
+    def _signature_frames(self,block_size,basis_size):
+        with io.open(self.path,"rb") as basis:
+            return list(signature_frames(block_size,basis_size,signatures(basis,block_size)))
+
+    def _send_signatures(self,payloads):
+        for payload in payloads:
+            self.conn.send_frame(DELTA_SIGNATURES,self.stream,payload)
+
+    def on_frame(self,frame_type,payload):
+
+        if frame_type != DELTA_OPS:
+            IncomingFile.on_frame(self,frame_type,payload)
+
+        #A copy op can read a long run of our copy, the ops are applied in the background in the order they came
+        self.box._in_background(self.conn,lambda: self._apply(payload))
+
+    def _apply(self,payload):
+
+        for op in unpack_ops(payload):
+            if op[0] == "copy":
+                self._patcher.copy(op[1],op[2])
+            elif op[0] == "data":
+                self._patcher.write(op[1])
+            else:
+                self._digest = op[1]
+
+    def finish(self):
+
+        self._close()
+
+        if self._digest is not None and self._patcher.finish(self._digest):
+            self.box._replace_file(self._temp,self.path)
+            print "\nSuccessfully patched %s!"%self.path
+            return STATUS_OK
+
+        #Our copy changed under us or the data got mangled, the peer falls back to a whole send
+        self._remove(self._temp)
+        return STATUS_FAILED
+
+    def abort(self):
+        self._close()
+        self._remove(self._temp)
+
+    def _close(self):
+        self._basis.close()
+        self._out.close()
+
+
+class ChunkedFile(IncomingFile):
+    #The peer lists the file's chunks, every chunk we already have somewhere in the folder is copied
+    #locally and only the rest is asked for. Those come back as FILE_DATA, one chunk per frame.
+    #For a file new to the peer the list may come after a probe of its first chunks
+
+    def start(self):
+        self._temp = self._temp_name("lbchunks")
+        self._out = None
+        self._listed = False
+        self._wanted = {}
+        return None
+
+    def on_frame(self,frame_type,payload):
+
+        if frame_type == CHUNK_PROBE and not self._listed:
+            #Only looked up, a chunk that turns out to have changed since just gets asked for later
+            count, = COUNT.unpack_from(payload)
+            for offset,length,digest in unpack_chunk_list(payload[COUNT.size:],count):
+                if self.box._chunk_index.lookup(digest):
+                    self.conn.send_frame(CHUNK_PROBE_HIT,self.stream)
+                    return None
+            return STATUS_SEND_WHOLE
+
+        if frame_type != CHUNK_LIST or self._listed:
+            IncomingFile.on_frame(self,frame_type,payload)
+
+        self._listed = True
+        count, = COUNT.unpack_from(payload)
+        self._chunk_list = unpack_chunk_list(payload[COUNT.size:],count)
+
+        #Copying the chunks we have reads and writes most of the file, CHUNK_WANT goes out once they are in
+        self.box._in_background(self.conn,self._copy_local,self._send_wanted)
+        return None
+
+    def _copy_local(self):
+        #Returns the indexes of the chunks to ask the peer for
+
+        #The index is kept up to date as files change and come in (see chunkbox), only the
+        #offered chunks are looked up in it
+        chunk_index = self.box._chunk_index
+
+        #Offsets every missing chunk has to be written at, a chunk is only asked for once
+        missing = {}
+        missing_order = []
+        self.local_bytes = 0
+
+        self._out = OutputFile(self._temp,self.size,truncate=True)
+
+        reader = chunk_index.reader()
+        try:
+            for index,(offset,length,digest) in enumerate(self._chunk_list):
+
+                if digest in missing:
+                    missing[digest].append(offset)
+                    continue
+
+                data = reader.read_verified(digest)
+                if data is None:
+                    missing[digest] = [offset]
+                    missing_order.append(index)
+                    continue
+
+                self._out.write_at(offset,data)
+                self.local_bytes = self.local_bytes + length
+        finally:
+            reader.close()
+
+        for index in missing_order:
+            offset,length,digest = self._chunk_list[index]
+            self._wanted[offset] = (length,digest,missing[digest])
+
+        return missing_order
+
+    def _send_wanted(self,missing_order):
+
+        if self.local_bytes == 0:
+            #Nothing to reuse, a whole transfer moves the same bytes without a frame per chunk
+            self.box._refuse(self.conn,self.stream,STATUS_SEND_WHOLE)
+            return
+
+        self.conn.send_frame(CHUNK_WANT,self.stream,pack_index_list(missing_order))
+
+    def on_data(self,length):
+        offset = self.conn.read_data_offset()
+        self.write_data(offset,self.conn.read_payload(length-DATA_PAYLOAD.size))
+
+    def write_data(self,offset,data):
+
+        wanted = self._wanted.get(offset)
+        if wanted is None or wanted[0] != len(data) or chunk_hash(data) != wanted[1]:
+            return
+
+        for chunk_offset in wanted[2]:
+            self._out.write_at(chunk_offset,data)
+        del self._wanted[offset]
+
+    def finish(self):
+
+        if self._out is None:
+            return STATUS_FAILED
+        self._out.close()
+
+        if self._wanted:
+            #Some chunks never arrived or didn't match their hash
+            self._remove(self._temp)
+            return STATUS_FAILED
+
+        self.box._replace_file(self._temp,self.path)
+
+        st = os.stat(self.path)
+        self.box._chunk_index.add(self.path,st.st_size,st.st_mtime,self._chunk_list)
+
+        print "\nSuccessfully assembled %s! (%s bytes found locally)"%(self.path,self.local_bytes)
+        return STATUS_OK
+
+    def abort(self):
+        if self._out is not None:
+            self._out.close()
+        self._remove(self._temp)
+
+
+class BulkStream(IncomingFile):
+    #Many small files one after the other as records (see bulkbox). There is no path of its own, every file
+    #is ignored while it comes in and put in place, indexed and passed on as soon as its last byte is in
+
+    def start(self):
+
+        self.files = 0
+        self._reader = RecordReader(self._begin_file,self._file_data,self._end_file)
+        self._position = 0
+        self._file = None
+        self._received = []
+        return None
+
+    def relayed_range(self):
+        #Passed on when it is done, as one bulk stream again
+        return False
+
+    def on_data(self,length):
+        offset = self.conn.read_data_offset()
+        self.write_data(offset,self.conn.read_payload(length-DATA_PAYLOAD.size))
+
+    def write_data(self,offset,data):
+
+        if offset != self._position:
+            raise ProtocolError("Bulk stream %s skipped from %s to %s"%(self.stream,self._position,offset))
+        self._position = self._position + len(data)
+        self._reader.feed(data)
+
+    def _begin_file(self,name,size,mtime_ns):
+
+        path = self.box._local_path(name)
+        self.box._temp_ignore_list.append(path)
+
+        self._file_path = path
+        self._file_temp = temp_name(path,"lbbulk")
+        self._file = OutputFile(self._file_temp,size,truncate=True)
+
+    def _file_data(self,offset,data):
+        self._file.write_at(offset,data)
+
+    def _end_file(self):
+
+        self._file.close()
+        self._file = None
+
+        self.box._replace_file(self._file_temp,self._file_path)
+        self.box._received(self._file_path,True)
+        self._received.append(self._file_path)
+        self.files = self.files + 1
+
+    def finish(self):
+
+        if self._reader.in_record():
+            #The stream ended in the middle of a file
+            self.abort()
+            return STATUS_FAILED
+
+        if self.route and self._received:
+            self.box._relay(self._received,self.size,self.mtime_ns,None,self.route,True)
+
+        print "\nSuccessfully received %s files in bulk!"%self.files
+        return STATUS_OK
+
+    def abort(self):
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._remove(self._file_temp)
+            self.box._received(self._file_path,False)
+
+
+class CastFile(IncomingFile):
+    #A whole file multicast to us and every other peer (see castbox). Its datagrams are written as they
+    #come in, on the thread of the group's listener, the pieces they missed come as FILE_DATA after CAST_DONE
+
+    def start(self):
+
+        self._temp = self._temp_name("lbcast")
+        self._output = OutputFile(self._temp,self.size,truncate=True)
+
+        #A 1 for every block that is in, parity blocks of the groups that aren't complete yet, and the
+        #(offset,length) pieces repaired over TCP
+        self._have = bytearray(block_count(self.size))
+        self._blocks = 0
+        self._parity = {}
+        self._repaired = []
+
+        self._lock = threading.Lock()
+        self._listener = None
+        self._session = None
+        self._listening = False
+        self._last = time.time()
+        return None
+
+    def on_frame(self,frame_type,payload):
+
+        if frame_type == CAST_JOIN and self._listener is None:
+
+            session,group,port = unpack_join(payload)
+            try:
+                listener = self.box._cast_listener(group,port)
+            except socket.error as e:
+                print "\nCan't join multicast group %s:%s: %s"%(group,port,e)
+                return STATUS_SEND_WHOLE
+
+            self._session = session
+            self._listener = listener
+            self._listening = True
+            listener.add(session,self)
+            self.conn.send_frame(CAST_READY,self.stream)
+            return None
+
+        if frame_type == CAST_DONE and self._listening:
+            #Waits for the last datagrams and reads blocks back to rebuild the lost ones
+            self.box._in_background(self.conn,self._settle,self._settled)
+            return None
+
+        return IncomingFile.on_frame(self,frame_type,payload)
+
+    def _settle(self):
+        #(blocks rebuilt,pieces still missing) once the multicast is over, None if none of it got here
+
+        self._drain()
+        self._leave()
+
+        if self._blocks == 0 and self.size > 0:
+            return None
+
+        recovered = self._recover()
+        return recovered,missing_blocks(self._have,self.size)
+
+    def _settled(self,result):
+
+        if result is None:
+            #Multicast doesn't get here, the peer sends this file and the next ones over TCP
+            self.box._refuse(self.conn,self.stream,STATUS_SEND_WHOLE)
+            return
+
+        recovered,missing = result
+        print "\nMulticast of %s: %s of %s blocks in, %s rebuilt, %s bytes to repair"%(os.path.basename(self.path),
+              self._blocks,len(self._have),recovered,sum(length for offset,length in missing))
+        self.conn.send_frame(CAST_NACK,self.stream,pack_extents(missing))
+
+    def on_datagram(self,index,kind,payload):
+        #On the listener's thread
+
+        self._last = time.time()
+        with self._lock:
+            if not self._listening:
+                return
+
+            if kind != KIND_DATA:
+                #index is the group
+                if not self._group_complete(index):
+                    self._parity[index] = payload.tobytes()
+                return
+
+            if index >= len(self._have) or self._have[index]:
+                return
+
+            offset = index*CAST_BLOCK_SIZE
+            self._output.write_at(offset,payload,min(len(payload),self.size-offset))
+            self._have[index] = 1
+            self._blocks = self._blocks + 1
+
+            group = index//FEC_GROUP
+            if self._group_complete(group):
+                self._parity.pop(group,None)
+
+    def _group_complete(self,group):
+        first = group*FEC_GROUP
+        return self._have.find(b"\0",first,min(first+FEC_GROUP,len(self._have))) == -1
+
+    def _drain(self):
+        #Datagrams sent before CAST_DONE may still be on their way or in the socket's buffer
+
+        deadline = time.time() + DRAIN_TIME
+        while self._blocks < len(self._have) and time.time() < deadline and time.time() - self._last < QUIET_TIME:
+            time.sleep(0.01)
+
+    def _leave(self):
+
+        if self._listener is not None:
+            self._listener.remove(self._session)
+        with self._lock:
+            self._listening = False
+
+    def _recover(self):
+        #Rebuilds the block of every group that lost exactly one from the others and the parity block
+
+        recovered = 0
+        with io.open(self._temp,"rb") as f:
+            for group,parity in self._parity.items():
+
+                first = group*FEC_GROUP
+                last = min(first+FEC_GROUP,len(self._have))
+                lost = [index for index in range(first,last) if not self._have[index]]
+                if len(lost) != 1:
+                    continue
+
+                blocks = [parity]
+                for index in range(first,last):
+                    if index != lost[0]:
+                        f.seek(index*CAST_BLOCK_SIZE)
+                        blocks.append(f.read(CAST_BLOCK_SIZE))
+
+                offset = lost[0]*CAST_BLOCK_SIZE
+                self._output.write_at(offset,xor_blocks(blocks,CAST_BLOCK_SIZE),min(CAST_BLOCK_SIZE,self.size-offset))
+                self._have[lost[0]] = 1
+                recovered = recovered + 1
+
+        self._parity = {}
+        return recovered
+
+    def on_data(self,length):
+        offset = self.conn.read_data_offset()
+        self.conn.read_into_file(self._output,offset,length-DATA_PAYLOAD.size)
+        self._repaired.append((offset,length-DATA_PAYLOAD.size))
+
+    def write_data(self,offset,data):
+        self._output.write_at(offset,data)
+        self._repaired.append((offset,len(data)))
+
+    def _unfilled(self):
+        #The pieces of the file that came neither by multicast nor rebuilt nor repaired
+        held = missing_extents(missing_blocks(self._have,self.size),self.size)
+        return missing_extents(held+self._repaired,self.size)
+
+    def finish(self):
+
+        self._leave()
+        self._output.close()
+
+        unfilled = self._unfilled()
+        if unfilled:
+            #FILE_END before every repair was in, the file would have holes. The peer sends it over TCP
+            print "\nMulticast of %s is missing %s bytes"%(os.path.basename(self.path),sum(length for offset,length in unfilled))
+            self._remove(self._temp)
+            return STATUS_SEND_WHOLE
+
+        self.box._replace_file(self._temp,self.path)
+
+        print "\nSuccessfully downloaded %s!"%self.path
+        return STATUS_OK
+
+    def abort(self):
+
+        self._leave()
+        self._output.close()
+        self._remove(self._temp)
+
+
+TRANSFER_MODES = {MODE_WHOLE: WholeFile, MODE_DELTA: DeltaFile, MODE_CHUNKS: ChunkedFile, MODE_RANGE: RangeFile, MODE_MULTICAST: CastFile}
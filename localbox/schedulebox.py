@@ -0,0 +1,139 @@
+'''
+## SCHEDULEBOX 1.0
+## Sits between the watcher and LocalBox.sync_files. Watcher events only add paths to a pending set,
+## repeated events for a path are merged, and once no new event has come in for the quiet window the
+## whole set is synced in one go, so copying 500 files into the folder is one sync and not 500.
+## Files still being written (or still being received from a peer) are held back until they stop
+## changing, everything else goes to sync_files as one work list with the small files first
+'''
+
+import os
+import threading
+import time
+
+#Seconds without a new event before the pending paths are synced
+DEFAULT_QUIET_WINDOW = 1.0
+
+#A file whose mtime is at least this old isn't being written anymore
+DEFAULT_SETTLE_TIME = 2.0
+
+#A path waits at most this long, even if events for it or for other files keep coming
+DEFAULT_MAX_DELAY = 30.0
+
+
+class SyncScheduler(object):
+
+    def __init__(self,box,quiet_window=DEFAULT_QUIET_WINDOW,settle_time=DEFAULT_SETTLE_TIME,max_delay=DEFAULT_MAX_DELAY):
+
+        self.box = box
+        self.quiet_window = quiet_window
+        self.settle_time = settle_time
+        self.max_delay = max_delay
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+        #path -> time it was first reported since it was last synced
+        self._pending = {}
+        self._last_event = 0
+
+        #path -> (size,mtime) when it was last looked at and still changing
+        self._seen = {}
+
+        self._thread = None
+
+    def start(self):
+
+        t = threading.Thread(target = self._run)
+        t.daemon = True
+        t.start()
+        self._thread = t
+
+    def add(self,paths):
+        #Called by the watcher for every added, changed or deleted file
+
+        now = time.time()
+        with self._lock:
+            for path in paths:
+                self._pending.setdefault(path,now)
+            self._last_event = now
+            self._changed.notify()
+
+    def _run(self):
+
+        while True:
+            paths = self._next_batch()
+            ready = self._settled(paths)
+
+            if not ready:
+                continue
+
+            print "\nSyncing %s file(s)"%len(ready)
+            try:
+                self.box.sync_files(ready)
+            except (IOError,OSError) as e:
+                print "\nSync Failed: %s"%e
+
+    def _next_batch(self):
+        #Waits for a quiet window (or until the oldest path has waited max_delay), then takes every pending path
+
+        with self._lock:
+            while True:
+                if not self._pending:
+                    self._changed.wait()
+                    continue
+
+                now = time.time()
+                wake = min(self._last_event+self.quiet_window,min(self._pending.values())+self.max_delay)
+                if now >= wake:
+                    break
+                self._changed.wait(wake-now)
+
+            paths = self._pending
+            self._pending = {}
+            return paths
+
+    def _settled(self,paths):
+        #The paths that are ready to sync, smallest first. The rest go back to pending
+
+        now = time.time()
+        ready = []
+        waiting = {}
+
+        for path,first_seen in paths.items():
+
+            if os.path.basename(path) in self.box._ignore_list:
+                continue
+
+            if path in self.box._temp_ignore_list:
+                #Still coming in from a peer, however long that takes
+                waiting[path] = now
+                continue
+
+            try:
+                st = os.stat(path)
+            except OSError:
+                #Deleted
+                self._seen.pop(path,None)
+                ready.append((0,path))
+                continue
+
+            signature = (st.st_size,st.st_mtime)
+            still_written = now - st.st_mtime < self.settle_time and self._seen.get(path) != signature
+
+            if still_written and now - first_seen < self.max_delay:
+                self._seen[path] = signature
+                waiting[path] = first_seen
+                continue
+
+            self._seen.pop(path,None)
+            ready.append((st.st_size,path))
+
+        if waiting:
+            with self._lock:
+                for path,first_seen in waiting.items():
+                    self._pending.setdefault(path,first_seen)
+                self._last_event = max(self._last_event,now)
+                self._changed.notify()
+
+        return [path for size,path in sorted(ready)]
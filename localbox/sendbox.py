@@ -0,0 +1,190 @@
+'''
+## SENDBOX 1.0
+## The transfer engine LocalBox uses to move file data across a socket
+## Sending goes through the kernel's sendfile (zero-copy, the data never enters python)
+## and receiving reads into one preallocated buffer with recv_into, so no string is built per chunk,
+## which is written straight to its offset in the file (see writebox)
+## When neither is available the plain read/send and recv/write loops are used instead
+'''
+
+import ctypes
+import ctypes.util
+import errno
+import io
+import os
+import select
+import sys
+import threading
+
+DEFAULT_SEND_BUFFER_SIZE = 1024*1024
+DEFAULT_RECV_BUFFER_SIZE = 256*1024
+
+#sendfile errors that mean "this file/socket pair can't be spliced", use the copy loop instead
+_SENDFILE_UNSUPPORTED = (errno.EINVAL,errno.ENOSYS,errno.EOPNOTSUPP,errno.ENOTSOCK)
+
+
+def _load_sendfile():
+    #os.sendfile only exists from python 3.3, on python 2 call libc directly (linux only)
+    if hasattr(os,"sendfile"):
+        return os.sendfile
+
+    if not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",use_errno=True)
+        _sendfile = libc.sendfile64
+    except (OSError,AttributeError):
+        return None
+
+    _sendfile.argtypes = [ctypes.c_int,ctypes.c_int,ctypes.POINTER(ctypes.c_longlong),ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd,in_fd,offset,count):
+        position = ctypes.c_longlong(offset)
+        sent = _sendfile(out_fd,in_fd,ctypes.byref(position),count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err,os.strerror(err))
+        return sent
+
+    return sendfile
+
+
+_sendfile = _load_sendfile()
+
+
+class TransferEngine(object):
+
+    def __init__(self,send_buffer_size=DEFAULT_SEND_BUFFER_SIZE,recv_buffer_size=DEFAULT_RECV_BUFFER_SIZE,zero_copy=True):
+
+        self.send_buffer_size = send_buffer_size
+        self.recv_buffer_size = recv_buffer_size
+
+        #Picked once per engine, both peers choose on their own since the bytes on the wire are the same
+        self.zero_copy = zero_copy and _sendfile is not None
+
+        #Reused for every chunk of every file, one set per thread since every connection runs on its own
+        self._buffers = threading.local()
+
+    def _recv_buffer(self):
+
+        if not hasattr(self._buffers,"recv_buffer"):
+            self._buffers.recv_buffer = bytearray(self.recv_buffer_size)
+            self._buffers.recv_view = memoryview(self._buffers.recv_buffer)
+        return self._buffers.recv_buffer,self._buffers.recv_view
+
+    def _send_view(self):
+        #Only the fallback send loop needs one
+
+        if not hasattr(self._buffers,"send_view"):
+            self._buffers.send_view = memoryview(bytearray(self.send_buffer_size))
+        return self._buffers.send_view
+
+    def send_file(self,sock,filename,size,offset=0):
+        #Sends exactly size bytes of the file starting at offset. If the file shrank while it was
+        #being sent the rest is padded with zeros so the peer's byte count (and the stream) stays intact,
+        #the changed mtime makes the next sync send it again anyway
+
+        with io.open(filename,"rb") as f:
+            return self.send_from(sock,f,offset,size)
+
+    def send_from(self,sock,f,offset,size):
+        #Same as send_file for a file that is already open
+
+        sent = 0
+        if self.zero_copy:
+            sent = self._send_zero_copy(sock,f,offset,size)
+
+        if sent < size:
+            sent = sent + self._send_loop(sock,f,offset+sent,size-sent)
+
+        if sent < size:
+            self._send_padding(sock,size-sent)
+
+        return size
+
+    def _send_zero_copy(self,sock,f,offset,count):
+
+        out_fd = sock.fileno()
+        in_fd = f.fileno()
+        sent = 0
+
+        while sent < count:
+            try:
+                n = _sendfile(out_fd,in_fd,offset+sent,min(count-sent,0x7ffff000))
+            except OSError as e:
+                if e.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
+                    #Socket has a timeout set (non blocking underneath), wait until it drains
+                    select.select([],[out_fd],[])
+                    continue
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno in _SENDFILE_UNSUPPORTED and sent == 0:
+                    self.zero_copy = False
+                    return 0
+                raise
+
+            if n == 0:
+                #End of file reached early
+                break
+            sent = sent + n
+
+        return sent
+
+    def _send_loop(self,sock,f,offset,count):
+        #Fallback: the original read/send loop, but reading into one buffer instead of new strings
+
+        view = self._send_view()
+
+        f.seek(offset)
+        sent = 0
+
+        while sent < count:
+            n = f.readinto(view[:min(count-sent,len(view))])
+            if not n:
+                break
+            sock.sendall(view[:n])
+            sent = sent + n
+
+        return sent
+
+    def _send_padding(self,sock,count):
+
+        zeros = b"\0"*min(count,self.send_buffer_size)
+        while count > 0:
+            n = min(count,len(zeros))
+            sock.sendall(zeros[:n])
+            count = count - n
+
+    def receive_at(self,sock,out,offset,size):
+        #Receives exactly size bytes into out (a writebox.OutputFile) from offset on and returns how many
+        #arrived, never reads past size so whatever the peer sends next stays on the socket
+
+        if not hasattr(sock,"recv_into"):
+            return self._receive_loop(sock,out,offset,size)
+
+        buf,view = self._recv_buffer()
+        remaining = size
+
+        while remaining > 0:
+            n = sock.recv_into(view,min(remaining,len(view)))
+            if n == 0:
+                break
+            out.write_at(offset+size-remaining,buf,n)
+            remaining = remaining - n
+
+        return size - remaining
+
+    def _receive_loop(self,sock,out,offset,size):
+
+        remaining = size
+
+        while remaining > 0:
+            chunk = sock.recv(min(remaining,self.recv_buffer_size))
+            if not chunk:
+                break
+            out.write_at(offset+size-remaining,chunk)
+            remaining = remaining - len(chunk)
+
+        return size - remaining
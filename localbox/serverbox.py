@@ -0,0 +1,420 @@
+'''
+## SERVERBOX 1.0
+## Serves the connections of many peers from one thread, on epoll where there is one and select everywhere else
+## Frames are read without blocking into a buffer per connection and handed to frame_received once complete,
+## replies wait in the connection's output buffer until the socket takes them.
+## A connection with more than output_limit bytes waiting to go out isn't read from until it drains, so a peer
+## that stops reading only slows itself down, and a connection that stays quiet for timeout seconds is dropped.
+## Peers PING their connections well within it (see peerbox), only a peer that is gone goes quiet
+## Nothing that blocks should run on the server thread, other threads hand their results back with call_soon
+'''
+
+import collections
+import errno
+import select
+import socket
+import time
+
+from framebox import FRAME_HEADER, MAX_PAYLOAD, DATA_FRAME_SIZE, DATA_PAYLOAD, HELLO, ProtocolError, pack_hello, unpack_hello
+
+DEFAULT_TIMEOUT = 300
+DEFAULT_OUTPUT_LIMIT = 4*1024*1024
+
+#Most bytes read from one connection in a row before the others get their turn
+_READ_QUOTA = 1024*1024
+
+_WOULD_BLOCK = (errno.EAGAIN,errno.EWOULDBLOCK,errno.EINTR)
+
+
+class PeerConnection(object):
+    #One peer's connection as the frame handler sees it. It has the methods of framebox.Connection, but
+    #reads come out of the frame that is already buffered and sends go to the output buffer
+
+    def __init__(self,sock,address):
+
+        self.sock = sock
+        self.address = address
+        self.peer_version = None
+        self.peer_capabilities = []
+
+        #Whatever the server's user wants to keep per connection
+        self.session = None
+
+        self.last_active = time.time()
+        self.closed = False
+
+        self._out = collections.deque()
+        self.out_size = 0
+
+        self._header = bytearray(FRAME_HEADER.size)
+        self._buffer = bytearray(DATA_FRAME_SIZE+DATA_PAYLOAD.size)
+        self._target = memoryview(self._header)
+        self._received = 0
+        self._frame = None
+        self._position = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def can(self,capability):
+        return capability in self.peer_capabilities
+
+    #Reading
+
+    def receive(self,budget):
+        #Reads into the header or payload being received, returns how many bytes arrived (0 if none were waiting)
+
+        if self.frame_complete():
+            return 0
+
+        try:
+            n = self.sock.recv_into(self._target[self._received:],min(len(self._target)-self._received,budget))
+        except socket.error as e:
+            if e.errno in _WOULD_BLOCK:
+                return 0
+            raise
+
+        if n == 0:
+            raise ProtocolError("Connection closed")
+
+        self._received = self._received + n
+        self.last_active = time.time()
+
+        if self._frame is None and self._received == len(self._target):
+            frame_type,stream,length = FRAME_HEADER.unpack(bytes(self._header))
+            if length > MAX_PAYLOAD:
+                raise ProtocolError("Frame of %s bytes is too big"%length)
+
+            #Data frames reuse the connection's buffer, anything bigger gets its own
+            if length > len(self._buffer):
+                self._target = memoryview(bytearray(length))
+            else:
+                self._target = memoryview(self._buffer)[:length]
+
+            self._frame = (frame_type,stream,length)
+            self._received = 0
+
+        return n
+
+    def frame_complete(self):
+        return self._frame is not None and self._received == len(self._target)
+
+    def take_frame(self):
+        #(type,stream,length) of the complete frame, its payload is then read with the methods below
+        self._position = 0
+        return self._frame
+
+    def next_frame(self):
+        self._frame = None
+        self._target = memoryview(self._header)
+        self._received = 0
+
+    def _take(self,length):
+
+        if self._position + length > len(self._target):
+            raise ProtocolError("Frame is shorter than its contents")
+
+        data = self._target[self._position:self._position+length]
+        self._position = self._position + length
+        return data
+
+    def read_payload(self,length):
+        return self._take(length).tobytes()
+
+    def read_data_offset(self):
+        return DATA_PAYLOAD.unpack(self.read_payload(DATA_PAYLOAD.size))[0]
+
+    def read_into_file(self,out,offset,length):
+        out.write_at(offset,self._take(length))
+
+    def skip(self,length):
+        self._take(length)
+
+    #Writing
+
+    def send_frame(self,frame_type,stream,payload=b""):
+        self._queue(FRAME_HEADER.pack(frame_type,stream,len(payload))+payload)
+
+    def send_frames(self,frames):
+        self._queue(b"".join(FRAME_HEADER.pack(frame_type,stream,len(payload))+payload for frame_type,stream,payload in frames))
+
+    def _queue(self,data):
+        self._out.append(data)
+        self.out_size = self.out_size + len(data)
+
+    def flush(self):
+        #Sends as much of the output buffer as the socket takes right now
+
+        while self._out:
+            data = self._out[0]
+
+            try:
+                n = self.sock.send(data)
+            except socket.error as e:
+                if e.errno in _WOULD_BLOCK:
+                    return
+                raise
+
+            self.out_size = self.out_size - n
+            self.last_active = time.time()
+
+            if n < len(data):
+                self._out[0] = memoryview(data)[n:]
+                return
+            self._out.popleft()
+
+    def close(self):
+
+        self.closed = True
+        try:
+            self.sock.close()
+        except:
+            pass
+
+
+class _Poller(object):
+    #epoll where there is one, select everywhere else
+
+    def __init__(self):
+
+        self._epoll = select.epoll() if hasattr(select,"epoll") else None
+        self._events = {}
+
+    def watch(self,fd,read,write):
+
+        if self._events.get(fd) == (read,write):
+            return
+
+        if self._epoll is not None:
+            mask = (select.EPOLLIN if read else 0) | (select.EPOLLOUT if write else 0)
+            if fd in self._events:
+                self._epoll.modify(fd,mask)
+            else:
+                self._epoll.register(fd,mask)
+
+        self._events[fd] = (read,write)
+
+    def forget(self,fd):
+
+        if self._events.pop(fd,None) is not None and self._epoll is not None:
+            self._epoll.unregister(fd)
+
+    def wait(self,timeout):
+        #[(fd,readable,writable)]
+
+        if self._epoll is not None:
+            try:
+                events = self._epoll.poll(timeout)
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    return []
+                raise
+            readable = select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR
+            return [(fd,bool(mask & readable),bool(mask & select.EPOLLOUT)) for fd,mask in events]
+
+        readers = [fd for fd,(read,write) in self._events.items() if read]
+        writers = [fd for fd,(read,write) in self._events.items() if write]
+
+        try:
+            readable,writable,broken = select.select(readers,writers,[],timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+        writable = set(writable)
+        events = [(fd,True,fd in writable) for fd in readable]
+        events.extend((fd,False,True) for fd in writable if fd not in readable)
+        return events
+
+
+class FrameServer(object):
+    #Accepts peers on a listening socket and runs them all from serve_forever
+    #Override peer_connected, frame_received and peer_closed
+
+    def __init__(self,server_socket,timeout=DEFAULT_TIMEOUT,output_limit=DEFAULT_OUTPUT_LIMIT):
+
+        self.server_socket = server_socket
+        self.timeout = timeout
+        self.output_limit = output_limit
+
+        self._poller = _Poller()
+        self._conns = {}
+
+        #(conn,func,args) to run on the server thread, the other end of the socket pair wakes it up for them.
+        #Without socketpair (windows) they wait for the poll to time out
+        self._calls = collections.deque()
+        self._wakeup = socket.socketpair() if hasattr(socket,"socketpair") else None
+
+    def peer_connected(self,conn):
+        #The peer said hello
+        pass
+
+    def frame_received(self,conn,frame_type,stream,length):
+        #A complete frame, its payload is read from conn. Return False to close the connection
+        conn.skip(length)
+        return True
+
+    def peer_closed(self,conn,error):
+        #error is None when the peer said goodbye
+        pass
+
+    def call_soon(self,conn,func,*args):
+        #Runs func(*args) on the server thread, from any thread. What it sends to conn goes out and whatever
+        #it raises takes conn down, like frame_received. Nothing runs once conn is closed
+
+        self._calls.append((conn,func,args))
+        if self._wakeup is not None:
+            try:
+                self._wakeup[1].send(b"x")
+            except socket.error:
+                #Its buffer is full, the server is woken up already
+                pass
+
+    def serve_forever(self):
+
+        self.server_socket.setblocking(False)
+        listen_fd = self.server_socket.fileno()
+        self._poller.watch(listen_fd,True,False)
+
+        wakeup_fd = None
+        if self._wakeup is not None:
+            for sock in self._wakeup:
+                sock.setblocking(False)
+            wakeup_fd = self._wakeup[0].fileno()
+            self._poller.watch(wakeup_fd,True,False)
+
+        while True:
+
+            for fd,readable,writable in self._poller.wait(1.0):
+
+                if fd == listen_fd:
+                    self._accept()
+                    continue
+
+                if fd == wakeup_fd:
+                    self._woken()
+                    continue
+
+                conn = self._conns.get(fd)
+                if conn is None:
+                    continue
+
+                try:
+                    if writable:
+                        conn.flush()
+                    if readable:
+                        self._read(conn)
+                    if not conn.closed:
+                        conn.flush()
+                except Exception as e:
+                    #Whatever went wrong only takes this peer down
+                    self._close(conn,e)
+                    continue
+
+                self._done(conn)
+
+            self._run_calls()
+            self._expire()
+
+    def _woken(self):
+
+        try:
+            while self._wakeup[0].recv(4096):
+                pass
+        except socket.error as e:
+            if e.errno not in _WOULD_BLOCK:
+                raise
+
+    def _run_calls(self):
+
+        while self._calls:
+            conn,func,args = self._calls.popleft()
+            if conn.closed:
+                continue
+
+            try:
+                func(*args)
+                conn.flush()
+            except Exception as e:
+                self._close(conn,e)
+                continue
+
+            self._done(conn)
+
+    def _done(self,conn):
+
+        if conn.closed:
+            self._close(conn,None)
+        else:
+            self._watch(conn)
+
+    def _accept(self):
+
+        while True:
+            try:
+                sock,address = self.server_socket.accept()
+            except socket.error as e:
+                if e.errno in _WOULD_BLOCK:
+                    return
+                raise
+
+            print "\nReceived connection from: ",address
+
+            sock.setblocking(False)
+            conn = PeerConnection(sock,address)
+            conn.send_frame(HELLO,0,pack_hello())
+
+            self._conns[conn.fileno()] = conn
+            self._watch(conn)
+
+    def _watch(self,conn):
+        #Stops reading from a connection while too much of its output is waiting
+        self._poller.watch(conn.fileno(),conn.out_size < self.output_limit,conn.out_size > 0)
+
+    def _read(self,conn):
+
+        budget = _READ_QUOTA
+
+        while budget > 0 and conn.out_size < self.output_limit:
+
+            n = conn.receive(budget)
+            budget = budget - n
+
+            if conn.frame_complete():
+                frame_type,stream,length = conn.take_frame()
+
+                if conn.peer_version is None:
+                    conn.peer_version,conn.peer_capabilities = unpack_hello(frame_type,conn.read_payload(length))
+                    self.peer_connected(conn)
+                elif not self.frame_received(conn,frame_type,stream,length):
+                    conn.closed = True
+                    return
+
+                conn.next_frame()
+
+            elif n == 0:
+                return
+
+    def _expire(self):
+
+        now = time.time()
+        for conn in self._conns.values():
+            if now - conn.last_active > self.timeout:
+                self._close(conn,ProtocolError("Timed out after %s seconds"%self.timeout))
+
+    def _close(self,conn,error):
+
+        fd = conn.fileno()
+        self._poller.forget(fd)
+        del self._conns[fd]
+
+        if error is None:
+            #Whatever replies are left go out if the socket takes them
+            try:
+                conn.flush()
+            except socket.error:
+                pass
+
+        conn.close()
+        self.peer_closed(conn,error)
@@ -0,0 +1,121 @@
+'''
+## SHAPEBOX 1.0
+## What goes out to a peer first and how fast.
+## Whole files and ranges wait for a data connection in a TransferQueue, by priority class: small files
+## first, then files changed in the last RECENT_TIME seconds, then the bulk of big or old files. A range
+## of a bulk transfer gives way to anything more urgent at the next frame, the rest of it is queued again
+## in its old place (see peerbox), so a saved document doesn't wait behind a 30 GB file.
+## Outgoing bytes can be capped by token buckets, one for the whole node and one for every peer, so
+## syncing doesn't take all of a shared network
+'''
+
+import itertools
+import Queue
+import threading
+import time
+
+MB = 1024*1024
+
+#Priority classes, lower goes first
+PRIORITY_SMALL = 0
+PRIORITY_RECENT = 1
+PRIORITY_BULK = 2
+
+#After every class, the job that stops a worker
+PRIORITY_STOP = 3
+
+#Files smaller than this are always sent first
+SMALL_FILE_SIZE = 1*MB
+
+#Files modified less than RECENT_TIME seconds ago go before the bulk, unless they are BULK_CLASS_MIN_SIZE or bigger
+RECENT_TIME = 300
+BULK_CLASS_MIN_SIZE = 64*MB
+
+
+def transfer_priority(size,mtime_ns,now=None):
+
+    if size < SMALL_FILE_SIZE:
+        return PRIORITY_SMALL
+
+    if now is None:
+        now = time.time()
+    if size < BULK_CLASS_MIN_SIZE and now - mtime_ns/1e9 < RECENT_TIME:
+        return PRIORITY_RECENT
+
+    return PRIORITY_BULK
+
+
+class TransferQueue(Queue.PriorityQueue):
+    #Jobs by priority class, in the order they were queued within a class. join and task_done work as
+    #for any Queue, every job put is one task
+
+    def __init__(self):
+        Queue.PriorityQueue.__init__(self)
+        self._order = itertools.count()
+
+    def put_job(self,job,priority,order=None):
+        #order is the place of a job queued before, the rest of a transfer that gave way keeps it
+        if order is None:
+            order = next(self._order)
+        self.put((priority,order,job))
+
+    def get_job(self):
+        #(priority,order,job), waits for one
+        return self.get()
+
+    def stop(self,workers):
+        #A None job for each of the workers, they get them once everything queued before is done
+        for i in range(workers):
+            self.put_job(None,PRIORITY_STOP)
+
+    def more_urgent(self,priority):
+        #True if a job of a class before priority is waiting
+        with self.mutex:
+            return bool(self.queue) and self.queue[0][0] < priority
+
+
+class TokenBucket(object):
+    #rate bytes a second, up to burst bytes saved up while idle. Takers may run the bucket into debt,
+    #a frame bigger than what is left still goes out and the wait after it evens the rate out
+
+    def __init__(self,rate,burst=None):
+
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self,size):
+        #Takes size bytes and returns how many seconds the caller has to wait before sending them
+
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,self._tokens+(now-self._last)*self.rate)
+            self._last = now
+            self._tokens = self._tokens - size
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens/self.rate
+
+
+class RateLimit(object):
+    #The buckets bytes sent to one peer are taken from, its own and the node's. None in buckets is no limit
+
+    def __init__(self,buckets,metrics=None,peer=None):
+
+        self.buckets = [bucket for bucket in buckets if bucket is not None]
+        self.metrics = metrics
+        self.peer = peer
+
+    def take(self,size):
+        #Waits until size bytes may go out
+
+        if not self.buckets:
+            return
+
+        wait = max(bucket.reserve(size) for bucket in self.buckets)
+        if wait > 0:
+            time.sleep(wait)
+            if self.metrics is not None:
+                self.metrics.count("localbox_send_throttle_seconds_total",wait,peer=self.peer)
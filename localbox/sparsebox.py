@@ -0,0 +1,79 @@
+'''
+## SPARSEBOX 1.0
+## Files with holes: VM disk images, preallocated databases. A file whose allocated blocks don't add up to
+## its size is mapped with lseek SEEK_DATA/SEEK_HOLE, only its data is read and sent and every hole goes
+## as one FILE_HOLE frame (offset, length). The receiver doesn't preallocate such a file, it extends it
+## with truncate and writes the data at its offsets, so the holes stay holes there too.
+## Where the platform or filesystem can't tell holes apart all of the file is data, as before
+'''
+
+import errno
+import os
+
+#The lseek whences, python only has names for them from 3.3
+SEEK_DATA = getattr(os,"SEEK_DATA",3)
+SEEK_HOLE = getattr(os,"SEEK_HOLE",4)
+
+#lseek errors that mean this platform or filesystem doesn't know SEEK_DATA
+_SEEK_UNSUPPORTED = (errno.EINVAL,errno.EOPNOTSUPP,errno.ENOSYS)
+
+
+def has_holes(st):
+    #Fewer blocks allocated than the size needs, st_blocks is in 512 byte units. Not known on windows
+    blocks = getattr(st,"st_blocks",None)
+    return blocks is not None and blocks*512 < st.st_size
+
+def data_extents(path,offset,length):
+    #[(offset,length,is_data)] from offset to offset+length, holes have is_data False
+
+    end = offset + length
+    whole = [(offset,length,True)]
+
+    try:
+        #A descriptor of its own, seeking the one a file object reads through would confuse its buffer
+        fd = os.open(path,os.O_RDONLY | getattr(os,"O_BINARY",0))
+    except OSError:
+        return whole
+
+    extents = []
+    position = offset
+    try:
+        while position < end:
+            try:
+                data = min(os.lseek(fd,position,SEEK_DATA),end)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                #No data after position
+                data = end
+
+            if data > position:
+                extents.append((position,data-position,False))
+            if data >= end:
+                break
+
+            hole = min(os.lseek(fd,data,SEEK_HOLE),end)
+            extents.append((data,hole-data,True))
+            position = hole
+
+    except OSError as e:
+        if e.errno in _SEEK_UNSUPPORTED:
+            return whole
+        raise
+    finally:
+        os.close(fd)
+
+    return extents
+
+def frame_pieces(extents,frame_size):
+    #The extents with the data cut into pieces of at most frame_size bytes, a hole stays in one piece
+
+    for offset,length,is_data in extents:
+        if not is_data:
+            yield offset,length,False
+            continue
+        end = offset + length
+        while offset < end:
+            n = min(frame_size,end-offset)
+            yield offset,n,True
+            offset = offset + n
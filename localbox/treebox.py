@@ -0,0 +1,384 @@
+'''
+## TREEBOX 1.0
+## Hash tree reconciliation of the file lists of two peers
+## Every file name hashes to a leaf, leaves are grouped by the first hex digits of their hash
+## (16 children per node) and a node's digest is the XOR of the leaf hashes under it, so adding or
+## removing a name only touches the nodes on its path. Peers compare root digests first and only
+## descend into the children that differ, an idle sync costs one small message each way.
+## Requests and replies are plain bytes, the caller moves them (as frames), nothing is pickled
+## Peers that can stream replies send them in parts of about STREAM_REPLY_SIZE bytes. Every node and every
+## leaf's names are compared and the extra names handed on as soon as they are read, so neither end holds
+## a whole level of a big folder's tree, or all its names, at once
+'''
+
+import hashlib
+import struct
+import threading
+
+FANOUT = 16
+MAX_DEPTH = 4
+
+#Once the sender has this few names under a node its names are asked for instead of its children
+LEAF_SIZE = 32
+
+#Streamed replies are split into parts of about this size
+STREAM_REPLY_SIZE = 64*1024
+
+DIGEST_SIZE = 20
+EMPTY_DIGEST = b"\0"*DIGEST_SIZE
+
+COUNT = struct.Struct(">I")
+STRING = struct.Struct(">H")
+NODE = struct.Struct(">20sI")
+
+#Requests the reconciling peer sends, the first byte of a message
+REQUEST_NODES = b"N"
+REQUEST_NAMES = b"L"
+REQUEST_DONE = b"D"
+
+#The same as REQUEST_NODES and REQUEST_NAMES, with the reply streamed
+REQUEST_NODES_STREAM = b"n"
+REQUEST_NAMES_STREAM = b"l"
+
+#First byte of every part of a streamed reply, whether another one follows
+MORE_PARTS = b"+"
+LAST_PART = b"."
+
+_HEX = "0123456789abcdef"
+
+
+def name_hash(name):
+    return hashlib.sha1(name).digest()
+
+def _to_digest(value):
+    return ("%040x"%value).decode("hex")
+
+
+class NameTree(object):
+    #The set of file names of one peer, as a hash tree
+
+    def __init__(self,names=()):
+
+        #Changed by the sending thread while the receiving thread reconciles against it
+        self._lock = threading.RLock()
+
+        #prefix -> [xor of leaf hashes as an int, count], for every prefix up to MAX_DEPTH hex digits
+        self._nodes = {}
+        #prefix of MAX_DEPTH digits -> set of names
+        self._buckets = {}
+
+        for name in names:
+            self.add(name)
+
+    def _path(self,name):
+        h = name_hash(name)
+        return h,h.encode("hex")[:MAX_DEPTH]
+
+    def add(self,name):
+
+        h,bucket = self._path(name)
+        with self._lock:
+            names = self._buckets.setdefault(bucket,set())
+            if name in names:
+                return
+            names.add(name)
+            self._update(h,bucket,1)
+
+    def remove(self,name):
+
+        h,bucket = self._path(name)
+        with self._lock:
+            names = self._buckets.get(bucket)
+            if not names or name not in names:
+                return
+            names.remove(name)
+            if not names:
+                del self._buckets[bucket]
+            self._update(h,bucket,-1)
+
+    def _update(self,h,bucket,change):
+
+        value = int(h.encode("hex"),16)
+        for depth in range(MAX_DEPTH+1):
+            prefix = bucket[:depth]
+            node = self._nodes.setdefault(prefix,[0,0])
+            node[0] = node[0] ^ value
+            node[1] = node[1] + change
+            if node[1] == 0:
+                del self._nodes[prefix]
+
+    def __contains__(self,name):
+        h,bucket = self._path(name)
+        with self._lock:
+            return name in self._buckets.get(bucket,())
+
+    def __len__(self):
+        return self.node(b"")[1]
+
+    def node(self,prefix):
+        #(digest,count) of the subtree under prefix
+        with self._lock:
+            value,count = self._nodes.get(prefix,(0,0))
+        if count == 0:
+            return EMPTY_DIGEST,0
+        return _to_digest(value),count
+
+    def root(self):
+        return self.node(b"")[0]
+
+    def children(self,prefix):
+        return [self.node(prefix+digit) for digit in _HEX]
+
+    def iter_names(self,prefix):
+        #Every name under prefix, a bucket at a time, names can be removed in the meantime
+
+        if len(prefix) == MAX_DEPTH:
+            with self._lock:
+                names = list(self._buckets.get(prefix,()))
+            for name in names:
+                yield name
+            return
+
+        if self.node(prefix)[1] == 0:
+            return
+
+        for digit in _HEX:
+            for name in self.iter_names(prefix+digit):
+                yield name
+
+    def names(self,prefix):
+        #Every name under prefix
+
+        if len(prefix) == MAX_DEPTH:
+            with self._lock:
+                return list(self._buckets.get(prefix,()))
+
+        if self.node(prefix)[1] == 0:
+            return []
+
+        names = []
+        for digit in _HEX:
+            names.extend(self.names(prefix+digit))
+        return names
+
+
+def pack_strings(strings):
+    parts = [COUNT.pack(len(strings))]
+    for s in strings:
+        parts.append(STRING.pack(len(s)))
+        parts.append(s)
+    return b"".join(parts)
+
+def unpack_strings(data,offset=0):
+    return [s for s in iter_strings(data,offset)]
+
+def iter_strings(data,offset=0,end=None):
+    #The strings packed at offset one at a time. With end, its offset is set to where they end
+
+    count, = COUNT.unpack_from(data,offset)
+    offset = offset + COUNT.size
+
+    for i in range(count):
+        length, = STRING.unpack_from(data,offset)
+        offset = offset + STRING.size
+        if offset + length > len(data):
+            raise IOError("Truncated string list")
+        yield data[offset:offset+length]
+        offset = offset + length
+
+    if end is not None:
+        end[0] = offset
+
+def pack_nodes(nodes):
+    return b"".join(NODE.pack(digest,count) for digest,count in nodes)
+
+def unpack_nodes(data):
+    return [NODE.unpack_from(data,i*NODE.size) for i in range(len(data)//NODE.size)]
+
+
+def serve_reconcile(send,recv,tree):
+    #Sender side: answers the peer's requests about our tree until it is done
+    #send(payload) sends a reply, recv() returns the next request
+
+    while True:
+        request = recv()
+        kind = request[:1]
+
+        if kind == REQUEST_DONE:
+            break
+
+        prefixes = unpack_strings(request,1)
+
+        if kind == REQUEST_NODES:
+            nodes = []
+            for prefix in prefixes:
+                nodes.extend(tree.children(prefix))
+            send(pack_nodes(nodes))
+
+        elif kind == REQUEST_NAMES:
+            names = []
+            for prefix in prefixes:
+                names.extend(tree.names(prefix))
+            send(pack_strings(names))
+
+        elif kind == REQUEST_NODES_STREAM:
+            _send_parts(send,(pack_nodes(tree.children(prefix)) for prefix in prefixes))
+
+        elif kind == REQUEST_NAMES_STREAM:
+            #One group of names per prefix
+            _send_parts(send,(pack_strings(tree.names(prefix)) for prefix in prefixes))
+
+        else:
+            raise IOError("Unknown reconcile request %r"%kind)
+
+def _send_parts(send,groups):
+    #Sends the groups in parts of about STREAM_REPLY_SIZE, a group is never split
+
+    parts = []
+    size = 0
+    for group in groups:
+        parts.append(group)
+        size = size + len(group)
+        if size >= STREAM_REPLY_SIZE:
+            send(MORE_PARTS+b"".join(parts))
+            parts = []
+            size = 0
+    send(LAST_PART+b"".join(parts))
+
+class Reconciler(object):
+    #Receiver side: walks down the parts of the peer's tree that differ from ours, one round trip per
+    #level. It doesn't move any bytes itself, start() gives the first request and feed(reply) the next
+    #one until done (None when the peer has more replies to send first). The names only we have, the ones
+    #the peer doesn't have anymore, are passed to remove(name) as they are found, or kept in extra
+    #Peers that can stream their replies (stream) are asked for them that way
+    #exchanged_bytes counts the root, the requests and the replies
+
+    def __init__(self,tree,remote_root,remove=None,stream=False):
+
+        self.tree = tree
+        self.remote_root = remote_root
+        self.extra = []
+        self.extra_count = 0
+        self.round_trips = 0
+        self.exchanged_bytes = len(remote_root)
+        self.done = False
+        self._remove = remove or self.extra.append
+        self._stream = stream
+        self._request = None
+        self._steps = self._walk()
+
+    def start(self):
+        return self._next(self._steps.next())
+
+    def feed(self,reply):
+        if self._request is not None:
+            self.round_trips = self.round_trips + 1
+        self.exchanged_bytes = self.exchanged_bytes + len(reply)
+        return self._next(self._steps.send(reply))
+
+    def _next(self,request):
+        self._request = request
+        self.done = request == REQUEST_DONE
+        if request is not None:
+            self.exchanged_bytes = self.exchanged_bytes + len(request)
+        return request
+
+    def _extra(self,names):
+        for name in names:
+            self.extra_count = self.extra_count + 1
+            self._remove(name)
+
+    def _compare(self,child,remote_node,descend,leaves):
+        #Where the walk goes from one child node that the peer has too
+
+        remote_digest,remote_count = remote_node
+        local_digest,local_count = self.tree.node(child)
+
+        if remote_digest == local_digest:
+            return
+
+        if local_count == 0:
+            #Names only the peer has, nothing to remove here
+            return
+
+        if remote_count == 0:
+            self._extra(self.tree.iter_names(child))
+        elif remote_count <= LEAF_SIZE or len(child) == MAX_DEPTH:
+            leaves.append(child)
+        else:
+            descend.append(child)
+
+    def _walk(self):
+
+        tree = self.tree
+
+        if self.remote_root == tree.root():
+            yield REQUEST_DONE
+
+        level = [b""]
+        while level:
+
+            descend = []
+            leaves = []
+
+            #Every child of every prefix of the level, in order, each compared as soon as it is read
+            child = 0
+            request = REQUEST_NODES_STREAM if self._stream else REQUEST_NODES
+            reply = yield request+pack_strings(level)
+
+            while True:
+                body = reply[1:] if self._stream else reply
+                for offset in range(0,len(body)-NODE.size+1,NODE.size):
+                    if child == len(level)*FANOUT:
+                        raise IOError("More nodes than asked for")
+                    self._compare(level[child//FANOUT]+_HEX[child%FANOUT],NODE.unpack_from(body,offset),descend,leaves)
+                    child = child + 1
+
+                if not self._stream or reply[:1] != MORE_PARTS:
+                    break
+                reply = yield None
+
+            if leaves and self._stream:
+                #Every group of names is compared with its leaf as soon as it is read
+                leaf = 0
+                reply = yield REQUEST_NAMES_STREAM+pack_strings(leaves)
+
+                while True:
+                    end = [1]
+                    while end[0] < len(reply):
+                        if leaf == len(leaves):
+                            raise IOError("More names than leaves asked for")
+                        local = set(tree.names(leaves[leaf]))
+                        for name in iter_strings(reply,end[0],end):
+                            local.discard(name)
+                        self._extra(local)
+                        leaf = leaf + 1
+
+                    if reply[:1] != MORE_PARTS:
+                        break
+                    reply = yield None
+
+            elif leaves:
+                remote_names = set(unpack_strings((yield REQUEST_NAMES+pack_strings(leaves))))
+
+                for prefix in leaves:
+                    self._extra([name for name in tree.names(prefix) if name not in remote_names])
+
+            level = descend
+
+        yield REQUEST_DONE
+
+def reconcile(send,recv,tree,remote_root):
+    #Runs a Reconciler over a blocking send/recv pair, returns (names only we have, number of round trips)
+
+    reconciler = Reconciler(tree,remote_root)
+    request = reconciler.start()
+
+    while True:
+        if request is not None:
+            send(request)
+        if reconciler.done:
+            break
+        request = reconciler.feed(recv())
+
+    return reconciler.extra,reconciler.round_trips
@@ -0,0 +1,150 @@
+'''
+## WALKBOX 1.0
+## Lists every file under the synced folder, subfolders included, with its stat.
+## It is built on scandir (os.scandir from python 3.5, the scandir package before that): the entry
+## type comes with the directory listing so folders are told apart without a stat call each, and on
+## windows the stat comes with it too. Big trees are scanned by a pool of threads, one folder each at a
+## time, since most of the time goes into system calls that don't hold the GIL.
+## Without scandir the walk falls back to listdir and lstat, same results, just slower
+## Only what a sync looks at is kept of every stat, in a small FileStat record
+'''
+
+import os
+import stat
+import threading
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+DEFAULT_WALK_THREADS = 8
+
+
+class FileStat(object):
+    #The fields of a stat result LocalBox uses, a fraction of the memory of a full one on big trees
+    __slots__ = ("st_mode","st_size","st_mtime","st_mtime_ns","st_ino","st_dev")
+
+    def __init__(self,st):
+        self.st_mode = st.st_mode
+        self.st_size = st.st_size
+        self.st_mtime = st.st_mtime
+        self.st_ino = st.st_ino
+        self.st_dev = st.st_dev
+        #Left unset where the platform doesn't have it, see indexbox.mtime_ns
+        if hasattr(st,"st_mtime_ns"):
+            self.st_mtime_ns = st.st_mtime_ns
+
+class _Entry(object):
+    #What the walker needs of os.DirEntry, for when there is no scandir
+
+    def __init__(self,directory,name):
+
+        self.name = name
+        self.path = os.path.join(directory,name)
+        self._stat = None
+
+    def stat(self,follow_symlinks=False):
+        if self._stat is None:
+            self._stat = os.lstat(self.path)
+        return self._stat
+
+    def is_dir(self,follow_symlinks=False):
+        return stat.S_ISDIR(self.stat().st_mode)
+
+    def is_file(self,follow_symlinks=False):
+        return stat.S_ISREG(self.stat().st_mode)
+
+def _list(directory):
+
+    if scandir is not None:
+        return scandir(directory)
+    return [_Entry(directory,name) for name in os.listdir(directory)]
+
+
+def walk_files(root,exclude=(),threads=DEFAULT_WALK_THREADS):
+    #{path: FileStat} of every regular file under root
+    return walk(root,exclude,threads)[0]
+
+def walk(root,exclude=(),threads=DEFAULT_WALK_THREADS):
+    #({path: FileStat} of every regular file under root, [every folder under root]). Symlinks aren't
+    #followed and the folders in exclude (full paths) are skipped along with everything in them
+
+    root = os.path.realpath(root)
+    exclude = set(os.path.realpath(path) for path in exclude)
+
+    files = {}
+    folders = []
+    pending = [root]
+    lock = threading.Lock()
+    more = threading.Condition(lock)
+
+    #Folders handed out and not finished yet, the walk is done when none are left and none are pending
+    state = {"busy": 0, "error": None}
+
+    def scan(directory):
+
+        found = {}
+        subfolders = []
+
+        try:
+            entries = _list(directory)
+        except OSError:
+            #Removed or unreadable since its parent was listed
+            return found,subfolders
+
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path not in exclude:
+                        subfolders.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    found[entry.path] = FileStat(entry.stat(follow_symlinks=False))
+            except OSError:
+                #Gone between the listing and the stat
+                continue
+
+        return found,subfolders
+
+    def worker():
+
+        while True:
+            with lock:
+                while not pending and state["busy"]:
+                    more.wait()
+                if not pending:
+                    return
+                directory = pending.pop()
+                state["busy"] = state["busy"] + 1
+
+            try:
+                found,subfolders = scan(directory)
+            except Exception as e:
+                found,subfolders = {},[]
+                state["error"] = e
+
+            with lock:
+                files.update(found)
+                folders.extend(subfolders)
+                pending.extend(subfolders)
+                state["busy"] = state["busy"] - 1
+                more.notify_all()
+
+    workers = []
+    for i in range(max(1,threads)-1):
+        t = threading.Thread(target = worker)
+        t.daemon = True
+        t.start()
+        workers.append(t)
+
+    #The calling thread works too, a small tree is done before the others get going
+    worker()
+    for t in workers:
+        t.join()
+
+    if state["error"] is not None:
+        raise state["error"]
+    return files,folders
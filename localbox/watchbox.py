@@ -3,52 +3,76 @@
 ## This contains a class that is inspired by the "pywatch" Watcher class to detect file changes
 ## After the file is changed, the change is detected and an appropriate action is taken
 ##
-## AUTHOR: Shimpano Mutangama 
+## Changes are picked up by a backend. On linux that is inotify, the kernel reports exactly which
+## files changed on a single fd and the watcher sleeps until it does. Everywhere else (or if inotify
+## can't be set up) the polling backend lists the directory and stats every file once a second
+## Subfolders are watched too, inotify gets a watch on every folder in the tree and the polling backend
+## walks the whole tree (see walkbox). Folders in exclude (the localbox folder) are left out
+##
+## AUTHOR: Shimpano Mutangama
 '''
 
+import ctypes
+import ctypes.util
 import datetime
+import errno
 import os
+import select
+import struct
+import sys
 import threading
 import time
+from walkbox import walk, walk_files
 
 class Watcher(object):
 
-    def __init__(self,files=None):
+    def __init__(self,files=None,directory="..",backend=None,exclude=(),metrics=None):
 
-        self.files = []
+        self.files = set()
         self.num_runs = 0
         self.mtimes = {}
         self._monitor_continuously = False
         self._monitor_thread = None
 
+        #The folder whose files are watched, and "inotify", "poll" or None to pick the best available
+        self.directory = directory
+        self.exclude = [os.path.realpath(path) for path in exclude]
+        self.backend_name = backend
+        self._backend = None
+
+        #Where the time every pass (or batch of events) takes is recorded, if anywhere (see metricsbox)
+        self.metrics = metrics
+
         if files:
-            self.files = files
+            self.files = set(files)
 
     #Override this
-    def lb_file_changed(self):
-        #This function should be called on a file change
+    def lb_file_changed(self,paths):
+        #This function should be called on a file change, with the files that changed
         pass
 
     #Override this
-    def lb_file_deleted(self):
-        #This function should be called on a file deletion
+    def lb_file_deleted(self,paths):
+        #This function should be called on a file deletion, with the files that were deleted
         pass
 
     #Override this
-    def lb_file_added(self):
-        #This function should be called on a file addition 
+    def lb_file_added(self,paths):
+        #This function should be called on a file addition, with the files that were added
         pass
 
 
-    def execute(self):
+    def execute(self,paths):
         #It only executes when a file changes, basically the "last modified" property
-        print "A file(s) has changed..."
-        self.lb_file_changed()
+        print "A file(s) has changed...",paths
+        self.lb_file_changed(paths)
 
     def monitor(self):
         #ensures only one thread runs
         self.stop_monitor()
-        
+
+        self._backend = make_backend(self,self.backend_name)
+
         self._monitor_continously = True
         self._monitor_thread = threading.Thread(target = self._monitor_till_stopped)
         self._monitor_thread.start()
@@ -72,68 +96,320 @@ class Watcher(object):
 
 
     def watch_directory_once(self):
-        #This function is called (roughly) once a second (_monitor_till_stopped)
+        #This function is called (roughly) once a second by the polling backend
         #Because the execute() function handles file changes already,
-        #It works on the directory level, detecting file additins and subtractions 
+        #It works on the directory level, detecting file additins and subtractions
 
-        directory_files = []
-
-        #Get every path in the current directory but exclude the files.lb (stores directory files)
-        dir_paths = map(lambda x: os.path.realpath("../%s"%x),os.listdir(".."))
-        current_directory_paths = [os.path.realpath(obj) for obj in dir_paths if obj != "files.lb"]
-        for obj in dir_paths:
-            
-            if os.path.isfile(obj):
-                directory_files.append(obj)
+        #Every file in the folder and its subfolders, leaving out the excluded folders
+        directory_files = set(walk_files(self.directory,self.exclude))
 
         #self.files holds the files being watched,
         #directory_files holds files currently in directory at the given moment
         #Symmetric difference returns elements in both files excluding elements contained in both sets
-        file_changes = list(set(self.files).symmetric_difference(set(directory_files)))
+        file_changes = list(self.files.symmetric_difference(directory_files))
         #print"File Changes: ",file_changes
-        
-        if len(file_changes) > 0:
-            
-            for obj in file_changes:
-
-                if obj in self.files and obj not in directory_files:
-                    print "A file(s) has been deleted...",obj
-                    
-                    self.files.remove(obj)
-                    self.lb_file_deleted()
-
-                elif obj not in self.files and obj in directory_files:
-                    print "A file(s) has been added...",obj
-                    self.files.append(obj)
-                    self.lb_file_added()
-
-            
+
+        deleted = [obj for obj in file_changes if obj in self.files]
+        added = [obj for obj in file_changes if obj not in self.files]
+
+        if deleted:
+            print "A file(s) has been deleted...",deleted
+            for obj in deleted:
+                self.files.discard(obj)
+                self.mtimes.pop(obj,None)
+            self.lb_file_deleted(deleted)
+
+        if added:
+            print "A file(s) has been added...",added
+            self.files.update(added)
+            self.lb_file_added(added)
+
+
+    def _observe_poll(self,started):
+        if self.metrics is not None:
+            self.metrics.observe("localbox_watcher_poll_seconds",time.time()-started)
+
     def _monitor_till_stopped(self):
-        while self._monitor_continously:
-            self.watch_directory_once()
-            self.monitor_once()
-            time.sleep(1)
+        try:
+            while self._monitor_continously:
+                self._backend.run_once()
+        finally:
+            self._backend.close()
 
 
     def monitor_once(self, execute=True):
         #This detects file changes on a file level, meaning changes to the actual file
-        for f in self.files:
+        changed = []
+
+        for f in list(self.files):
             try:
                 mtime = os.stat(f).st_mtime
             except OSError:
-                #The file might be right in the middle of being written so sleep
-                time.sleep(1)
-                mtime = os.stat(f).st_mtime
+                #The file might be right in the middle of being written or was just deleted,
+                #the next directory pass sorts it out
+                continue
 
-            if f not in self.mtimes.keys():
+            if f not in self.mtimes:
                 self.mtimes[f] = mtime
                 continue
 
             if mtime > self.mtimes[f]:
                 self.mtimes[f] = mtime
-                if execute:
-                    self.execute()
+                changed.append(f)
+
+        if changed and execute:
+            self.execute(changed)
+
+
+def make_backend(watcher,name=None):
+    #inotify where it works, polling everywhere else
+
+    if name in (None,"inotify"):
+        try:
+            return InotifyBackend(watcher)
+        except (OSError,AttributeError) as e:
+            if name == "inotify":
+                raise
+            print "inotify unavailable (%s), polling instead"%e
+
+    return PollingBackend(watcher)
+
+
+class PollingBackend(object):
+    #The original loop: list the directory and stat every watched file once a second
+
+    def __init__(self,watcher,interval=1):
+        self.watcher = watcher
+        self.interval = interval
+
+    def run_once(self):
+        started = time.time()
+        self.watcher.watch_directory_once()
+        self.watcher.monitor_once()
+        self.watcher._observe_poll(started)
+        time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+#From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+_libc = None
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is linux only")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int,ctypes.c_char_p,ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int,ctypes.c_int]
+        _libc = libc
+    return _libc
+
+
+class InotifyBackend(object):
+    #One inotify fd with a watch on every folder in the tree. The thread sleeps in select until the kernel has events,
+    #waits a moment so a burst (a big copy, a save that writes many times) is read in one go,
+    #then reports every affected path once
+
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+    def __init__(self,watcher,timeout=1,batch_window=0.05):
+
+        self.watcher = watcher
+        self.timeout = timeout
+        self.batch_window = batch_window
+
+        libc = _load_libc()
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err,os.strerror(err))
+
+        #watch descriptor -> folder, and back
+        self._folders = {}
+        self._watches = {}
+
+        self._directory = os.path.realpath(watcher.directory)
+        try:
+            self._watch(self._directory)
+            self._watch_tree(self._directory)
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def _watch(self,folder):
+
+        wd = _libc.inotify_add_watch(self._fd,folder.encode(sys.getfilesystemencoding() or "utf-8"),self.MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err,os.strerror(err))
+
+        self._folders[wd] = folder
+        self._watches[folder] = wd
+
+    def _watch_tree(self,folder):
+        #Watches every folder under folder, returns the files that are in them already
+
+        files,folders = walk(folder,self.watcher.exclude)
+        for path in folders:
+            try:
+                self._watch(path)
+            except OSError:
+                #Gone already, or out of watches (fs.inotify.max_user_watches)
+                continue
+        return files
+
+    def _unwatch_tree(self,folder):
+        #Drops the watches of a folder that was moved away or deleted, and of everything under it
+
+        prefix = folder + os.sep
+        for path in [path for path in self._watches if path == folder or path.startswith(prefix)]:
+            wd = self._watches.pop(path)
+            self._folders.pop(wd,None)
+            _libc.inotify_rm_watch(self._fd,wd)
+
+        #Its files are checked again, they are all gone from here
+        return [path for path in self.watcher.files if path.startswith(prefix)]
+
+    def run_once(self):
+
+        readable,_,_ = select.select([self._fd],[],[],self.timeout)
+        if not readable:
+            return
+
+        time.sleep(self.batch_window)
+
+        started = time.time()
+        touched = set()
+        overflow = False
+
+        for wd,mask,name in self._read_events():
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+
+            if mask & IN_IGNORED:
+                #The folder is gone, the kernel dropped its watch
+                folder = self._folders.pop(wd,None)
+                if folder is not None and self._watches.get(folder) == wd:
+                    del self._watches[folder]
+                continue
+
+            if not name or wd not in self._folders:
+                continue
+            path = os.path.join(self._folders[wd],name)
+
+            if mask & IN_ISDIR:
+                if path in self.watcher.exclude:
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    #A new folder, anything put in it before its watch was added is only found by listing it
+                    try:
+                        self._watch(path)
+                    except OSError:
+                        continue
+                    touched.update(self._watch_tree(path))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    touched.update(self._unwatch_tree(path))
+                continue
+
+            touched.add(path)
+
+        if overflow:
+            #The kernel dropped events, fall back to one full pass to catch up
+            for folder in walk(self._directory,self.watcher.exclude)[1]:
+                if folder not in self._watches:
+                    try:
+                        self._watch(folder)
+                    except OSError:
+                        continue
+            self.watcher.watch_directory_once()
+            self.watcher.monitor_once()
+            self.watcher._observe_poll(started)
+            return
+
+        self._dispatch(touched)
+        self.watcher._observe_poll(started)
+
+    def _read_events(self):
+        #Everything queued on the fd right now
+
+        data = b""
+        while True:
+            try:
+                chunk = os.read(self._fd,64*1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
                     break
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not chunk:
+                break
+            data = data + chunk
+
+        offset = 0
+        while offset + _INOTIFY_EVENT.size <= len(data):
+            wd,mask,cookie,length = _INOTIFY_EVENT.unpack_from(data,offset)
+            offset = offset + _INOTIFY_EVENT.size
+            name = data[offset:offset+length].rstrip(b"\0")
+            offset = offset + length
+            yield wd,mask,name
+
+    def _dispatch(self,touched):
+        #Compares what the watcher knew with what is on disk now, so a file created and deleted
+        #within one batch reports nothing and a file replaced by a rename reports a change
+
+        watcher = self.watcher
+        added = []
+        deleted = []
+        changed = []
+
+        for path in sorted(touched):
+
+            if path in watcher.files:
+                if not os.path.exists(path):
+                    deleted.append(path)
+                elif os.path.isfile(path):
+                    changed.append(path)
+            elif os.path.isfile(path):
+                added.append(path)
+
+        if deleted:
+            print "A file(s) has been deleted...",deleted
+            for path in deleted:
+                watcher.files.discard(path)
+                watcher.mtimes.pop(path,None)
+            watcher.lb_file_deleted(deleted)
+
+        if added:
+            print "A file(s) has been added...",added
+            watcher.files.update(added)
+            watcher.lb_file_added(added)
+
+        if changed:
+            watcher.execute(changed)
 
-            
-        
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
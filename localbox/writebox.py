@@ -0,0 +1,221 @@
+'''
+## WRITEBOX 1.0
+## How received file data gets to disk. A file coming in is preallocated to its full size with
+## posix_fallocate, so the filesystem can hand it contiguous blocks instead of growing it frame by frame.
+## Every piece is written at its own offset with pwrite, the ranges of a file arriving out of order or on
+## several connections at once all go through one descriptor without seeking it. The finished file is
+## renamed over the real one in one step, so readers never see half of it.
+## A file with holes isn't preallocated, it is only extended with truncate so what isn't written stays a hole.
+## Nothing is fsynced per file: files put in place are collected in a SyncBatch and made durable together,
+## data and folders, once per sync cycle
+## Where python doesn't have posix_fallocate or pwrite (before 3.3) they are called from libc through ctypes,
+## failing that the file is extended with truncate and written with a seek and a write under a lock
+'''
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import sys
+import threading
+
+
+def _libc_function(name,argtypes,restype):
+    #name from libc, None where there is no libc to load it from
+
+    if sys.platform == "win32":
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",use_errno=True)
+        function = getattr(libc,name)
+    except (OSError,AttributeError):
+        return None
+
+    function.argtypes = argtypes
+    function.restype = restype
+    return function
+
+def _load_fallocate():
+
+    if hasattr(os,"posix_fallocate"):
+        return os.posix_fallocate
+
+    _fallocate = _libc_function("posix_fallocate64",[ctypes.c_int,ctypes.c_longlong,ctypes.c_longlong],ctypes.c_int)
+    if _fallocate is None:
+        return None
+
+    def posix_fallocate(fd,offset,length):
+        #Returns the error instead of setting errno
+        err = _fallocate(fd,offset,length)
+        if err != 0:
+            raise OSError(err,os.strerror(err))
+
+    return posix_fallocate
+
+def _load_pwrite():
+    #pwrite(fd,data,start,length,offset) writes data[start:start+length] at offset and returns how much it wrote
+
+    if hasattr(os,"pwrite"):
+        def pwrite(fd,data,start,length,offset):
+            return os.pwrite(fd,memoryview(data)[start:start+length],offset)
+        return pwrite
+
+    _pwrite = _libc_function("pwrite64",[ctypes.c_int,ctypes.c_void_p,ctypes.c_size_t,ctypes.c_longlong],ctypes.c_ssize_t)
+    if _pwrite is None:
+        return None
+
+    def pwrite(fd,data,start,length,offset):
+
+        if isinstance(data,memoryview):
+            #ctypes can't take the address of a memoryview on python 2
+            data = data[start:start+length].tobytes()
+            start = 0
+
+        if isinstance(data,bytearray):
+            address = ctypes.addressof((ctypes.c_char*len(data)).from_buffer(data))
+        else:
+            address = ctypes.cast(ctypes.c_char_p(data),ctypes.c_void_p).value
+
+        written = _pwrite(fd,address+start,length,offset)
+        if written < 0:
+            err = ctypes.get_errno()
+            raise OSError(err,os.strerror(err))
+        return written
+
+    return pwrite
+
+
+_fallocate = _load_fallocate()
+_pwrite = _load_pwrite()
+
+#posix_fallocate errors that mean the filesystem can't preallocate, the file is just extended instead
+_FALLOCATE_UNSUPPORTED = (errno.EINVAL,errno.EOPNOTSUPP,errno.ENOSYS)
+
+
+class OutputFile(object):
+    #A file being received, opened once and written at explicit offsets by every transfer of it.
+    #size preallocates it (only extends it if it is sparse), truncate empties it first
+
+    def __init__(self,path,size=None,truncate=False,sparse=False):
+
+        flags = os.O_RDWR | os.O_CREAT | getattr(os,"O_BINARY",0)
+        if truncate:
+            flags = flags | os.O_TRUNC
+
+        self.path = path
+        self.fd = os.open(path,flags,0o666)
+
+        #Only the seek and write fallback needs it
+        self._lock = threading.Lock()
+
+        if size is not None:
+            try:
+                if sparse:
+                    self.extend(size)
+                else:
+                    self.preallocate(size)
+            except (IOError,OSError):
+                os.close(self.fd)
+                raise
+
+    def preallocate(self,size):
+
+        if size > 0 and _fallocate is not None:
+            try:
+                _fallocate(self.fd,0,size)
+                return
+            except OSError as e:
+                if e.errno not in _FALLOCATE_UNSUPPORTED:
+                    raise
+
+        self.extend(size)
+
+    def extend(self,size):
+        #Without allocating anything, the new part reads as zeros
+        if os.fstat(self.fd).st_size != size:
+            os.ftruncate(self.fd,size)
+
+    def write_at(self,offset,data,length=None):
+        #data is bytes, a bytearray or a memoryview, only the first length bytes of it are written
+
+        if length is None:
+            length = len(data)
+        if length == 0:
+            return
+
+        if _pwrite is None:
+            with self._lock:
+                os.lseek(self.fd,offset,os.SEEK_SET)
+                view = memoryview(data)[:length]
+                while len(view) > 0:
+                    view = view[os.write(self.fd,view):]
+            return
+
+        start = 0
+        while start < length:
+            #A short write goes on with the rest
+            start = start + _pwrite(self.fd,data,start,length-start,offset+start)
+
+    def sync(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def sync_file(path):
+    #fsyncs the file by its name, whichever descriptor wrote it. False if it isn't there anymore
+
+    try:
+        fd = os.open(path,os.O_RDWR if os.name == "nt" else os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return True
+
+
+class SyncBatch(object):
+    #Files put in place since the last flush, made durable all at once with their folders
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._paths = set()
+
+    def add(self,path):
+        with self._lock:
+            self._paths.add(path)
+
+    def flush(self):
+        #Returns how many files were synced, files gone since they were added are skipped
+
+        with self._lock:
+            paths = self._paths
+            self._paths = set()
+
+        folders = set()
+        synced = 0
+
+        for path in paths:
+            if sync_file(path):
+                synced = synced + 1
+                folders.add(os.path.dirname(path))
+
+        #The renames themselves are only durable once their folder is, folders can't be opened on windows
+        if os.name != "nt":
+            for folder in folders:
+                try:
+                    fd = os.open(folder,os.O_RDONLY)
+                except OSError:
+                    continue
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+        return synced